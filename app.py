@@ -1,21 +1,193 @@
-# gunicorn -w 4 app:app --access-logfile -
+# gunicorn -w 4 --threads 8 app:app --access-logfile -
 
-from flask import Flask, request, abort, jsonify
-from models import db, Warehouse, Item, BalanceJournal
+from flask import Flask, Response, request, abort, jsonify, \
+    stream_with_context
+from models import db, Warehouse, Item, BalanceJournal, WarehouseSummary, \
+    ItemSummary, TableVersion, Tombstone, BalanceChangesListener, \
+    IdempotencyKey
 from flask_migrate import Migrate
-from auth import AuthError, requires_auth
+from sqlalchemy import tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from auth import AuthError, requires_auth, token_cache
+from cache import response_cache
+from coalescing import FutureTimeoutError, balance_coalescer
+from pool import MeasuredQueuePool, pool_metrics
+import metrics
+import profiling
+from importer import IMPORT_FORMATS, import_records, is_valid_capacity
+import base64
+import codecs
+import csv
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+import io
+import json
 import sys
+import time
 
 app = Flask(__name__)
 
 app.config.from_object('config')
+# checkouts of the pool are timed for the pool metrics
+app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'] = MeasuredQueuePool
 db.init_app(app)
 app.app_context().push()
 
 migrate = Migrate(app, db)
 
+profiling.init_app(app)
+metrics.init_app(app)
+balance_coalescer.init_app(app)
+
 db.create_all()
 
+# PAGINATION
+'''
+keyset pagination on the primary key
+cursor is an opaque string with the key of the last returned row,
+the next page starts right after that key, so deep pages cost the same
+as the first one
+'''
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not (isinstance(key, list) and
+            all(type(value) is int for value in key)):
+        raise ValueError('Malformed cursor')
+    return key
+
+
+def paginate(query, key_columns, key_of):
+    """Returns list of rows and the next cursor (None for the last page),
+    if neither limit nor cursor is requested returns all rows
+    and no cursor"""
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+
+    if limit is None and cursor is None:
+        return query.all(), None
+
+    try:
+        limit = int(limit or app.config['PAGE_DEFAULT_LIMIT'])
+        key = decode_cursor(cursor) if cursor else None
+    except Exception:
+        abort(400)
+
+    if not 0 < limit <= app.config['PAGE_MAX_LIMIT']:
+        abort(400)
+
+    if key is not None:
+        if len(key) != len(key_columns):
+            abort(400)
+        query = query.filter(tuple_(*key_columns) > tuple_(*key))
+
+    # one extra row tells if there is a next page
+    rows = query.order_by(*key_columns).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(key_of(rows[-1]))
+
+    return rows, next_cursor
+
+
+def is_paginated():
+    return 'limit' in request.args or 'cursor' in request.args
+
+# BALANCE FILTERS
+
+
+def parse_balance_filters(args):
+    """Returns warehouse_id, item_id and min_quantity filters from
+    query args, raises ValueError if a filter is not a number"""
+    filters = {}
+    for name in ('warehouse_id', 'item_id', 'min_quantity'):
+        value = args.get(name)
+        if value is not None:
+            filters[name] = int(value)
+    return filters
+
+
+def apply_balance_filters(query, filters, balances=BalanceJournal):
+    """Applies filters to a query (or a select) of balances, balances is
+    the source of warehouse_id, item_id and quantity columns"""
+    if 'warehouse_id' in filters:
+        query = query.filter(
+            balances.warehouse_id == filters['warehouse_id'])
+    if 'item_id' in filters:
+        query = query.filter(balances.item_id == filters['item_id'])
+    if 'min_quantity' in filters:
+        query = query.filter(balances.quantity >= filters['min_quantity'])
+
+    return query
+
+
+def filter_balances(query, balances=BalanceJournal):
+    """Applies warehouse_id, item_id and min_quantity filters
+    from request args to a query of balances"""
+    try:
+        filters = parse_balance_filters(request.args)
+    except ValueError:
+        abort(400)
+
+    return apply_balance_filters(query, filters, balances)
+
+
+def parse_moment(value):
+    """Parses ISO 8601 timestamp, without timezone it's UTC"""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+# CONDITIONAL AND CACHED RESPONSES
+'''
+lists are tagged with the version of the data they are built from, the
+version is bumped in the same transaction as every change of the data
+(see TableVersion), so it's read with one cheap query before the rows:
+- the tag is the strong ETag of the response, if it matches If-None-Match
+  of the request 304 Not Modified is returned without querying the rows
+- responses of rarely changing lists are kept serialized per process
+  with their tag, a cached body is served while its tag is the current one
+the version is read before the rows, so a response is never older than
+its tag
+'''
+
+
+def versioned_response(tag_of, cached=False):
+    def versioned_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tag = tag_of()
+            if request.if_none_match.contains(tag):
+                response = Response(status=304)
+                response.set_etag(tag)
+                return response
+
+            key = request.full_path
+            body = response_cache.get(key, tag) if cached else None
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+            else:
+                response = f(*args, **kwargs)
+                if cached:
+                    response_cache.put(key, tag, response.get_data())
+
+            response.set_etag(tag)
+            return response
+
+        return wrapper
+    return versioned_response_decorator
+
 # HEALTH CHECK
 
 
@@ -23,7 +195,26 @@ db.create_all()
 def hello():
     return jsonify({
         'success': True,
-        'status': 'Healthy'
+        'status': 'Healthy',
+        'token_cache': token_cache.stats(),
+        'response_cache': response_cache.stats()
+        })
+
+
+@app.route("/metrics")
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+@app.route("/pool")
+def get_pool_stats():
+    # the pool of the serving worker in detail, the pools of all the
+    # running workers from the metrics they write
+    return jsonify({
+        'success': True,
+        'pool': pool_metrics.stats(db.engine.pool),
+        'workers': metrics.pool_workers()
         })
 
 # CREATE ENTITIES
@@ -40,6 +231,10 @@ def add_warehouse(jwt):
         new_wh.name = wh_data['name']
         if 'overdraft_control' in wh_data:
             new_wh.overdraft_control = wh_data['overdraft_control']
+        if 'capacity' in wh_data:
+            if not is_valid_capacity(wh_data['capacity']):
+                abort(400)
+            new_wh.capacity = wh_data['capacity']
         new_wh.insert()
 
         return jsonify({
@@ -74,6 +269,45 @@ def add_item(jwt):
         print(sys.exc_info())
         abort(400)
 
+# BULK IMPORT
+
+IMPORT_MIMETYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson'
+}
+
+
+def import_entities(model):
+    """Imports warehouses or items from the CSV or NDJSON request body,
+    the body is read line by line, not at once"""
+    import_format = request.args.get('format',
+                                     IMPORT_MIMETYPES.get(request.mimetype))
+    if import_format not in IMPORT_FORMATS:
+        abort(400)
+
+    lines = codecs.iterdecode(request.stream, 'utf-8')
+    report = import_records(model, lines, import_format)
+
+    # the rows before the malformed part are imported, the report says
+    # how many
+    if report['aborted'] is not None:
+        return jsonify(dict(report, success=False, error=400,
+                            message='Malformed file')), 400
+
+    return jsonify(dict(report, success=True))
+
+
+@app.route("/warehouses/import", methods=['POST'])
+@requires_auth('edit:warehouses')
+def import_warehouses(jwt):
+    return import_entities(Warehouse)
+
+
+@app.route("/items/import", methods=['POST'])
+@requires_auth('edit:items')
+def import_items(jwt):
+    return import_entities(Item)
+
 # PATCH ENTITIES
 
 
@@ -94,6 +328,11 @@ def patch_warehouse(jwt, warehouse_id):
     if 'overdraft_control' in warehouse_data:
         warehouse.overdraft_control = warehouse_data['overdraft_control']
 
+    if 'capacity' in warehouse_data:
+        if not is_valid_capacity(warehouse_data['capacity']):
+            abort(400)
+        warehouse.capacity = warehouse_data['capacity']
+
     warehouse.update()
 
     return jsonify({
@@ -105,7 +344,8 @@ def patch_warehouse(jwt, warehouse_id):
 @app.route("/items/<int:item_id>", methods=['PATCH'])
 @requires_auth('edit:items')
 def patch_item(jwt, item_id):
-    item = Item.query.get(item_id)
+    # locked, so volume totals of warehouses move by the right difference
+    item = Item.query.filter_by(id=item_id).with_for_update().first()
 
     if item is None:
         abort(404)
@@ -117,7 +357,7 @@ def patch_item(jwt, item_id):
         item.name = item_data['name']
 
     if 'volume' in item_data:
-        item.volume = item_data['volume']
+        item.update_volume(item_data['volume'])
 
     item.update()
 
@@ -129,23 +369,116 @@ def patch_item(jwt, item_id):
 # GET ENTITIES
 
 
+def sync_changes(model, name):
+    """Delta sync: returns rows of the model changed after the
+    updated_since version, ids of deleted rows and the version to sync
+    from next time"""
+    try:
+        since = int(request.args['updated_since'])
+    except ValueError:
+        abort(400)
+
+    # versions are committed in order, so there can't be a change below
+    # the current version the client hasn't seen yet
+    version = TableVersion.get(model.__tablename__)
+
+    changed = model.query \
+        .filter(model.row_version > since, model.row_version <= version) \
+        .order_by(model.id)
+    deleted = db.session.query(Tombstone.row_id) \
+        .filter(Tombstone.table_name == model.__tablename__,
+                Tombstone.row_version > since,
+                Tombstone.row_version <= version) \
+        .order_by(Tombstone.row_id)
+
+    return jsonify({
+        'success': True,
+        name: [dict(entity.format(),
+                    row_version=entity.row_version,
+                    updated_at=entity.updated_at.isoformat())
+               for entity in changed],
+        'deleted': [row_id for row_id, in deleted],
+        'version': version
+    })
+
+
 @app.route("/warehouses", methods=['GET'])
+@versioned_response(lambda: TableVersion.tag('warehouses'), cached=True)
 def get_warehouses():
-    wh_list = [wh.format() for wh in Warehouse.query.all()]
+    if 'updated_since' in request.args:
+        return sync_changes(Warehouse, 'warehouses')
 
-    return jsonify({
+    warehouses, next_cursor = paginate(Warehouse.query, [Warehouse.id],
+                                       lambda wh: [wh.id])
+    wh_list = [wh.format() for wh in warehouses]
+
+    response = {
         'success': True,
         'warehouses': wh_list
-    })
+    }
+    if is_paginated():
+        response['next_cursor'] = next_cursor
+
+    return jsonify(response)
 
 
 @app.route("/items", methods=['GET'])
+@versioned_response(lambda: TableVersion.tag('items'), cached=True)
 def get_items():
-    items_list = [item.format() for item in Item.query.all()]
+    if 'updated_since' in request.args:
+        return sync_changes(Item, 'items')
 
-    return jsonify({
+    items, next_cursor = paginate(Item.query, [Item.id],
+                                  lambda item: [item.id])
+    items_list = [item.format() for item in items]
+
+    response = {
         'success': True,
         'items': items_list
+    }
+    if is_paginated():
+        response['next_cursor'] = next_cursor
+
+    return jsonify(response)
+
+# GET SUMMARIES
+
+
+@app.route("/warehouses/<int:warehouse_id>/summary", methods=['GET'])
+def get_warehouse_summary(warehouse_id):
+    warehouse = Warehouse.query.get(warehouse_id)
+
+    if warehouse is None:
+        abort(404)
+
+    # summaries are kept up to date by balance operations
+    summary = WarehouseSummary.query.get(warehouse_id) or \
+        WarehouseSummary(warehouse_id=warehouse_id, total_quantity=0,
+                         total_volume=0)
+
+    return jsonify({
+        'success': True,
+        'warehouse': warehouse.format(),
+        'summary': summary.format()
+    })
+
+
+@app.route("/items/<int:item_id>/summary", methods=['GET'])
+def get_item_summary(item_id):
+    item = Item.query.get(item_id)
+
+    if item is None:
+        abort(404)
+
+    summary = ItemSummary.query.get(item_id) or \
+        ItemSummary(item_id=item_id, total_quantity=0)
+    summary_dict = summary.format()
+    summary_dict['total_volume'] = summary.total_quantity * item.volume
+
+    return jsonify({
+        'success': True,
+        'item': item.format(),
+        'summary': summary_dict
     })
 
 # DELETE ENTITIES
@@ -182,6 +515,35 @@ def delete_item(jwt, item_id):
         'success': True
     })
 
+# IDEMPOTENCY KEYS
+'''
+a balance operation sent with an Idempotency-Key header is applied once:
+the key is stored with the response in the transaction of the operation,
+a retry with the same key (by the same user) gets the stored response
+with Idempotent-Replayed: true, waiting for the first request if it's
+still running, and the same key with another operation is 422
+rejected operations are not stored, nothing was applied, so their
+retries are applied as new ones
+'''
+
+
+def parse_idempotency_key(headers):
+    """Returns the Idempotency-Key header, None if there is none,
+    raises ValueError if it's empty or too long"""
+    key = headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= 255:
+        raise ValueError('Malformed idempotency key')
+    return key
+
+
+def operation_hash(operation):
+    return hashlib.sha256(json.dumps(operation).encode()).hexdigest()
+
+
+def replay_response(body):
+    return Response(body, mimetype='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
+
 # POST BALANCE OPERATIONS
 
 
@@ -206,60 +568,299 @@ def post_balance_operation(jwt):
     item_id = operation_data['item_id']
     quantity = operation_data['quantity']
 
-    bj_entry = BalanceJournal.query.get((warehouse_id, item_id))
-    new = False
+    if not all(type(value) is int
+               for value in (warehouse_id, item_id, quantity)):
+        abort(400)
 
-    # if there are no info in the journal, initiate a new entry
-    if bj_entry is None:
-        new = True
-        bj_entry = BalanceJournal()
-        bj_entry.warehouse_id = warehouse_id
-        bj_entry.item_id = item_id
-        bj_entry.quantity = 0
+    try:
+        idempotency_key = parse_idempotency_key(request.headers)
+    except ValueError:
+        abort(400)
+    owner = jwt.get('sub', '')
 
-    bj_entry.quantity = bj_entry.quantity + quantity
+    # one atomic statement: insert or increment the entry and check overdraft
+    try:
+        if idempotency_key is not None:
+            request_hash = operation_hash([warehouse_id, item_id, quantity])
+            first = IdempotencyKey.claim(owner, idempotency_key,
+                                         request_hash,
+                                         app.config['IDEMPOTENCY_KEY_TTL'])
+            if first is not None:
+                db.session.rollback()
+                if first.request_hash != request_hash:
+                    abort(422)
+                return replay_response(first.response)
+
+        # operations with a key are applied in the transaction of the key
+        if idempotency_key is None and \
+                balance_coalescer.accepts(warehouse_id):
+            new_balance = balance_coalescer.submit(warehouse_id, item_id,
+                                                   quantity)
+        else:
+            new_balance = BalanceJournal.apply_operation(
+                warehouse_id, item_id, quantity,
+                commit=idempotency_key is None)
+
+        body = {
+            'success': True,
+            'new_balance': new_balance
+        }
+        # the response is committed together with the operation
+        if idempotency_key is not None and new_balance is not None:
+            IdempotencyKey.remember(owner, idempotency_key, json.dumps(body))
+            db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        print(sys.exc_info())
+        abort(400)
+    except FutureTimeoutError:
+        # the coalesced batch wasn't applied in time
+        print(sys.exc_info())
+        abort(503)
 
-    # check for overdraft
-    warehouse = Warehouse.query.get(warehouse_id)
-    if bj_entry.quantity < 0 and warehouse.overdraft_control:
+    # rejected by overdraft control or capacity,
+    # or warehouse does not exist
+    if new_balance is None:
+        db.session.rollback()
+        abort(400)
+
+    return jsonify(body)
+
+
+@app.route("/balances/batch", methods=['POST'])
+@requires_auth('post:balance_operations')
+def post_balance_operations_batch(jwt):
+    # get posted json object
+    batch_data = request.get_json()
+
+    # should have properties:
+    #   - operations: list of operations with the same properties
+    #                 as in post_balance_operation
+    #   - mode: 'atomic' (default) - nothing is applied if any operation
+    #           fails, or 'best_effort' - failed operations are skipped
+    try:
+        operations = batch_data['operations']
+        mode = batch_data.get('mode', 'atomic')
+    except:
+        print(sys.exc_info())
         abort(400)
 
-    if new:
-        bj_entry.insert()
-    else:
-        bj_entry.update()
+    if (not isinstance(operations, list) or
+            len(operations) > app.config['BALANCE_BATCH_MAX_SIZE'] or
+            mode not in ('atomic', 'best_effort')):
+        abort(400)
+
+    atomic = mode == 'atomic'
+
+    errors = []
+    valid_operations = []
+    for operation_data in operations:
+        try:
+            operation = (operation_data['warehouse_id'],
+                         operation_data['item_id'],
+                         operation_data['quantity'])
+        except:
+            operation = None
+
+        if operation is None or not all(type(value) is int
+                                        for value in operation):
+            errors.append('invalid operation')
+        else:
+            errors.append(None)
+            valid_operations.append(operation)
+
+    balances = {}
+    if valid_operations and not (atomic and any(errors)):
+        try:
+            batch_errors, balances = BalanceJournal.apply_batch(
+                valid_operations, atomic)
+        except SQLAlchemyError:
+            db.session.rollback()
+            print(sys.exc_info())
+            abort(400)
+
+        batch_errors = iter(batch_errors)
+        errors = [next(batch_errors) if error is None else error
+                  for error in errors]
+
+    results = [{'success': True} if error is None
+               else {'success': False, 'error': error}
+               for error in errors]
+
+    if atomic and any(errors):
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': 'Bad request',
+            'results': results
+        }), 400
 
     return jsonify({
         'success': True,
-        'new_balance': bj_entry.quantity
+        'results': results,
+        'balances': [
+            {
+                'warehouse_id': warehouse_id,
+                'item_id': item_id,
+                'quantity': quantity
+            }
+            for (warehouse_id, item_id), quantity in sorted(balances.items())
+        ]
     })
 
 # GET BALANCES
 
 
 @app.route("/balances", methods=['GET'])
+@versioned_response(BalanceJournal.version_tag)
 def get_all_balances():
+    # balances as of the moment in the past
+    balances = None
+    if 'as_of' in request.args:
+        try:
+            moment = parse_moment(request.args['as_of'])
+        except ValueError:
+            abort(400)
+
+        balances = BalanceJournal.as_of(moment)
+        # there is no history before the first snapshot
+        if balances is None:
+            abort(422)
+
+    columns = BalanceJournal if balances is None else balances.c
+
+    # one joined query instead of lazy loading warehouse and item per entry
+    rows, next_cursor = paginate(
+        filter_balances(BalanceJournal.flat_query(balances), columns),
+        [columns.warehouse_id, columns.item_id],
+        lambda row: [row.warehouse_id, row.item_id])
+    balances_list = [BalanceJournal.format_row(row) for row in rows]
+
+    response = {
+        'success': True,
+        'balances': balances_list
+    }
+    if is_paginated():
+        response['next_cursor'] = next_cursor
 
-    balances_list_raw = BalanceJournal.query.all()
+    return jsonify(response)
 
-    balances_list = []
+# EXPORT BALANCES
 
-    for entry_raw in balances_list_raw:
-        warehouse_dict = entry_raw.warehouse.format()
-        item_dict = entry_raw.item.format()
+EXPORT_CSV_COLUMNS = ['warehouse_id', 'warehouse_name', 'overdraft_control',
+                      'item_id', 'item_name', 'item_volume',
+                      'quantity', 'volume']
+
+
+def export_ndjson(rows):
+    for row in rows:
+        yield json.dumps(BalanceJournal.format_row(row)) + '\n'
+
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_CSV_COLUMNS)
+    for row in rows:
+        writer.writerow([getattr(row, column) for column in EXPORT_CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
 
-        entry = {
-            'warehouse': warehouse_dict,
-            'item': item_dict,
-            'quantity': entry_raw.quantity,
-            'volume': entry_raw.quantity * item_dict['volume']
-        }
 
-        balances_list.append(entry)
+EXPORT_FORMATS = {
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv')
+}
+
+
+@app.route("/balances/export", methods=['GET'])
+def export_balances():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+
+    formatter, mimetype = EXPORT_FORMATS[export_format]
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+
+    # rows are read from a server-side cursor batch by batch and sent as
+    # soon as the batch is formatted, the whole table is never in memory
+    rows = filter_balances(BalanceJournal.flat_query()) \
+        .order_by(BalanceJournal.warehouse_id, BalanceJournal.item_id) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+
+    def generate():
+        chunk = []
+        for line in formatter(rows):
+            chunk.append(line)
+            if len(chunk) >= batch_size:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename=balances.{export_format}'})
+
+# CHANGE FEED OF BALANCES
+
+
+def read_changes(since):
+    # the new cursor is read first, the rows are at least as new as it
+    cursor = BalanceJournal.changes_cursor()
+    rows = filter_balances(BalanceJournal.changes_query(since, cursor)) \
+        .order_by(BalanceJournal.warehouse_id, BalanceJournal.item_id).all()
+    # ends the read transaction, long polls shouldn't keep it open
+    db.session.commit()
+    return rows, cursor
+
+
+@app.route("/balances/changes", methods=['GET'])
+def get_balance_changes():
+    # without since returns the current cursor only, it should be taken
+    # before reading the balances the changes are applied to
+    since = request.args.get('since')
+    try:
+        wait = int(request.args.get('wait', 0))
+        if since is not None:
+            since = decode_cursor(since)
+    except Exception:
+        abort(400)
+
+    if not 0 <= wait <= app.config['CHANGES_MAX_WAIT'] or \
+            (since is not None and len(since) != 1):
+        abort(400)
+
+    if since is None:
+        return jsonify({
+            'success': True,
+            'changes': [],
+            'cursor': encode_cursor([BalanceJournal.changes_cursor()])
+        })
+
+    rows, cursor = read_changes(since[0])
+
+    # long poll: wait for a notification of a balance operation, checking
+    # every CHANGES_POLL_INTERVAL anyway, since a change becomes visible
+    # to the feed only after all the older transactions are finished
+    if not rows and wait:
+        deadline = time.monotonic() + wait
+        with BalanceChangesListener() as listener:
+            rows, cursor = read_changes(since[0])
+            while not rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                listener.wait(min(remaining,
+                                  app.config['CHANGES_POLL_INTERVAL']))
+                rows, cursor = read_changes(since[0])
 
     return jsonify({
         'success': True,
-        'balances': balances_list
+        'changes': [BalanceJournal.format_row(row) for row in rows],
+        'cursor': encode_cursor([cursor])
     })
 
 # ERROR HANDLERS
@@ -319,6 +920,15 @@ def forbidden(error):
     }), 403
 
 
+@app.errorhandler(503)
+def service_unavailable(error):
+    return jsonify({
+        'success': False,
+        'error': 503,
+        'message': 'Service unavailable'
+    }), 503
+
+
 @app.errorhandler(AuthError)
 def auth_error(ex):
     return jsonify({
@@ -1,16 +1,58 @@
 import os
+import threading
+import time
 import unittest
 import json
+from unittest import mock
+from datetime import datetime, timezone
 
+import rsa
 from flask_migrate import heads
+from jose import jwk, jwt
+from sqlalchemy import event
+from starlette.testclient import TestClient
 
+import asgi
 from app import app, patch_warehouse
-from models import db, Warehouse, Item, BalanceJournal
-from config import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME_TEST, MANAGER_TOKEN, USER_TOKEN
+from generator import TRUNCATE, generate_dataset
+from auth import AuthError, JWKSKeyStore, VerifiedTokenCache, jwks_store, \
+    requires_auth, verify_decode_jwt
+from coalescing import BalanceCoalescer
+from models import db, Warehouse, Item, BalanceJournal, WarehouseSummary, \
+    ItemSummary, StockMovement, BalanceSnapshot, BalanceSnapshotEntry, \
+    TableVersion, rebuild_summaries, take_balance_snapshot, \
+    prune_idempotency_keys
+from config import DB_HOST, DB_USER, DB_PASSWORD, DB_NAME_TEST, MANAGER_TOKEN, USER_TOKEN, \
+    AUTH0_DOMAIN, API_AUDIENCE
 
 database_path = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME_TEST}'
 
 
+# LOCAL SIGNING KEYS
+def make_signing_key(kid):
+    """Returns private key in PEM and public key in JWK format"""
+    _, private_key = rsa.newkeys(1024)
+    private_pem = private_key.save_pkcs1().decode()
+    public_jwk = jwk.construct(private_pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+
+    return private_pem, public_jwk
+
+
+def make_token(private_pem, kid, permissions, expires_in=3600):
+    claims = {
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': 'test|user',
+        'exp': int(time.time()) + expires_in,
+        'permissions': permissions
+    }
+    if API_AUDIENCE:
+        claims['aud'] = API_AUDIENCE
+
+    return jwt.encode(claims, private_pem, algorithm='RS256',
+                      headers={'kid': kid})
+
+
 class WarehouseTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -58,6 +100,83 @@ class WarehouseTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(data['status'], 'Healthy')
 
+    def test_metrics(self):
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.insert()
+
+        self.client().get('/items?limit=10')
+        self.client().get('/items/100/summary')
+        self.client().post('/items', headers=self.manager_headers,
+                           json={'volume': True})
+
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_request_duration_seconds_count'
+                      '{endpoint="get_items",method="GET"}', text)
+        self.assertIn('http_responses_total'
+                      '{endpoint="get_item_summary",status="404"}', text)
+        self.assertIn('http_responses_total'
+                      '{endpoint="add_item",status="400"}', text)
+        self.assertIn('db_queries_per_request_count{endpoint="get_items"}',
+                      text)
+        self.assertIn('db_time_per_request_seconds_sum{endpoint="get_items"}',
+                      text)
+        self.assertIn('auth_verification_seconds_count', text)
+
+    def test_sql_profiling(self):
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.insert()
+
+        # off by default
+        res = self.client().get('/items/1/summary')
+        self.assertNotIn('Server-Timing', res.headers)
+
+        with mock.patch('profiling.SQL_PROFILING', True), \
+                mock.patch('profiling.SQL_SLOW_QUERY_MS', 0.0001), \
+                self.assertLogs(app.logger, 'WARNING') as logs:
+            res = self.client().get('/items/1/summary')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertEqual(res.headers['X-SQL-Queries'], '2')
+        self.assertIn('SELECT', res.headers['X-SQL-Slowest'])
+        self.assertGreaterEqual(float(res.headers['X-SQL-Time-Ms']),
+                                float(res.headers['X-SQL-Slowest-Ms']))
+        # every statement is over the threshold and logged with its plan
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('Scan', logs.output[0])
+
+    def test_pool_stats(self):
+        res = self.client().get('/pool')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        pool = data['pool']
+        self.assertEqual(pool['pid'], os.getpid())
+        self.assertEqual(pool['size'], app.config['DB_POOL_SIZE'])
+        self.assertEqual(pool['max_overflow'], app.config['DB_MAX_OVERFLOW'])
+        # checkouts of the tests themselves are counted too
+        self.assertGreater(pool['checkouts'], 0)
+        self.assertGreaterEqual(pool['wait_max_ms'], pool['wait_mean_ms'])
+
+        # every running worker, here only this process
+        workers = {worker['pid']: worker for worker in data['workers']}
+        self.assertEqual(list(workers), [os.getpid()])
+        self.assertEqual(workers[os.getpid()]['size'],
+                         app.config['DB_POOL_SIZE'])
+        self.assertGreater(workers[os.getpid()]['checkouts'], 0)
+
+        res = self.client().get('/metrics')
+        self.assertIn(b'db_pool_wait_seconds_count{outcome="ok",pid=',
+                      res.data)
+
     # CREATE ENTITIES
     def test_post_warehouse_success(self):
         warehouse_name = 'Test warehouse'
@@ -131,6 +250,169 @@ class WarehouseTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(res.status_code, 400)
 
+    # BULK IMPORT
+    def test_import_items_success(self):
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item 1'
+        new_item.volume = 1
+        new_item.insert()
+        warehouse_id, item_id = new_wh.id, new_item.id
+
+        BalanceJournal.apply_operation(warehouse_id, item_id, 5)
+
+        headers = dict(self.manager_headers, **{'Content-Type': 'text/csv'})
+        body = 'name,volume\n' \
+               'Test item 1,3\n' \
+               'Test item 2,\n' \
+               'Test item 3,-1\n' \
+               ',2\n' \
+               'Test item 4,2\n' \
+               'Test item 4,4\n'
+
+        res = self.client().post('/items/import', headers=headers,
+                                 data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['updated'], 1)
+        # the first row of Test item 4
+        self.assertEqual(data['skipped'], 1)
+        self.assertEqual(data['error_count'], 2)
+        self.assertEqual(data['errors'], [
+            {'line': 4, 'error': 'invalid volume'},
+            {'line': 5, 'error': 'name is required'}
+        ])
+
+        items = {item.name: item.volume for item in Item.query.all()}
+        # later rows with the same name win, missing volume is the default
+        self.assertEqual(items, {'Test item 1': 3, 'Test item 2': 0,
+                                 'Test item 4': 4})
+        # volume totals follow the new volume of the item
+        self.assertEqual(
+            WarehouseSummary.query.get(warehouse_id).total_volume, 15)
+
+        # the same rows again change nothing, not even the table version
+        version = TableVersion.get('items')
+        body = '{"name": "Test item 1", "volume": 3}\n' \
+               '{"name": "Test item 2"}\n' \
+               'not json\n'
+        res = self.client().post('/items/import?format=ndjson',
+                                 headers=headers, data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual(data['updated'], 0)
+        self.assertEqual(data['unchanged'], 2)
+        self.assertEqual(data['skipped'], 0)
+        self.assertEqual(TableVersion.get('items'), version)
+        self.assertEqual(data['errors'],
+                         [{'line': 3, 'error': 'malformed record'}])
+
+        BalanceJournal.query.get((warehouse_id, item_id)).delete()
+
+    def test_import_warehouses_success(self):
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse 1'
+        new_wh.capacity = 100
+        new_wh.insert()
+
+        headers = dict(self.manager_headers,
+                       **{'Content-Type': 'application/x-ndjson'})
+        body = '{"name": "Test warehouse 1", "overdraft_control": true}\n' \
+               '{"name": "Test warehouse 2", "capacity": 50}\n' \
+               '{"name": "Test warehouse 3", "capacity": "big"}\n'
+
+        res = self.client().post('/warehouses/import', headers=headers,
+                                 data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(data['errors'],
+                         [{'line': 3, 'error': 'invalid capacity'}])
+
+        warehouses = {wh.name: (wh.overdraft_control, wh.capacity)
+                      for wh in Warehouse.query.all()}
+        # missing values of existing warehouses are kept
+        self.assertEqual(warehouses, {'Test warehouse 1': (True, 100),
+                                      'Test warehouse 2': (False, 50)})
+
+    def test_import_failure(self):
+        headers = dict(self.manager_headers, **{'Content-Type': 'text/plain'})
+        res = self.client().post('/items/import', headers=headers,
+                                 data='name\nTest item\n')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+        headers = dict(self.user_headers, **{'Content-Type': 'text/csv'})
+        res = self.client().post('/items/import', headers=headers,
+                                 data='name\nTest item\n')
+
+        self.assertEqual(res.status_code, 403)
+
+        # rows before a part which isn't UTF-8 are imported
+        headers = dict(self.manager_headers, **{'Content-Type': 'text/csv'})
+        res = self.client().post('/items/import', headers=headers,
+                                 data=b'name\nTest item\n\xff\n')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['aborted'],
+                         {'after_line': 2, 'error': 'malformed file'})
+
+    def test_generate_dataset(self):
+        def dataset():
+            counts = generate_dataset(20, 200, 1000, seed=7, truncate=True)
+            balances = [(balance.warehouse_id, balance.item_id,
+                         balance.quantity)
+                        for balance in BalanceJournal.query.order_by(
+                            BalanceJournal.warehouse_id,
+                            BalanceJournal.item_id)]
+            summary = db.session.get(WarehouseSummary, 1)
+            return counts, balances, summary.total_quantity
+
+        try:
+            counts, balances, total_quantity = dataset()
+
+            self.assertEqual(counts['warehouses'], 20)
+            self.assertEqual(counts['items'], 200)
+            self.assertEqual(counts['balances'], len(balances))
+            self.assertAlmostEqual(len(balances), 1000, delta=50)
+            self.assertEqual(total_quantity,
+                             sum(quantity
+                                 for warehouse_id, _, quantity in balances
+                                 if warehouse_id == 1))
+            # the same seed gives the same dataset
+            self.assertEqual(dataset(), (counts, balances, total_quantity))
+
+            # a few items have most of the balances
+            per_item = sorted(
+                (sum(1 for _, item_id, _ in balances if item_id == item)
+                 for item in range(1, 201)), reverse=True)
+            self.assertGreater(sum(per_item[:20]), sum(per_item[100:]))
+
+            with self.assertRaises(ValueError):
+                generate_dataset(1, 1, 1)
+        finally:
+            # the generated rows would collide with ids of the other tests
+            db.session.rollback()
+            db.session.execute(TRUNCATE)
+            db.session.commit()
+
     # GET ENTITIES
     def test_get_warehouses_success(self):
         # create warehouse for operation
@@ -146,7 +428,8 @@ class WarehouseTestCase(unittest.TestCase):
                     {
                         "id": 1,
                         "name": "Test warehouse",
-                        "overdraft_control": True
+                        "overdraft_control": True,
+                        "capacity": None
                     }
                 ]
         }
@@ -167,6 +450,39 @@ class WarehouseTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 405)
         self.assertFalse(data['success'])
 
+    def test_get_warehouses_pagination(self):
+        # create warehouses to paginate
+        for wh_id in range(1, 6):
+            new_wh = Warehouse()
+            new_wh.id = wh_id
+            new_wh.name = f'Test warehouse {wh_id}'
+            new_wh.insert()
+
+        pages = []
+        url = '/warehouses?limit=2'
+        while url:
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data['success'])
+
+            pages.append([wh['id'] for wh in data['warehouses']])
+            url = None
+            if data['next_cursor']:
+                url = f'/warehouses?limit=2&cursor={data["next_cursor"]}'
+
+        self.assertEqual(pages, [[1, 2], [3, 4], [5]])
+
+    def test_get_warehouses_pagination_failure(self):
+        for url in ('/warehouses?limit=0', '/warehouses?limit=abc',
+                    '/warehouses?cursor=abc', '/warehouses?limit=100000'):
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(data['success'])
+
     def test_get_items_success(self):
         # create item for operation
         new_item = Item()
@@ -202,6 +518,114 @@ class WarehouseTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 405)
         self.assertFalse(data['success'])
 
+    def test_get_items_cached(self):
+        # create item for operation
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.insert()
+
+        first = self.client().get('/items')
+        # ends the session of the request, as the app context teardown does
+        db.session.remove()
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            second = self.client().get('/items')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        # cached body, only the version is read
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(len(statements), 1)
+
+        # patch through the API invalidates the cache
+        res = self.client().patch('/items/1', headers=self.manager_headers,
+                                  json={'name': 'Patched item'})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/items')
+        data = json.loads(res.data)
+        self.assertEqual(data['items'][0]['name'], 'Patched item')
+
+        # change committed by another worker, with its own connection
+        with engine.begin() as conn:
+            conn.execute(db.text(
+                "UPDATE items SET name = 'Renamed item' WHERE id = 1"))
+            conn.execute(db.text(
+                "UPDATE table_versions SET version = version + 1 "
+                "WHERE name = 'items'"))
+        db.session.remove()
+
+        res = self.client().get('/items')
+        data = json.loads(res.data)
+        self.assertEqual(data['items'][0]['name'], 'Renamed item')
+
+    def test_sync_items_success(self):
+        # tombstones of the items deleted by the other tests are older
+        start = TableVersion.get('items')
+
+        for item_id in range(1, 4):
+            new_item = Item()
+            new_item.id = item_id
+            new_item.name = f'Test item {item_id}'
+            new_item.insert()
+
+        res = self.client().get(f'/items?updated_since={start}')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([item['id'] for item in data['items']], [1, 2, 3])
+        self.assertEqual(data['deleted'], [])
+        version = data['version']
+
+        # only the changes after the version are returned
+        res = self.client().patch('/items/2', headers=self.manager_headers,
+                                  json={'name': 'Patched item'})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete('/items/3', headers=self.manager_headers)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(f'/items?updated_since={version}')
+        data = json.loads(res.data)
+
+        self.assertEqual([(item['id'], item['name'])
+                          for item in data['items']], [(2, 'Patched item')])
+        self.assertEqual(data['deleted'], [3])
+        self.assertGreater(data['version'], version)
+        version = data['version']
+
+        res = self.client().get(f'/items?updated_since={version}')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['items'], [])
+        self.assertEqual(data['deleted'], [])
+
+        # the tombstone goes away when the id is used again
+        new_item = Item()
+        new_item.id = 3
+        new_item.name = 'Test item 3'
+        new_item.insert()
+
+        res = self.client().get(f'/items?updated_since={start}')
+        data = json.loads(res.data)
+        self.assertEqual([item['id'] for item in data['items']], [1, 2, 3])
+        self.assertEqual(data['deleted'], [])
+
+    def test_sync_items_failure(self):
+        res = self.client().get('/items?updated_since=abc')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
     # PATCH ENTITIES
     def test_patch_warehouse_success(self):
         # create warehouse to patch
@@ -417,156 +841,1259 @@ class WarehouseTestCase(unittest.TestCase):
         Warehouse.query.get(1).delete()
         Item.query.get(1).delete()
 
-    # GET BALANCE
-    def test_get_balance_success(self):
+    def test_post_balance_operation_unknown_warehouse(self):
+        balance_operation_json = {
+            'warehouse_id': 1,
+            'item_id': 1,
+            'quantity': 10
+        }
 
-        # create warehouse for operation
+        res = self.client().post('/balances', headers=self.manager_headers,
+                                 json=balance_operation_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_post_balance_operation_idempotency_key(self):
         new_wh = Warehouse()
         new_wh.id = 1
         new_wh.name = 'Test warehouse'
         new_wh.overdraft_control = True
         new_wh.insert()
 
-        # create item for operation
         new_item = Item()
         new_item.id = 1
         new_item.name = 'Test item'
-        new_item.volume = 2
+        new_item.volume = 1
         new_item.insert()
 
-        # create balance
-        entry = BalanceJournal()
-        entry.warehouse_id = 1
-        entry.item_id = 1
-        entry.quantity = 43
-        entry.insert()
-
-        model_dict = {
-            "balances": [
-                {
-                    "item": {
-                        "id": 1,
-                        "name": "Test item",
-                        "volume": 2
-                    },
-                    "quantity": 43,
-                    "volume": 86,
-                    "warehouse": {
-                        "id": 1,
-                        "name": "Test warehouse",
-                        "overdraft_control": True
-                    }
-                }
-            ],
-            "success": True
+        balance_operation_json = {
+            'warehouse_id': 1,
+            'item_id': 1,
+            'quantity': 10
         }
+        headers = dict(self.manager_headers, **{'Idempotency-Key': 'scan-1'})
 
-        res = self.client().get('/balances', headers=self.manager_headers)
-        data = json.loads(res.data)
+        # rejected operations are not remembered
+        res = self.client().post('/balances', headers=headers,
+                                 json=dict(balance_operation_json,
+                                           quantity=-10))
+        self.assertEqual(res.status_code, 400)
 
+        # retries in parallel
+        responses = []
+        start = threading.Barrier(4)
+
+        def retry():
+            start.wait()
+            responses.append(self.client().post(
+                '/balances', headers=headers, json=balance_operation_json))
+            db.session.remove()
+
+        threads = [threading.Thread(target=retry) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([res.status_code for res in responses], [200] * 4)
+        self.assertEqual(
+            [json.loads(res.data)['new_balance'] for res in responses],
+            [10] * 4)
+        self.assertEqual(
+            sum(res.headers.get('Idempotent-Replayed') == 'true'
+                for res in responses), 3)
+
+        # the same key with another operation
+        res = self.client().post('/balances', headers=headers,
+                                 json=dict(balance_operation_json, quantity=5))
+        self.assertEqual(res.status_code, 422)
+
+        # asgi.py shares the keys
+        with TestClient(asgi.app) as client:
+            res = client.post('/balances', headers=headers,
+                              json=balance_operation_json)
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(data, model_dict)
+        self.assertEqual(res.json()['new_balance'], 10)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+
+        db.session.expire_all()
+        self.assertEqual(BalanceJournal.query.get((1, 1)).quantity, 10)
 
+        # expired keys are claimed again
+        self.assertEqual(prune_idempotency_keys(0), 1)
+        res = self.client().post('/balances', headers=headers,
+                                 json=balance_operation_json)
+        self.assertEqual(json.loads(res.data)['new_balance'], 20)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+        prune_idempotency_keys(0)
         BalanceJournal.query.get((1, 1)).delete()
         Warehouse.query.get(1).delete()
         Item.query.get(1).delete()
 
-    def test_get_balance_failure(self):
-
-        res = self.client().put('/balances')
-        data = json.loads(res.data)
-
-        self.assertEqual(res.status_code, 405)
-        self.assertFalse(data['success'])
-
-    # RBAC TESTS
-    def test_manager_post_warehouse_success(self):
-        warehouse_name = 'Test warehouse'
-
-        new_warehouse_json = {
-            'name': warehouse_name,
-            'overdraft_control': True
-        }
-
-        res = self.client().post('/warehouses', headers=self.manager_headers,
-                                 json=new_warehouse_json)
-        data = json.loads(res.data)
-
-        self.assertEqual(res.status_code, 200)
-        self.assertTrue(data['success'])
-
-        new_wh_dict = data['new_wh']
-        new_wh = Warehouse.query.get(new_wh_dict['id'])
-
-        self.assertTrue(new_wh is not None)
-        self.assertEqual(new_wh.name, warehouse_name)
-        self.assertEqual(new_wh.overdraft_control, True)
+    def run_concurrent_operations(self, quantity, threads_count, ops_count):
+        """Applies operation from several threads at once,
+        returns the list of new balances of accepted operations"""
+        results = []
+        start = threading.Barrier(threads_count)
+
+        def worker():
+            with self.app.app_context():
+                start.wait()
+                for _ in range(ops_count):
+                    new_balance = BalanceJournal.apply_operation(1, 1, quantity)
+                    if new_balance is not None:
+                        results.append(new_balance)
+                db.session.remove()
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_concurrent_balance_operations_no_lost_updates(self):
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = False
+        new_wh.insert()
 
-        new_wh.delete()
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 1
+        new_item.insert()
 
-    def test_manager_post_warehouse_failure(self):
-        warehouse_name = 'Test warehouse'
+        results = self.run_concurrent_operations(1, 8, 50)
 
-        new_warehouse_json = {
-            'name': warehouse_name,
-            'overdraft_control': True
-        }
+        # every operation saw a distinct balance and none was lost
+        self.assertEqual(len(results), 400)
+        self.assertEqual(sorted(results), list(range(1, 401)))
 
-        res = self.client().post('/warehouses', headers=self.user_headers,
-                                 json=new_warehouse_json)
-        data = json.loads(res.data)
+        db.session.expire_all()
+        entry = BalanceJournal.query.get((1, 1))
+        self.assertEqual(entry.quantity, 400)
+        self.assertEqual(WarehouseSummary.query.get(1).total_quantity, 400)
+        self.assertEqual(ItemSummary.query.get(1).total_quantity, 400)
 
-        self.assertEqual(res.status_code, 403)
-        self.assertFalse(data['success'])
+        entry.delete()
+        Warehouse.query.get(1).delete()
+        Item.query.get(1).delete()
 
-    def test_user_post_balance_success(self):
-        # create warehouse for operation
+    def test_concurrent_balance_operations_overdraft_control(self):
         new_wh = Warehouse()
         new_wh.id = 1
         new_wh.name = 'Test warehouse'
         new_wh.overdraft_control = True
         new_wh.insert()
 
-        # create item for operation
         new_item = Item()
         new_item.id = 1
         new_item.name = 'Test item'
         new_item.volume = 1
         new_item.insert()
 
-        # json of operation
-        balance_operation_json = {
-            'warehouse_id': 1,
-            'item_id': 1,
-            'quantity': 10
-        }
-
-        res = self.client().post('/balances', headers=self.user_headers,
-                                 json=balance_operation_json)
-        data = json.loads(res.data)
-
-        self.assertEqual(res.status_code, 200)
-        self.assertTrue(data['success'])
-        self.assertEqual(data['new_balance'], 10)
+        BalanceJournal.apply_operation(1, 1, 100)
 
-        res = self.client().post('/balances', headers=self.user_headers,
-                                 json=balance_operation_json)
-        data = json.loads(res.data)
+        results = self.run_concurrent_operations(-1, 8, 25)
 
-        self.assertEqual(res.status_code, 200)
-        self.assertTrue(data['success'])
-        self.assertEqual(data['new_balance'], 20)
+        # exactly the available 100 items were taken, never below 0
+        self.assertEqual(len(results), 100)
+        self.assertEqual(min(results), 0)
 
+        db.session.expire_all()
         entry = BalanceJournal.query.get((1, 1))
-
-        self.assertEqual(entry.quantity, 20)
+        self.assertEqual(entry.quantity, 0)
 
         entry.delete()
         Warehouse.query.get(1).delete()
         Item.query.get(1).delete()
 
-    def test_user_post_item_failure(self):
-        item_name = 'Test item'
+    def test_coalesced_balance_operations(self):
+        for wh_id, overdraft_control, capacity in ((1, False, None),
+                                                   (2, True, None),
+                                                   (3, False, 10)):
+            new_wh = Warehouse()
+            new_wh.id = wh_id
+            new_wh.name = f'Test warehouse {wh_id}'
+            new_wh.overdraft_control = overdraft_control
+            new_wh.capacity = capacity
+            new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 1
+        new_item.insert()
+
+        coalescer = BalanceCoalescer(window_ms=20)
+        coalescer.init_app(self.app)
+        results = []
+        start = threading.Barrier(8)
+
+        def worker():
+            start.wait()
+            for _ in range(25):
+                results.append(coalescer.submit(1, 1, 1))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # every operation saw a distinct balance and none was lost
+        self.assertEqual(sorted(results), list(range(1, 201)))
+        db.session.expire_all()
+        self.assertEqual(BalanceJournal.query.get((1, 1)).quantity, 200)
+        self.assertEqual(WarehouseSummary.query.get(1).total_quantity, 200)
+        self.assertEqual(StockMovement.query.filter_by(warehouse_id=1)
+                         .count(), 200)
+
+        # overdraft control: left to be applied one by one
+        self.assertTrue(coalescer.accepts(1))
+        self.assertFalse(coalescer.accepts(2))
+        self.assertFalse(coalescer.accepts(4))
+        self.assertEqual(BalanceJournal.apply_coalesced(
+            [(2, 1, 5), (2, 1, -10), (1, 1, -300)]), {2: -100})
+        db.session.commit()
+        # capacity: the total fits, decreases go first
+        self.assertEqual(BalanceJournal.apply_coalesced(
+            [(3, 1, 8), (3, 1, 5), (3, 1, -4)]), {0: 9, 1: 1, 2: -4})
+        db.session.commit()
+        # the total doesn't fit: nothing is applied
+        self.assertEqual(BalanceJournal.apply_coalesced(
+            [(3, 1, -1), (3, 1, 3), (3, 1, 7)]), {})
+        # ... and every request of the batch gets its own result
+        operations = [(3, 1, -1), (3, 1, 3), (2, 1, -10)]
+        outcomes = {}
+        start = threading.Barrier(len(operations))
+
+        def submit(operation):
+            start.wait()
+            outcomes[operation] = coalescer.submit(*operation)
+
+        threads = [threading.Thread(target=submit, args=(operation,))
+                   for operation in operations]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(outcomes, {(3, 1, -1): 8, (3, 1, 3): None,
+                                    (2, 1, -10): None})
+
+        # a warehouse over its capacity can only be emptied, even if the
+        # total goes down
+        warehouse = Warehouse.query.get(3)
+        warehouse.capacity = 5
+        warehouse.update()
+        self.assertEqual(BalanceJournal.apply_coalesced(
+            [(3, 1, -3), (3, 1, 2)]), {})
+        self.assertEqual(BalanceJournal.apply_coalesced(
+            [(3, 1, -1), (3, 1, -1)]), {0: 7, 1: 6})
+        db.session.commit()
+
+        db.session.expire_all()
+        for wh_id in (1, 2, 3):
+            BalanceJournal.query.get((wh_id, 1)).delete()
+            Warehouse.query.get(wh_id).delete()
+        Item.query.get(1).delete()
+
+    # POST BALANCE OPERATIONS BATCH
+    def test_post_balance_batch_success(self):
+        # create warehouses and item for operations
+        for wh_id, overdraft_control in ((1, True), (2, False)):
+            new_wh = Warehouse()
+            new_wh.id = wh_id
+            new_wh.name = f'Test warehouse {wh_id}'
+            new_wh.overdraft_control = overdraft_control
+            new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 1
+        new_item.insert()
+
+        batch_json = {
+            'operations': [
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': 10},
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': -4},
+                {'warehouse_id': 2, 'item_id': 1, 'quantity': -3}
+            ]
+        }
+
+        res = self.client().post('/balances/batch',
+                                 headers=self.user_headers, json=batch_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['results'], [{'success': True}] * 3)
+        self.assertEqual(data['balances'], [
+            {'warehouse_id': 1, 'item_id': 1, 'quantity': 6},
+            {'warehouse_id': 2, 'item_id': 1, 'quantity': -3}
+        ])
+
+        self.assertEqual(BalanceJournal.query.get((1, 1)).quantity, 6)
+        self.assertEqual(BalanceJournal.query.get((2, 1)).quantity, -3)
+
+        BalanceJournal.query.get((1, 1)).delete()
+        BalanceJournal.query.get((2, 1)).delete()
+        Warehouse.query.get(1).delete()
+        Warehouse.query.get(2).delete()
+        Item.query.get(1).delete()
+
+    def test_post_balance_batch_atomic_failure(self):
+        # create warehouse and item for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = True
+        new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 1
+        new_item.insert()
+
+        # the last operation takes more than the first ones leave
+        batch_json = {
+            'operations': [
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': 5},
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': -3},
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': -5}
+            ]
+        }
+
+        res = self.client().post('/balances/batch',
+                                 headers=self.user_headers, json=batch_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['results'], [
+            {'success': True},
+            {'success': True},
+            {'success': False, 'error': 'overdraft'}
+        ])
+
+        self.assertIsNone(BalanceJournal.query.get((1, 1)))
+
+        Warehouse.query.get(1).delete()
+        Item.query.get(1).delete()
+
+    def test_post_balance_batch_best_effort(self):
+        # create warehouse and item for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = True
+        new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 1
+        new_item.insert()
+
+        batch_json = {
+            'mode': 'best_effort',
+            'operations': [
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': 5},
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': -7},
+                {'warehouse_id': 1, 'item_id': 2, 'quantity': 1},
+                {'warehouse_id': 3, 'item_id': 1, 'quantity': 1},
+                {'warehouse_id': 1, 'item_id': 1},
+                {'warehouse_id': 1, 'item_id': 1, 'quantity': -2}
+            ]
+        }
+
+        res = self.client().post('/balances/batch',
+                                 headers=self.user_headers, json=batch_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['results'], [
+            {'success': True},
+            {'success': False, 'error': 'overdraft'},
+            {'success': False, 'error': 'item not found'},
+            {'success': False, 'error': 'warehouse not found'},
+            {'success': False, 'error': 'invalid operation'},
+            {'success': True}
+        ])
+        self.assertEqual(data['balances'], [
+            {'warehouse_id': 1, 'item_id': 1, 'quantity': 3}
+        ])
+
+        BalanceJournal.query.get((1, 1)).delete()
+        Warehouse.query.get(1).delete()
+        Item.query.get(1).delete()
+
+    def test_post_balance_batch_failure(self):
+        res = self.client().post('/balances/batch',
+                                 headers=self.user_headers,
+                                 json={'operations': [], 'mode': 'unknown'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # CONDITIONAL REQUESTS
+    def count_statements(self, url, headers=None):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        # a new session, as for every request of the app
+        db.session.remove()
+        engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().get(url, headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        return res, len(statements)
+
+    def test_get_balances_not_modified(self):
+        # create warehouse and item for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.insert()
+
+        BalanceJournal.apply_operation(1, 1, 10)
+
+        res = self.client().get('/balances')
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+
+        # not modified: only the version is read, nothing is serialized
+        res, statements = self.count_statements(
+            '/balances', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(statements, 1)
+
+        # every change of balances, warehouses or items changes the tag
+        etags = {etag}
+
+        BalanceJournal.apply_operation(1, 1, 5)
+        res = self.client().get('/balances', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['balances'][0]['quantity'], 15)
+        etags.add(res.headers['ETag'])
+
+        res = self.client().patch('/items/1', headers=self.manager_headers,
+                                  json={'volume': 2})
+        self.assertEqual(res.status_code, 200)
+        etags.add(self.client().get('/balances').headers['ETag'])
+
+        rebuild_summaries()
+        etags.add(self.client().get('/balances').headers['ETag'])
+
+        self.assertEqual(len(etags), 4)
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_get_warehouses_not_modified(self):
+        # create warehouse for operation
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.insert()
+
+        res = self.client().get('/warehouses')
+        etag = res.headers['ETag']
+
+        res, statements = self.count_statements(
+            '/warehouses', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(statements, 1)
+
+        res = self.client().patch('/warehouses/1',
+                                  headers=self.manager_headers,
+                                  json={'capacity': 10})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/warehouses',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(json.loads(res.data)['warehouses'][0]['capacity'],
+                         10)
+
+    # GET BALANCE
+    def test_get_balance_success(self):
+
+        # create warehouse for operation
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = True
+        new_wh.insert()
+
+        # create item for operation
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 2
+        new_item.insert()
+
+        # create balance
+        entry = BalanceJournal()
+        entry.warehouse_id = 1
+        entry.item_id = 1
+        entry.quantity = 43
+        entry.insert()
+
+        model_dict = {
+            "balances": [
+                {
+                    "item": {
+                        "id": 1,
+                        "name": "Test item",
+                        "volume": 2
+                    },
+                    "quantity": 43,
+                    "volume": 86,
+                    "warehouse": {
+                        "id": 1,
+                        "name": "Test warehouse",
+                        "overdraft_control": True,
+                        "capacity": None
+                    }
+                }
+            ],
+            "success": True
+        }
+
+        res = self.client().get('/balances', headers=self.manager_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data, model_dict)
+
+        BalanceJournal.query.get((1, 1)).delete()
+        Warehouse.query.get(1).delete()
+        Item.query.get(1).delete()
+
+    def test_get_balance_pagination(self):
+        # create warehouses and items for balances
+        for index in range(1, 3):
+            new_wh = Warehouse()
+            new_wh.id = index
+            new_wh.name = f'Test warehouse {index}'
+            new_wh.insert()
+
+            new_item = Item()
+            new_item.id = index
+            new_item.name = f'Test item {index}'
+            new_item.insert()
+
+        for wh_id in range(1, 3):
+            for item_id in range(1, 3):
+                BalanceJournal.apply_operation(wh_id, item_id, 1)
+
+        res = self.client().get('/balances?limit=3')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(entry['warehouse']['id'], entry['item']['id'])
+                          for entry in data['balances']],
+                         [(1, 1), (1, 2), (2, 1)])
+
+        res = self.client().get(
+            f'/balances?limit=3&cursor={data["next_cursor"]}')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(entry['warehouse']['id'], entry['item']['id'])
+                          for entry in data['balances']], [(2, 2)])
+        self.assertIsNone(data['next_cursor'])
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_get_balance_filters(self):
+        # create warehouses and items for balances
+        for index in range(1, 3):
+            new_wh = Warehouse()
+            new_wh.id = index
+            new_wh.name = f'Test warehouse {index}'
+            new_wh.insert()
+
+            new_item = Item()
+            new_item.id = index
+            new_item.name = f'Test item {index}'
+            new_item.insert()
+
+        for wh_id in range(1, 3):
+            for item_id in range(1, 3):
+                BalanceJournal.apply_operation(wh_id, item_id,
+                                               10 * wh_id + item_id)
+
+        def get_keys(url):
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            return [(entry['warehouse']['id'], entry['item']['id'])
+                    for entry in data['balances']]
+
+        self.assertEqual(get_keys('/balances?warehouse_id=2'),
+                         [(2, 1), (2, 2)])
+        self.assertEqual(sorted(get_keys('/balances?item_id=2')),
+                         [(1, 2), (2, 2)])
+        self.assertEqual(get_keys('/balances?item_id=2&min_quantity=20'),
+                         [(2, 2)])
+        self.assertEqual(get_keys('/balances?warehouse_id=1&item_id=1'),
+                         [(1, 1)])
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_get_balance_filters_failure(self):
+        res = self.client().get('/balances?warehouse_id=abc')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # SUMMARIES
+    def test_summaries_success(self):
+        # create warehouses and items for operations
+        for index in range(1, 3):
+            new_wh = Warehouse()
+            new_wh.id = index
+            new_wh.name = f'Test warehouse {index}'
+            new_wh.overdraft_control = True
+            new_wh.insert()
+
+            new_item = Item()
+            new_item.id = index
+            new_item.name = f'Test item {index}'
+            new_item.volume = index
+            new_item.insert()
+
+        BalanceJournal.apply_operation(1, 1, 10)
+        BalanceJournal.apply_operation(1, 2, 5)
+        BalanceJournal.apply_operation(2, 2, 3)
+        # rejected by overdraft control
+        BalanceJournal.apply_operation(2, 1, -1)
+        BalanceJournal.apply_batch([(1, 1, -4), (2, 1, 2)])
+
+        res = self.client().get('/warehouses/1/summary')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['summary'], {
+            'warehouse_id': 1,
+            'total_quantity': 11,
+            'total_volume': 16
+        })
+
+        res = self.client().get('/items/2/summary')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['summary'], {
+            'item_id': 2,
+            'total_quantity': 8,
+            'total_volume': 16
+        })
+
+        # volume change moves volume totals of the warehouses
+        res = self.client().patch('/items/2', headers=self.manager_headers,
+                                  json={'volume': 4})
+        self.assertEqual(res.status_code, 200)
+
+        db.session.expire_all()
+        self.assertEqual(WarehouseSummary.query.get(1).total_volume, 26)
+        self.assertEqual(WarehouseSummary.query.get(2).total_volume, 14)
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    # STOCK MOVEMENTS AND SNAPSHOTS
+    def test_stock_movements_success(self):
+        # create warehouse and item for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = True
+        new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.insert()
+
+        BalanceJournal.apply_operation(1, 1, 10)
+        # rejected by overdraft control
+        BalanceJournal.apply_operation(1, 1, -20)
+        BalanceJournal.apply_batch([(1, 1, -3), (1, 1, 5), (1, 1, -50)],
+                                   atomic=False)
+
+        movements = StockMovement.query.order_by(StockMovement.id).all()
+
+        self.assertEqual([movement.quantity for movement in movements],
+                         [10, -3, 5])
+        self.assertEqual(sorted(movements, key=lambda m: m.created_at),
+                         movements)
+        self.assertEqual(sum(movement.quantity for movement in movements),
+                         BalanceJournal.query.get((1, 1)).quantity)
+
+        BalanceJournal.query.get((1, 1)).delete()
+
+    def test_balance_snapshots(self):
+        # create warehouse and items for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.insert()
+
+        for item_id in range(1, 3):
+            new_item = Item()
+            new_item.id = item_id
+            new_item.name = f'Test item {item_id}'
+            new_item.insert()
+
+            BalanceJournal.apply_operation(1, item_id, 10)
+
+        first = take_balance_snapshot(2)
+
+        BalanceJournal.apply_operation(1, 2, 5)
+
+        second = take_balance_snapshot(2)
+        third = take_balance_snapshot(2)
+
+        def snapshot_entries(snapshot):
+            return sorted((entry.item_id, entry.quantity)
+                          for entry in BalanceSnapshotEntry.query
+                          .filter_by(snapshot_id=snapshot.id))
+
+        # the first snapshot has all the balances, the next only changed,
+        # every second one is a checkpoint of all the balances again
+        self.assertEqual(snapshot_entries(first), [(1, 10), (2, 10)])
+        self.assertEqual(snapshot_entries(second), [(2, 15)])
+        self.assertEqual(snapshot_entries(third), [(1, 10), (2, 15)])
+        self.assertEqual([first.checkpoint, second.checkpoint,
+                          third.checkpoint], [True, False, True])
+        self.assertGreater(second.taken_at, first.taken_at)
+
+        # balances as of a moment after a checkpoint are read from it
+        BalanceJournal.apply_operation(1, 1, -4)
+        res = self.client().get('/balances', headers=self.user_headers,
+                                query_string={'as_of': datetime.now(
+                                    timezone.utc).isoformat()})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted((balance['item']['id'], balance['quantity'])
+                                for balance in json.loads(res.data)['balances']),
+                         [(1, 6), (2, 15)])
+
+        for snapshot in BalanceSnapshot.query.all():
+            db.session.delete(snapshot)
+        db.session.commit()
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_balances_as_of_success(self):
+        # create warehouse and items for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.insert()
+
+        for item_id in range(1, 3):
+            new_item = Item()
+            new_item.id = item_id
+            new_item.name = f'Test item {item_id}'
+            new_item.insert()
+
+        BalanceJournal.apply_operation(1, 1, 10)
+        snapshot = take_balance_snapshot(144)
+        BalanceJournal.apply_operation(1, 1, 5)
+        BalanceJournal.apply_operation(1, 1, -3)
+        BalanceJournal.apply_operation(1, 2, 7)
+
+        moments = [movement.created_at for movement in StockMovement.query
+                   .order_by(StockMovement.id)][1:]
+
+        def balances_as_of(moment):
+            res = self.client().get('/balances', headers=self.user_headers,
+                                    query_string={'as_of': moment.isoformat()})
+            self.assertEqual(res.status_code, 200)
+            return sorted((balance['item']['id'], balance['quantity'])
+                          for balance in json.loads(res.data)['balances'])
+
+        self.assertEqual(balances_as_of(snapshot.taken_at), [(1, 10)])
+        self.assertEqual(balances_as_of(moments[0]), [(1, 15)])
+        self.assertEqual(balances_as_of(moments[1]), [(1, 12)])
+        self.assertEqual(balances_as_of(moments[2]), [(1, 12), (2, 7)])
+
+        # an entry deleted later is still there in the past
+        BalanceJournal.query.get((1, 1)).delete()
+        self.assertEqual(balances_as_of(moments[2]), [(1, 12), (2, 7)])
+
+        # filters apply to balances as of the moment
+        res = self.client().get('/balances', headers=self.user_headers,
+                                query_string={'as_of': moments[0].isoformat(),
+                                              'min_quantity': 11})
+        self.assertEqual(len(json.loads(res.data)['balances']), 1)
+
+        for snapshot in BalanceSnapshot.query.all():
+            db.session.delete(snapshot)
+        db.session.commit()
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_balances_as_of_failure(self):
+        res = self.client().get('/balances?as_of=yesterday',
+                                headers=self.user_headers)
+        self.assertEqual(res.status_code, 400)
+
+        # there is no snapshot before the moment
+        res = self.client().get('/balances?as_of=2000-01-01T00:00:00Z',
+                                headers=self.user_headers)
+        self.assertEqual(res.status_code, 422)
+
+    # CAPACITY
+    def test_capacity_success(self):
+        # create warehouse with capacity and items for operations
+        res = self.client().post('/warehouses', headers=self.manager_headers,
+                                 json={'name': 'Test warehouse',
+                                       'capacity': 10})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['new_wh']['capacity'], 10)
+        wh_id = data['new_wh']['id']
+
+        for item_id in range(1, 3):
+            new_item = Item()
+            new_item.id = item_id
+            new_item.name = f'Test item {item_id}'
+            new_item.volume = item_id
+            new_item.insert()
+
+        def post_operation(item_id, quantity):
+            return self.client().post('/balances', headers=self.user_headers,
+                                      json={'warehouse_id': wh_id,
+                                            'item_id': item_id,
+                                            'quantity': quantity})
+
+        self.assertEqual(post_operation(2, 4).status_code, 200)
+        # 8 + 3 > 10
+        self.assertEqual(post_operation(1, 3).status_code, 400)
+        self.assertEqual(post_operation(1, 2).status_code, 200)
+        self.assertEqual(post_operation(1, 1).status_code, 400)
+
+        db.session.expire_all()
+        self.assertEqual(WarehouseSummary.query.get(wh_id).total_volume, 10)
+        self.assertEqual(BalanceJournal.query.get((wh_id, 1)).quantity, 2)
+
+        # volume change can overfill the warehouse, but it can be emptied
+        res = self.client().patch('/items/2', headers=self.manager_headers,
+                                  json={'volume': 3})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(post_operation(2, -1).status_code, 200)
+
+        db.session.expire_all()
+        self.assertEqual(WarehouseSummary.query.get(wh_id).total_volume, 11)
+
+        # batch checks capacity in order
+        errors, _ = BalanceJournal.apply_batch(
+            [(wh_id, 2, -1), (wh_id, 1, 2), (wh_id, 1, 1)], atomic=False)
+        self.assertEqual(errors, [None, None, 'over capacity'])
+
+        db.session.expire_all()
+        self.assertEqual(WarehouseSummary.query.get(wh_id).total_volume, 10)
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_capacity_failure(self):
+        res = self.client().post('/warehouses', headers=self.manager_headers,
+                                 json={'name': 'Test warehouse',
+                                       'capacity': -1})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_rebuild_summaries(self):
+        # create warehouse and item for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 2
+        new_item.insert()
+
+        BalanceJournal.apply_operation(1, 1, 10)
+
+        # make summaries drift
+        WarehouseSummary.query.get(1).total_volume = 0
+        ItemSummary.query.get(1).total_quantity = 0
+        db.session.commit()
+
+        rebuild_summaries()
+
+        self.assertEqual(WarehouseSummary.query.get(1).format(), {
+            'warehouse_id': 1,
+            'total_quantity': 10,
+            'total_volume': 20
+        })
+        self.assertEqual(ItemSummary.query.get(1).total_quantity, 10)
+
+        BalanceJournal.query.get((1, 1)).delete()
+
+    def test_summaries_failure(self):
+        for url in ('/warehouses/1/summary', '/items/1/summary'):
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 404)
+            self.assertFalse(data['success'])
+
+    # EXPORT BALANCES
+    def test_export_balances_success(self):
+        # create warehouse and items for balances
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = True
+        new_wh.insert()
+
+        for item_id in range(1, 3):
+            new_item = Item()
+            new_item.id = item_id
+            new_item.name = f'Test item {item_id}'
+            new_item.volume = 2
+            new_item.insert()
+
+            BalanceJournal.apply_operation(1, item_id, 10 * item_id)
+
+        res = self.client().get('/balances/export?format=ndjson')
+        lines = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(lines, json.loads(
+            self.client().get('/balances').data)['balances'])
+
+        res = self.client().get('/balances/export?format=csv')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(res.data.decode().splitlines(), [
+            'warehouse_id,warehouse_name,overdraft_control,'
+            'item_id,item_name,item_volume,quantity,volume',
+            '1,Test warehouse,True,1,Test item 1,2,10,20',
+            '1,Test warehouse,True,2,Test item 2,2,20,40'
+        ])
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    # CHANGE FEED
+    def test_balance_changes_success(self):
+        # create warehouse and items for operations
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.insert()
+
+        for item_id in range(1, 3):
+            new_item = Item()
+            new_item.id = item_id
+            new_item.name = f'Test item {item_id}'
+            new_item.insert()
+
+        BalanceJournal.apply_operation(1, 1, 10)
+
+        # the starting cursor
+        res = self.client().get('/balances/changes')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['changes'], [])
+        cursor = data['cursor']
+
+        BalanceJournal.apply_operation(1, 2, 5)
+        BalanceJournal.apply_operation(1, 2, 2)
+
+        res = self.client().get(f'/balances/changes?since={cursor}')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(change['item']['id'], change['quantity'])
+                          for change in data['changes']], [(2, 7)])
+        cursor = data['cursor']
+
+        res = self.client().get(f'/balances/changes?since={cursor}')
+        data = json.loads(res.data)
+        self.assertEqual(data['changes'], [])
+        cursor = data['cursor']
+
+        # long poll is woken up by an operation of another process
+        def operation():
+            with self.app.app_context():
+                time.sleep(0.2)
+                BalanceJournal.apply_operation(1, 1, 1)
+                db.session.remove()
+
+        thread = threading.Thread(target=operation)
+        started = time.monotonic()
+        thread.start()
+        res = self.client().get(f'/balances/changes?since={cursor}&wait=10')
+        elapsed = time.monotonic() - started
+        thread.join()
+
+        data = json.loads(res.data)
+        self.assertEqual([(change['item']['id'], change['quantity'])
+                          for change in data['changes']], [(1, 11)])
+        self.assertLess(elapsed, 5)
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_asgi_balances(self):
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = True
+        new_wh.insert()
+
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.insert()
+
+        # startup creates the async engine from the app config
+        with TestClient(asgi.app) as client:
+            res = client.post('/balances', headers=self.manager_headers,
+                              json={'warehouse_id': 1, 'item_id': 1,
+                                    'quantity': 5})
+            data = res.json()
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['new_balance'], 5)
+
+            # overdraft control
+            res = client.post('/balances', headers=self.manager_headers,
+                              json={'warehouse_id': 1, 'item_id': 1,
+                                    'quantity': -6})
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(res.json()['success'])
+
+            res = client.post('/balances', json={'warehouse_id': 1,
+                                                 'item_id': 1,
+                                                 'quantity': 1})
+            self.assertEqual(res.status_code, 401)
+
+            res = client.get('/balances?warehouse_id=1&limit=1')
+            data = res.json()
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([(balance['item']['id'], balance['quantity'])
+                              for balance in data['balances']], [(1, 5)])
+            self.assertIsNone(data['next_cursor'])
+
+            res = client.get('/balances',
+                             headers={'If-None-Match': res.headers['ETag']})
+            self.assertEqual(res.status_code, 304)
+
+            # routes which are not native are served by the Flask app
+            res = client.get('/items')
+            data = res.json()
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([item['id'] for item in data['items']], [1])
+
+        entry = BalanceJournal.query.get((1, 1))
+        self.assertEqual(entry.quantity, 5)
+
+        entry.delete()
+        Warehouse.query.get(1).delete()
+        Item.query.get(1).delete()
+
+    def test_balance_changes_failure(self):
+        for url in ('/balances/changes?since=abc',
+                    '/balances/changes?wait=abc',
+                    '/balances/changes?wait=100000'):
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertFalse(data['success'])
+
+    def test_export_balances_failure(self):
+        res = self.client().get('/balances/export?format=xml')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def count_get_balances_queries(self):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().get('/balances')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        self.assertEqual(res.status_code, 200)
+        return len(statements), len(json.loads(res.data)['balances'])
+
+    def test_get_balance_constant_query_count(self):
+        # create warehouses and items for balances
+        for index in range(1, 5):
+            new_wh = Warehouse()
+            new_wh.id = index
+            new_wh.name = f'Test warehouse {index}'
+            new_wh.insert()
+
+            new_item = Item()
+            new_item.id = index
+            new_item.name = f'Test item {index}'
+            new_item.volume = index
+            new_item.insert()
+
+        BalanceJournal.apply_operation(1, 1, 1)
+        queries_count, balances_count = self.count_get_balances_queries()
+        self.assertEqual(balances_count, 1)
+
+        for wh_id in range(1, 5):
+            for item_id in range(1, 5):
+                BalanceJournal.apply_operation(wh_id, item_id, 1)
+        db.session.expire_all()
+
+        self.assertEqual(self.count_get_balances_queries(),
+                         (queries_count, 16))
+
+        for entry in BalanceJournal.query.all():
+            entry.delete()
+
+    def test_get_balance_failure(self):
+
+        res = self.client().put('/balances')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 405)
+        self.assertFalse(data['success'])
+
+    # RBAC TESTS
+    def test_manager_post_warehouse_success(self):
+        warehouse_name = 'Test warehouse'
+
+        new_warehouse_json = {
+            'name': warehouse_name,
+            'overdraft_control': True
+        }
+
+        res = self.client().post('/warehouses', headers=self.manager_headers,
+                                 json=new_warehouse_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+
+        new_wh_dict = data['new_wh']
+        new_wh = Warehouse.query.get(new_wh_dict['id'])
+
+        self.assertTrue(new_wh is not None)
+        self.assertEqual(new_wh.name, warehouse_name)
+        self.assertEqual(new_wh.overdraft_control, True)
+
+        new_wh.delete()
+
+    def test_manager_post_warehouse_failure(self):
+        warehouse_name = 'Test warehouse'
+
+        new_warehouse_json = {
+            'name': warehouse_name,
+            'overdraft_control': True
+        }
+
+        res = self.client().post('/warehouses', headers=self.user_headers,
+                                 json=new_warehouse_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(data['success'])
+
+    def test_user_post_balance_success(self):
+        # create warehouse for operation
+        new_wh = Warehouse()
+        new_wh.id = 1
+        new_wh.name = 'Test warehouse'
+        new_wh.overdraft_control = True
+        new_wh.insert()
+
+        # create item for operation
+        new_item = Item()
+        new_item.id = 1
+        new_item.name = 'Test item'
+        new_item.volume = 1
+        new_item.insert()
+
+        # json of operation
+        balance_operation_json = {
+            'warehouse_id': 1,
+            'item_id': 1,
+            'quantity': 10
+        }
+
+        res = self.client().post('/balances', headers=self.user_headers,
+                                 json=balance_operation_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['new_balance'], 10)
+
+        res = self.client().post('/balances', headers=self.user_headers,
+                                 json=balance_operation_json)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['new_balance'], 20)
+
+        entry = BalanceJournal.query.get((1, 1))
+
+        self.assertEqual(entry.quantity, 20)
+
+        entry.delete()
+        Warehouse.query.get(1).delete()
+        Item.query.get(1).delete()
+
+    def test_user_post_item_failure(self):
+        item_name = 'Test item'
 
         new_item_json = {
             'name': item_name,
@@ -581,5 +2108,139 @@ class WarehouseTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
 
 
+class AuthTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_jwk = make_signing_key('test-key')
+
+    def test_seeded_key_store_verifies_token_offline(self):
+        with mock.patch('auth.urlopen') as urlopen, \
+                mock.patch.object(jwks_store, 'url', None):
+            jwks_store.load({'keys': [self.public_jwk]})
+
+            token = make_token(self.private_pem, 'test-key', ['get:items'])
+            payload = verify_decode_jwt(token)
+
+            self.assertEqual(payload['permissions'], ['get:items'])
+            urlopen.assert_not_called()
+
+    def test_key_store_loads_file(self):
+        path = os.path.join(os.path.dirname(__file__), 'test_jwks.json')
+        with open(path, 'w') as jwks_file:
+            json.dump({'keys': [self.public_jwk]}, jwks_file)
+
+        try:
+            store = JWKSKeyStore(path=path)
+        finally:
+            os.remove(path)
+
+        self.assertIsNotNone(store.get_key('test-key'))
+        self.assertIsNone(store.get_key('unknown-key'))
+
+    def test_key_store_fetches_once(self):
+        response = mock.Mock()
+        response.read.return_value = json.dumps({'keys': [self.public_jwk]})
+
+        with mock.patch('auth.urlopen', return_value=response) as urlopen:
+            store = JWKSKeyStore(url='https://example.com/jwks.json')
+            for _ in range(10):
+                self.assertIsNotNone(store.get_key('test-key'))
+
+        self.assertEqual(urlopen.call_count, 1)
+
+    def test_key_store_unknown_kid_refresh_is_rate_limited(self):
+        response = mock.Mock()
+        response.read.return_value = json.dumps({'keys': [self.public_jwk]})
+
+        with mock.patch('auth.urlopen', return_value=response) as urlopen:
+            store = JWKSKeyStore(url='https://example.com/jwks.json',
+                                 min_refresh_interval=60)
+            for _ in range(10):
+                self.assertIsNone(store.get_key('unknown-key'))
+
+        self.assertEqual(urlopen.call_count, 1)
+
+    def test_key_store_refreshes_after_ttl(self):
+        response = mock.Mock()
+        response.read.return_value = json.dumps({'keys': [self.public_jwk]})
+
+        with mock.patch('auth.urlopen', return_value=response) as urlopen:
+            store = JWKSKeyStore(url='https://example.com/jwks.json', ttl=0,
+                                 min_refresh_interval=0)
+            store.get_key('test-key')
+            store.get_key('test-key')
+
+        self.assertEqual(urlopen.call_count, 2)
+
+    def test_unknown_kid_failure(self):
+        with mock.patch.object(jwks_store, 'url', None):
+            jwks_store.load({'keys': [self.public_jwk]})
+
+            token = make_token(self.private_pem, 'other-key', ['get:items'])
+
+            with self.assertRaises(AuthError) as context:
+                verify_decode_jwt(token)
+
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_token_cache_skips_verification(self):
+        payload = {'exp': time.time() + 60, 'permissions': ['get:items']}
+
+        @requires_auth('get:items')
+        def protected(jwt):
+            return jwt
+
+        headers = {'Authorization': 'Bearer cached-token'}
+        with mock.patch('auth.token_cache', VerifiedTokenCache(10)) as cache, \
+                mock.patch('auth.verify_decode_jwt',
+                           return_value=payload) as verify:
+            for _ in range(3):
+                with app.test_request_context(headers=headers):
+                    self.assertEqual(protected(), payload)
+
+            self.assertEqual(verify.call_count, 1)
+            self.assertEqual(cache.stats()['hits'], 2)
+            self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_token_cache_checks_permissions_on_hit(self):
+        payload = {'exp': time.time() + 60, 'permissions': ['get:items']}
+
+        @requires_auth('edit:items')
+        def protected(jwt):
+            return jwt
+
+        headers = {'Authorization': 'Bearer cached-token'}
+        with mock.patch('auth.token_cache', VerifiedTokenCache(10)) as cache:
+            cache.put('cached-token', payload)
+            with app.test_request_context(headers=headers):
+                with self.assertRaises(AuthError) as context:
+                    protected()
+
+        self.assertEqual(context.exception.status_code, 403)
+
+    def test_token_cache_expiration(self):
+        cache = VerifiedTokenCache(10)
+        cache.put('expired-token', {'exp': time.time() - 1})
+        cache.put('no-exp-token', {'permissions': []})
+
+        self.assertIsNone(cache.get('expired-token'))
+        self.assertIsNone(cache.get('no-exp-token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_token_cache_eviction(self):
+        cache = VerifiedTokenCache(2)
+        exp = time.time() + 60
+        cache.put('token-1', {'exp': exp})
+        cache.put('token-2', {'exp': exp})
+        cache.get('token-1')
+        cache.put('token-3', {'exp': exp})
+
+        self.assertIsNotNone(cache.get('token-1'))
+        self.assertIsNone(cache.get('token-2'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,414 @@
+# gunicorn -w 4 -k uvicorn.workers.UvicornWorker asgi:app
+"""Async deployment of the app.
+
+Serves the same routes as app.py from an event loop: the routes where
+requests spend most of their time waiting (balance operations, balances
+and the long poll of the change feed) run natively on the async engine,
+all the other routes are served by the Flask app in a thread pool.
+Concurrency of the native routes is bounded by the connection pool, not
+by the number of workers or threads.
+"""
+import asyncio
+from functools import wraps
+import json
+import sys
+import time
+
+import asyncpg
+from sqlalchemy import tuple_
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_etags
+
+from app import app as flask_app, apply_balance_filters, \
+    decode_cursor, encode_cursor, operation_hash, parse_balance_filters, \
+    parse_idempotency_key
+from auth import AuthError, check_permissions, parse_auth_header, \
+    token_cache, verify_decode_jwt_async
+from cache import response_cache
+from coalescing import balance_coalescer
+from metrics import observe_auth, observe_request
+from models import BalanceJournal, BALANCE_OPERATIONS, BALANCES_VERSION, \
+    BALANCE_CHANGES_CURSOR, BALANCE_CHANGES_CHANNEL, BALANCE_CHANGES_NOTIFY, \
+    IDEMPOTENCY_KEY_CLAIM, IDEMPOTENCY_KEY_GET, IDEMPOTENCY_KEY_REMEMBER
+
+config = flask_app.config
+
+# routes which are not native, and native routes in the cases they don't
+# cover, are served by the Flask app
+flask_asgi = WSGIMiddleware(flask_app)
+
+
+def serve_with_flask(request):
+    """Returns the Flask app to serve the request of a native route,
+    the Flask app records its metrics itself"""
+    request.scope['served_by_flask'] = True
+    return flask_asgi
+
+# CHANGE NOTIFICATIONS
+'''
+one connection per process LISTENs to notifications of balance
+operations, all the waiting long polls share it instead of holding a
+connection each
+every notification sets the current event and replaces it with a new
+one, a request takes the event before reading the changes, so a
+notification that comes between the read and the wait isn't missed
+'''
+
+
+class BalanceChangesNotifier:
+    def __init__(self):
+        self.event = None
+        self._connection = None
+
+    async def start(self, database_url):
+        # created inside the event loop of the server
+        self.event = asyncio.Event()
+        try:
+            self._connection = await asyncpg.connect(
+                str(database_url.set(drivername='postgresql')))
+            await self._connection.add_listener(BALANCE_CHANGES_CHANNEL,
+                                                self._notify)
+        except (OSError, asyncpg.PostgresError):
+            # long polls still see the changes every CHANGES_POLL_INTERVAL
+            print(sys.exc_info())
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.close()
+
+    def _notify(self, *args):
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+    @staticmethod
+    async def wait(event, timeout):
+        """Waits for the event at most timeout seconds,
+        returns True if notified"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+notifier = BalanceChangesNotifier()
+
+
+async def startup():
+    # the database is read from the config on start, not on import,
+    # so the config can still be changed (e.g. by tests)
+    database_url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    app.state.engine = create_async_engine(
+        database_url.set(drivername='postgresql+asyncpg'),
+        pool_size=config['ASGI_DB_POOL_SIZE'],
+        max_overflow=config['ASGI_DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+        pool_recycle=config['DB_POOL_RECYCLE'],
+        pool_pre_ping=config['DB_POOL_PRE_PING'],
+        connect_args={'server_settings': {
+            'statement_timeout': str(config['DB_STATEMENT_TIMEOUT'])}})
+    await notifier.start(database_url)
+
+
+async def shutdown():
+    await notifier.stop()
+    await app.state.engine.dispose()
+
+# METRICS
+
+
+async def record_request_metrics(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # routing sets the endpoint of the native routes, requests served by
+    # the Flask app (the mount or a native route handing the request
+    # over) are recorded by the Flask app itself
+    endpoint = request.scope.get('endpoint')
+    if endpoint is not None and endpoint is not flask_asgi and \
+            not request.scope.get('served_by_flask'):
+        observe_request(endpoint.__name__, request.method,
+                        response.status_code, time.perf_counter() - start)
+    return response
+
+# RESPONSES
+
+
+ERROR_MESSAGES = {
+    400: 'Bad request',
+    401: 'Unauthorized request',
+    403: 'Forbidden request',
+    404: 'Resource not found',
+    405: 'Method not allowed',
+    422: 'Request is unprocessable'
+}
+
+
+def error(status_code):
+    return JSONResponse({
+        'success': False,
+        'error': status_code,
+        'message': ERROR_MESSAGES.get(status_code, 'Error')
+    }, status_code=status_code)
+
+
+async def http_error(request, ex):
+    return error(ex.status_code)
+
+
+async def auth_error(request, ex):
+    return JSONResponse({
+        'success': False,
+        'error': ex.status_code,
+        'message': ex.error['description']
+    }, status_code=ex.status_code)
+
+
+def requires_auth_async(permission=''):
+    """Same as requires_auth for the native routes"""
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            token = parse_auth_header(request.headers.get('Authorization'))
+            start = time.perf_counter()
+            payload = token_cache.get(token)
+            cache_hit = payload is not None
+            if not cache_hit:
+                payload = await verify_decode_jwt_async(token)
+                token_cache.put(token, payload)
+            observe_auth(cache_hit, time.perf_counter() - start)
+            check_permissions(permission, payload)
+            return await f(payload, request)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+def parse_page(params):
+    """Returns limit and the key of the cursor from query params,
+    (None, None) if the list is not paginated"""
+    limit = params.get('limit')
+    cursor = params.get('cursor')
+    if limit is None and cursor is None:
+        return None, None
+
+    limit = int(limit or config['PAGE_DEFAULT_LIMIT'])
+    key = decode_cursor(cursor) if cursor else None
+    if not 0 < limit <= config['PAGE_MAX_LIMIT'] or \
+            (key is not None and len(key) != 2):
+        raise ValueError('Malformed page')
+    return limit, key
+
+# HEALTH CHECK
+
+
+async def hello(request):
+    return JSONResponse({
+        'success': True,
+        'status': 'Healthy',
+        'token_cache': token_cache.stats(),
+        'response_cache': response_cache.stats()
+    })
+
+# POST BALANCE OPERATIONS
+
+
+@requires_auth_async('post:balance_operations')
+async def post_balance_operation(jwt, request):
+    # coalesced operations are collected by a thread of the Flask app
+    if balance_coalescer.enabled and \
+            'Idempotency-Key' not in request.headers:
+        return serve_with_flask(request)
+
+    try:
+        operation_data = await request.json()
+        operation = (operation_data['warehouse_id'],
+                     operation_data['item_id'],
+                     operation_data['quantity'])
+    except Exception:
+        return error(400)
+
+    if not all(type(value) is int for value in operation):
+        return error(400)
+
+    try:
+        idempotency_key = parse_idempotency_key(request.headers)
+    except ValueError:
+        return error(400)
+    key_params = {'owner': jwt.get('sub', ''), 'key': idempotency_key,
+                  'request_hash': operation_hash(list(operation)),
+                  'ttl': config['IDEMPOTENCY_KEY_TTL']}
+
+    # the same statements as BalanceJournal.apply_operation (and
+    # IdempotencyKey.claim with an Idempotency-Key)
+    async with request.app.state.engine.connect() as connection:
+        transaction = await connection.begin()
+        try:
+            while idempotency_key is not None:
+                if (await connection.execute(IDEMPOTENCY_KEY_CLAIM,
+                                             key_params)).first():
+                    break
+                first = (await connection.execute(IDEMPOTENCY_KEY_GET,
+                                                  key_params)).first()
+                if first is not None:
+                    await transaction.rollback()
+                    if first.request_hash != key_params['request_hash']:
+                        return error(422)
+                    return Response(first.response,
+                                    media_type='application/json',
+                                    headers={'Idempotent-Replayed': 'true'})
+
+            rows = (await connection.execute(BALANCE_OPERATIONS, {
+                'warehouse_ids': [operation[0]],
+                'item_ids': [operation[1]],
+                'quantities': [operation[2]]
+            })).fetchall()
+
+            # rejected by overdraft control or capacity,
+            # or warehouse does not exist
+            if not rows or rows[0].over_capacity:
+                await transaction.rollback()
+                return error(400)
+
+            body = {
+                'success': True,
+                'new_balance': rows[0].quantity
+            }
+            if idempotency_key is not None:
+                await connection.execute(IDEMPOTENCY_KEY_REMEMBER, dict(
+                    key_params, response=json.dumps(body)))
+            await connection.execute(BALANCE_CHANGES_NOTIFY)
+            await transaction.commit()
+        except SQLAlchemyError:
+            await transaction.rollback()
+            return error(400)
+
+    return JSONResponse(body)
+
+# GET BALANCES
+
+
+async def get_all_balances(request):
+    # balances as of the moment in the past are read from snapshots
+    if 'as_of' in request.query_params:
+        return serve_with_flask(request)
+
+    try:
+        filters = parse_balance_filters(request.query_params)
+        limit, key = parse_page(request.query_params)
+    except Exception:
+        return error(400)
+
+    async with request.app.state.engine.connect() as connection:
+        version = (await connection.execute(BALANCES_VERSION)).first()
+        tag = 'balances.' + '.'.join(str(part) for part in version)
+        if parse_etags(request.headers.get('If-None-Match')).contains(tag):
+            return Response(status_code=304, headers={'ETag': f'"{tag}"'})
+
+        key_columns = [BalanceJournal.warehouse_id, BalanceJournal.item_id]
+        statement = apply_balance_filters(BalanceJournal.flat_select(),
+                                          filters)
+        if limit is not None:
+            if key is not None:
+                statement = statement.where(tuple_(*key_columns) >
+                                            tuple_(*key))
+            statement = statement.order_by(*key_columns).limit(limit + 1)
+
+        rows = (await connection.execute(statement)).fetchall()
+
+    response = {
+        'success': True,
+        'balances': [BalanceJournal.format_row(row) for row in rows[:limit]]
+    }
+    if limit is not None:
+        response['next_cursor'] = encode_cursor(
+            [rows[limit - 1].warehouse_id, rows[limit - 1].item_id]) \
+            if len(rows) > limit else None
+
+    return JSONResponse(response, headers={'ETag': f'"{tag}"'})
+
+# CHANGE FEED OF BALANCES
+
+
+async def read_changes(engine, since, filters):
+    async with engine.connect() as connection:
+        cursor = (await connection.execute(BALANCE_CHANGES_CURSOR)).scalar()
+        statement = apply_balance_filters(
+            BalanceJournal.changes_select(since, cursor), filters) \
+            .order_by(BalanceJournal.warehouse_id, BalanceJournal.item_id)
+        rows = (await connection.execute(statement)).fetchall()
+    return rows, cursor
+
+
+async def get_balance_changes(request):
+    since = request.query_params.get('since')
+    try:
+        wait = int(request.query_params.get('wait', 0))
+        if since is not None:
+            since = decode_cursor(since)
+        filters = parse_balance_filters(request.query_params)
+    except Exception:
+        return error(400)
+
+    if not 0 <= wait <= config['CHANGES_MAX_WAIT'] or \
+            (since is not None and len(since) != 1):
+        return error(400)
+
+    engine = request.app.state.engine
+
+    if since is None:
+        async with engine.connect() as connection:
+            cursor = (await connection.execute(
+                BALANCE_CHANGES_CURSOR)).scalar()
+        return JSONResponse({
+            'success': True,
+            'changes': [],
+            'cursor': encode_cursor([cursor])
+        })
+
+    # long poll: the request holds no connection while it waits
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    event = notifier.event
+    rows, cursor = await read_changes(engine, since[0], filters)
+    while not rows:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        await notifier.wait(event, min(remaining,
+                                       config['CHANGES_POLL_INTERVAL']))
+        event = notifier.event
+        rows, cursor = await read_changes(engine, since[0], filters)
+
+    return JSONResponse({
+        'success': True,
+        'changes': [BalanceJournal.format_row(row) for row in rows],
+        'cursor': encode_cursor([cursor])
+    })
+
+
+app = Starlette(
+    routes=[
+        Route('/', hello, methods=['GET']),
+        Route('/balances', post_balance_operation, methods=['POST']),
+        Route('/balances', get_all_balances, methods=['GET']),
+        Route('/balances/changes', get_balance_changes, methods=['GET']),
+        Mount('', app=flask_asgi)
+    ],
+    middleware=[
+        Middleware(BaseHTTPMiddleware, dispatch=record_request_metrics)
+    ],
+    exception_handlers={
+        HTTPException: http_error,
+        AuthError: auth_error
+    },
+    on_startup=[startup],
+    on_shutdown=[shutdown])
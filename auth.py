@@ -1,9 +1,17 @@
+import asyncio
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
 from flask import request
 from functools import wraps
-from jose import jwt
+import httpx
+from jose import jwk, jwt
 from urllib.request import urlopen
-from config import AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE
+from metrics import observe_auth
+from config import AUTH0_DOMAIN, ALGORITHMS, API_AUDIENCE, JWKS_URL, \
+    JWKS_FILE, JWKS_CACHE_TTL, JWKS_MIN_REFRESH_INTERVAL, TOKEN_CACHE_SIZE
 
 # AuthError Exception
 '''
@@ -31,7 +39,12 @@ returns the token part of the header
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
+    """Returns the token of the value of an Authorization header
+    """
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -86,12 +99,121 @@ def check_permissions(permission, payload):
         }, 403)
     return True
 
+# JWKS Key Store
+'''
+process-level cache of the signing keys published by Auth0
+keys are parsed once and kept indexed by kid
+the key set is fetched again when it is older than ttl seconds or when
+a token comes with an unknown kid, but never more often than once per
+min_refresh_interval seconds, so bad tokens can't cause a refetch storm
+the store can be seeded from a local JWKS file (e.g. for offline tests),
+without url it never goes to the network
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url=None, path=None, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._loaded_at = None
+        self._last_fetch = None
+        self._lock = threading.Lock()
+        # created on first use, inside the event loop
+        self._async_lock = None
+
+        if path:
+            self.load_file(path)
+
+    def load(self, jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key or key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(
+                    key, key.get('alg', ALGORITHMS[0]))
+            except Exception:
+                # skip keys we can't use instead of failing the whole set
+                continue
+
+        self._keys = keys
+        self._loaded_at = time.monotonic()
+
+    def load_file(self, path):
+        with open(path) as jwks_file:
+            self.load(json.load(jwks_file))
+
+    def refresh(self):
+        with self._lock:
+            now = time.monotonic()
+            if (self._last_fetch is not None and
+                    now - self._last_fetch < self.min_refresh_interval):
+                return False
+            self._last_fetch = now
+
+            jsonurl = urlopen(self.url)
+            self.load(json.loads(jsonurl.read()))
+            return True
+
+    async def refresh_async(self):
+        """Same as refresh, fetches the key set without blocking
+        the event loop"""
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+
+        async with self._async_lock:
+            now = time.monotonic()
+            if (self._last_fetch is not None and
+                    now - self._last_fetch < self.min_refresh_interval):
+                return False
+            self._last_fetch = now
+
+            async with httpx.AsyncClient() as client:
+                response = await client.get(self.url)
+                response.raise_for_status()
+            self.load(response.json())
+            return True
+
+    def needs_refresh(self, kid):
+        if not self.url:
+            return False
+        expired = (self._loaded_at is None or
+                   time.monotonic() - self._loaded_at > self.ttl)
+        return expired or kid not in self._keys
+
+    def get_key(self, kid):
+        if self.needs_refresh(kid):
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving the keys we have if Auth0 is unreachable
+                if not self._keys:
+                    raise
+
+        return self._keys.get(kid)
+
+    async def get_key_async(self, kid):
+        if self.needs_refresh(kid):
+            try:
+                await self.refresh_async()
+            except Exception:
+                if not self._keys:
+                    raise
+
+        return self._keys.get(kid)
+
+
+jwks_store = JWKSKeyStore(JWKS_URL, JWKS_FILE)
+
 '''
 @INPUTS
     token: a json web token (string)
 
 it should be an Auth0 token with key id (kid)
-the token is verified using Auth0 /.well-known/jwks.json
+the token is verified using the key from the jwks_store
 decodes the payload from the token
 validates the claims
 returns the decoded payload
@@ -99,11 +221,34 @@ returns the decoded payload
 
 
 def verify_decode_jwt(token):
+    kid = get_token_kid(token)
+    try:
+        rsa_key = jwks_store.get_key(kid)
+    except:
+        raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Incorrect token.'
+            }, 401)
+    return decode_jwt(token, rsa_key)
+
+
+async def verify_decode_jwt_async(token):
+    """Same as verify_decode_jwt, the signing keys are fetched
+    without blocking the event loop (see asgi.py)"""
+    kid = get_token_kid(token)
+    try:
+        rsa_key = await jwks_store.get_key_async(kid)
+    except:
+        raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Incorrect token.'
+            }, 401)
+    return decode_jwt(token, rsa_key)
+
+
+def get_token_kid(token):
     try:
-        jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-        jwks = json.loads(jsonurl.read())
         unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
     except:
         raise AuthError({
                 'code': 'invalid_header',
@@ -114,16 +259,10 @@ def verify_decode_jwt(token):
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
+
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+def decode_jwt(token, rsa_key):
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -157,11 +296,78 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+# Verified Token Cache
+'''
+bounded LRU of payloads of tokens that already passed verify_decode_jwt
+entries are keyed by sha256 of the token, so raw tokens are not kept
+in memory, and expire at the exp claim of the token
+tokens without exp are never cached
+hits, misses and evictions are counted to help sizing the cache
+'''
+
+
+class VerifiedTokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, payload = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        if self.max_size <= 0 or 'exp' not in payload:
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload['exp'], payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+token_cache = VerifiedTokenCache()
+
 '''
 @INPUTS
     permission: string permission (i.e. 'post:drink')
 
 uses the get_token_auth_header method to get the token
+looks the token up in the token_cache and only if it's not there
 uses the verify_decode_jwt method to decode the jwt
 uses the check_permissions method validate claims and check the
 requested permission returns the decorator which passes the decoded payload to
@@ -174,7 +380,13 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            start = time.perf_counter()
+            payload = token_cache.get(token)
+            cache_hit = payload is not None
+            if not cache_hit:
+                payload = verify_decode_jwt(token)
+                token_cache.put(token, payload)
+            observe_auth(cache_hit, time.perf_counter() - start)
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
@@ -0,0 +1,142 @@
+"""Throughput of the sync (gunicorn app:app) and async (asgi:app)
+deployments under many concurrent clients.
+
+Both deployments should be started beforehand against the same scratch
+database, which this script reaches too (DATABASE_URL or DB_* variables)
+to remove the balances written by the benchmark, e.g.
+
+    gunicorn -w 4 --threads 8 -b :8000 app:app
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker -b :8001 asgi:app
+    python3 benchmarks/asgi_vs_wsgi.py --clients 1000
+
+Every client sends requests one after another for --duration seconds,
+half of them GET /balances?warehouse_id=..., half POST /balances to a
+warehouse and items created for the benchmark. Needs MANAGER_TOKEN.
+Prints a JSON report.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import MANAGER_TOKEN  # noqa: E402
+
+
+def remove_balances(warehouse_id):
+    """Deletes the balances of the warehouse, they can't be deleted
+    through the API and the warehouse can't be deleted while it has
+    them"""
+    from app import app
+    from models import db, BalanceJournal
+
+    with app.app_context():
+        BalanceJournal.query.filter_by(warehouse_id=warehouse_id) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+async def delete_entity(client, path):
+    response = await client.delete(path)
+    if response.status_code != 200:
+        raise RuntimeError(f'DELETE {path} failed with '
+                           f'{response.status_code}, delete the benchmark '
+                           f'rows by hand before the next run')
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run_client(client, index, warehouse_id, item_ids, deadline,
+                     latencies, errors):
+    item_id = item_ids[index % len(item_ids)]
+    post = index % 2 == 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if post:
+                response = await client.post('/balances', json={
+                    'warehouse_id': warehouse_id,
+                    'item_id': item_id,
+                    'quantity': 1
+                })
+            else:
+                response = await client.get(
+                    f'/balances?warehouse_id={warehouse_id}&limit=100')
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(time.perf_counter() - start)
+
+
+async def run_deployment(url, args):
+    headers = {'Authorization': f'Bearer {MANAGER_TOKEN}'}
+    limits = httpx.Limits(max_connections=args.clients,
+                          max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(base_url=url, headers=headers,
+                                 limits=limits, timeout=60) as client:
+        suffix = f'{url} {time.time()}'
+        warehouse_id = (await client.post('/warehouses', json={
+            'name': f'benchmark warehouse {suffix}'})).json()['new_wh']['id']
+        item_ids = [(await client.post('/items', json={
+            'name': f'benchmark item {index} {suffix}',
+            'volume': 1})).json()['new_item']['id']
+            for index in range(args.items)]
+
+        latencies = []
+        errors = []
+        deadline = time.monotonic() + args.duration
+        try:
+            await asyncio.gather(*(
+                run_client(client, index, warehouse_id, item_ids, deadline,
+                           latencies, errors)
+                for index in range(args.clients)))
+        finally:
+            remove_balances(warehouse_id)
+            await delete_entity(client, f'/warehouses/{warehouse_id}')
+            for item_id in item_ids:
+                await delete_entity(client, f'/items/{item_id}')
+
+    latencies.sort()
+    report = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_s': round(len(latencies) / args.duration, 1)
+    }
+    if latencies:
+        report.update({
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1)
+        })
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sync-url', default='http://localhost:8000')
+    parser.add_argument('--async-url', default='http://localhost:8001')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--items', type=int, default=100,
+                        help='number of distinct entries written')
+    args = parser.parse_args()
+
+    report = {'clients': args.clients, 'duration_s': args.duration}
+    for name, url in (('sync', args.sync_url), ('async', args.async_url)):
+        report[name] = await run_deployment(url, args)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+"""Throughput of balance operations on a few hot entries with and without
+write coalescing.
+
+Runs balance operations from many threads at once against the configured
+database (DATABASE_URL or DB_* variables, use a scratch database), all of
+them on --hot entries of a warehouse without overdraft control, first one
+by one (BalanceJournal.apply_operation, as POST /balances does by
+default), then through BalanceCoalescer (as with
+BALANCE_COALESCE_WINDOW_MS), in alternating rounds, and prints a JSON
+report.
+
+    python3 benchmarks/hot_row_coalescing.py --threads 64 --window-ms 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_round(app, apply, item_ids, threads_count, duration):
+    """Applies +1 operations from threads_count threads for duration
+    seconds, returns latencies of accepted operations and the number of
+    rejected ones"""
+    from models import db
+
+    latencies = []
+    rejected = []
+    start = threading.Barrier(threads_count)
+
+    def worker(index):
+        item_id = item_ids[index % len(item_ids)]
+        with app.app_context():
+            start.wait()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                begin = time.perf_counter()
+                if apply(item_id) is None:
+                    rejected.append(item_id)
+                else:
+                    latencies.append(time.perf_counter() - begin)
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, len(rejected)
+
+
+def main(args):
+    from app import app
+    from coalescing import BalanceCoalescer
+    from models import db, Warehouse, Item, BalanceJournal
+
+    with app.app_context():
+        warehouse = Warehouse(name='benchmark coalescing warehouse',
+                              overdraft_control=False)
+        db.session.add(warehouse)
+        items = [Item(name=f'benchmark coalescing item {index}', volume=1)
+                 for index in range(args.hot)]
+        db.session.add_all(items)
+        db.session.commit()
+        warehouse_id = warehouse.id
+        item_ids = [item.id for item in items]
+
+    coalescer = BalanceCoalescer(window_ms=args.window_ms,
+                                 max_batch=args.max_batch)
+    coalescer.init_app(app)
+    variants = {
+        'one_by_one': lambda item_id: BalanceJournal.apply_operation(
+            warehouse_id, item_id, 1),
+        'coalesced': lambda item_id: coalescer.submit(
+            warehouse_id, item_id, 1)
+    }
+    latencies = {name: [] for name in variants}
+    rejected = {name: 0 for name in variants}
+
+    try:
+        # warm up connections and entries
+        for apply in variants.values():
+            run_round(app, apply, item_ids, args.threads, 1)
+
+        for _ in range(args.rounds):
+            for name, apply in variants.items():
+                round_latencies, round_rejected = run_round(
+                    app, apply, item_ids, args.threads, args.duration)
+                latencies[name] += round_latencies
+                rejected[name] += round_rejected
+    finally:
+        with app.app_context():
+            db.session.rollback()
+            BalanceJournal.query.filter_by(warehouse_id=warehouse_id) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            for item in Item.query.filter(Item.id.in_(item_ids)):
+                db.session.delete(item)
+            db.session.delete(Warehouse.query.get(warehouse_id))
+            db.session.commit()
+
+    report = {
+        'threads': args.threads,
+        'hot_entries': args.hot,
+        'window_ms': args.window_ms,
+        'duration_s': args.duration * args.rounds
+    }
+    for name, values in latencies.items():
+        values.sort()
+        report[name] = {
+            'ops': len(values),
+            'rejected': rejected[name],
+            'ops_per_s': round(len(values) / report['duration_s'], 1),
+            'mean_ms': round(statistics.mean(values) * 1000, 2),
+            'p50_ms': round(values[len(values) // 2] * 1000, 2),
+            'p99_ms': round(values[int(len(values) * 0.99)] * 1000, 2)
+        }
+    report['throughput_gain'] = round(
+        report['coalesced']['ops_per_s'] / report['one_by_one']['ops_per_s'],
+        2)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--hot', type=int, default=1,
+                        help='number of hot entries written')
+    parser.add_argument('--window-ms', type=float, default=5)
+    parser.add_argument('--max-batch', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds per round and variant')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    # every thread of the one by one variant holds a connection
+    os.environ.setdefault('DB_POOL_SIZE', str(args.threads))
+    main(args)
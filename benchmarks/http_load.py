@@ -0,0 +1,291 @@
+"""HTTP load benchmark of the main routes at several dataset sizes and
+concurrency levels.
+
+Seeds the configured database (DATABASE_URL or DB_* variables, use a
+scratch database: all the tables are truncated) with every dataset in
+turn, starts the app under gunicorn on it and drives every scenario with
+every number of concurrent clients for --duration seconds. Auth0 is
+stubbed: tokens are signed by a key pair generated for the run and the
+server reads the public key from a local JWKS file.
+
+    python3 benchmarks/http_load.py --output before.json
+    python3 benchmarks/http_load.py --output after.json
+    python3 benchmarks/http_load.py compare before.json after.json
+
+The report is JSON: one result per dataset, scenario and concurrency with
+throughput, error count and p50/p95/p99 latency. `compare` prints the
+relative change of throughput and p99 of every result.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import rsa
+from jose import jwk, jwt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# the server verifies tokens with the local key only
+os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+os.environ.setdefault('API_AUDIENCE', 'benchmark')
+os.environ['JWKS_URL'] = ''
+
+DATASETS = {
+    # warehouses, items, balances
+    'small': (10, 1000, 1000),
+    'medium': (50, 10000, 50000),
+    'large': (100, 100000, 1000000)
+}
+
+SCENARIOS = ('post_balance', 'get_balances', 'get_items', 'get_warehouses')
+
+
+def seed(warehouses, items, balances):
+    from generator import generate_dataset
+
+    generate_dataset(warehouses, items, balances, seed=1, truncate=True)
+
+
+def make_signing_key(directory):
+    """Writes the public key to a JWKS file, returns the file path and
+    a token with all the permissions"""
+    from config import AUTH0_DOMAIN, API_AUDIENCE
+
+    _, private_key = rsa.newkeys(2048)
+    private_pem = private_key.save_pkcs1().decode()
+    public_jwk = jwk.construct(private_pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': 'benchmark', 'use': 'sig'})
+
+    path = os.path.join(directory, 'jwks.json')
+    with open(path, 'w') as jwks_file:
+        json.dump({'keys': [public_jwk]}, jwks_file)
+
+    token = jwt.encode({
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'aud': API_AUDIENCE,
+        'sub': 'benchmark|user',
+        'exp': int(time.time()) + 24 * 3600,
+        'permissions': ['edit:warehouses', 'edit:items',
+                        'post:balance_operations']
+    }, private_pem, algorithm='RS256', headers={'kid': 'benchmark'})
+
+    return path, token
+
+
+def start_server(args, jwks_path):
+    from config import SQLALCHEMY_DATABASE_URI
+
+    env = dict(os.environ, DATABASE_URL=SQLALCHEMY_DATABASE_URI,
+               JWKS_FILE=jwks_path)
+    command = ['gunicorn', '-w', str(args.workers), '-b',
+               f'127.0.0.1:{args.port}']
+    if args.server == 'async':
+        command += ['-k', 'uvicorn.workers.UvicornWorker', 'asgi:app']
+    else:
+        command += ['--threads', str(args.threads), 'app:app']
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f'http://127.0.0.1:{args.port}/').status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+
+    server.terminate()
+    raise RuntimeError('Server did not start')
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def make_request(client, scenario, dataset, rng):
+    warehouses, items, _ = dataset
+    if scenario == 'post_balance':
+        return client.post('/balances', json={
+            'warehouse_id': rng.randint(1, warehouses),
+            'item_id': rng.randint(1, items),
+            'quantity': 1
+        })
+    if scenario == 'get_balances':
+        return client.get('/balances', params={
+            'warehouse_id': rng.randint(1, warehouses),
+            'limit': 100
+        })
+    if scenario == 'get_items':
+        return client.get('/items', params={'limit': 100})
+    return client.get('/warehouses')
+
+
+async def run_client(client, scenario, dataset, rng, deadline, latencies,
+                     errors):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await make_request(client, scenario, dataset, rng)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        (latencies if ok else errors).append(time.perf_counter() - start)
+
+
+async def run_cell(args, token, scenario, dataset, concurrency, seed):
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(
+            base_url=f'http://127.0.0.1:{args.port}', limits=limits,
+            headers={'Authorization': f'Bearer {token}'},
+            timeout=60) as client:
+        # warm up connections and caches
+        await run_client_batch(client, scenario, dataset, concurrency, seed,
+                               args.warmup)
+        latencies, errors = await run_client_batch(
+            client, scenario, dataset, concurrency, seed + 1, args.duration)
+
+    latencies.sort()
+    result = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_s': round(len(latencies) / args.duration, 1)
+    }
+    if latencies:
+        result.update({
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+        })
+    return result
+
+
+async def run_client_batch(client, scenario, dataset, concurrency, seed,
+                           duration):
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(
+        run_client(client, scenario, dataset,
+                   random.Random(seed * 100003 + index), deadline,
+                   latencies, errors)
+        for index in range(concurrency)))
+    return latencies, errors
+
+
+def run(args):
+    from app import app
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                 cwd=ROOT, capture_output=True,
+                                 text=True).stdout.strip(),
+        'server': args.server,
+        'workers': args.workers,
+        'threads': args.threads,
+        'duration_s': args.duration,
+        'results': []
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        jwks_path, token = make_signing_key(directory)
+        for name in args.datasets:
+            dataset = DATASETS[name]
+            with app.app_context():
+                seed(*dataset)
+            server = start_server(args, jwks_path)
+            try:
+                for scenario in args.scenarios:
+                    for concurrency in args.concurrency:
+                        result = asyncio.run(run_cell(
+                            args, token, scenario, dataset, concurrency,
+                            args.seed))
+                        result.update({'dataset': name,
+                                       'scenario': scenario,
+                                       'concurrency': concurrency})
+                        report['results'].append(result)
+                        print(json.dumps(result), file=sys.stderr)
+            finally:
+                server.terminate()
+                server.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+
+    def key(result):
+        return result['dataset'], result['scenario'], result['concurrency']
+
+    def change(old, new):
+        return round(100 * (new - old) / old, 1) if old else None
+
+    previous = {key(result): result for result in before['results']}
+    changes = []
+    for result in after['results']:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        changes.append({
+            'dataset': result['dataset'],
+            'scenario': result['scenario'],
+            'concurrency': result['concurrency'],
+            'requests_per_s_pct': change(old['requests_per_s'],
+                                         result['requests_per_s']),
+            'p99_ms_pct': change(old.get('p99_ms'), result.get('p99_ms', 0))
+        })
+
+    print(json.dumps({
+        'before': before.get('commit'),
+        'after': after.get('commit'),
+        'changes': changes
+    }, indent=2))
+
+
+def main():
+    if sys.argv[1:2] == ['compare']:
+        parser = argparse.ArgumentParser(description='Compare two reports')
+        parser.add_argument('before')
+        parser.add_argument('after')
+        args = parser.parse_args(sys.argv[2:])
+        compare(args.before, args.after)
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--datasets', nargs='+', choices=DATASETS,
+                        default=['small', 'medium'])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=list(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int,
+                        default=[1, 16, 64])
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per scenario and concurrency')
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--server', choices=('sync', 'async'),
+                        default='sync')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='report file, stdout by default')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Extra write cost of the stock movements ledger per balance operation.
+
+Runs balance operations against the configured database (DATABASE_URL or
+DB_* variables, use a scratch database) with the full BALANCE_OPERATIONS
+statement and with the same statement without the stock_movements insert,
+in alternating rounds, and prints a JSON report.
+
+    python3 benchmarks/ledger_write_cost.py --ops 5000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from models import db, Warehouse, Item, BalanceJournal, \
+    BALANCE_OPERATIONS  # noqa: E402
+
+
+def without_ledger(statement):
+    text = statement.text
+    start = text.index('    ), movements AS (')
+    end = text.index('    )\n    SELECT warehouse_id, item_id, quantity,')
+    return db.text(text[:start] + text[end:])
+
+
+def run_round(statement, warehouse_id, item_ids, ops):
+    latencies = []
+    for index in range(ops):
+        params = {
+            'warehouse_ids': [warehouse_id],
+            'item_ids': [item_ids[index % len(item_ids)]],
+            'quantities': [1]
+        }
+        start = time.perf_counter()
+        db.session.execute(statement, params).fetchall()
+        db.session.commit()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def relation_size(name):
+    return db.session.execute(
+        db.text('SELECT pg_total_relation_size(:name)'),
+        {'name': name}).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ops', type=int, default=2000,
+                        help='operations per variant')
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--items', type=int, default=100,
+                        help='number of distinct entries written')
+    args = parser.parse_args()
+
+    warehouse = Warehouse(name='benchmark ledger warehouse')
+    db.session.add(warehouse)
+    items = [Item(name=f'benchmark ledger item {index}', volume=1)
+             for index in range(args.items)]
+    db.session.add_all(items)
+    db.session.commit()
+    item_ids = [item.id for item in items]
+
+    variants = {
+        'with_ledger': BALANCE_OPERATIONS,
+        'without_ledger': without_ledger(BALANCE_OPERATIONS)
+    }
+    latencies = {name: [] for name in variants}
+    ledger_bytes = 0
+    ops_per_round = args.ops // args.rounds
+
+    try:
+        # warm up caches and entries
+        run_round(BALANCE_OPERATIONS, warehouse.id, item_ids, args.items)
+
+        for _ in range(args.rounds):
+            for name, statement in variants.items():
+                size_before = relation_size('stock_movements')
+                latencies[name] += run_round(statement, warehouse.id,
+                                             item_ids, ops_per_round)
+                if name == 'with_ledger':
+                    ledger_bytes += relation_size('stock_movements') \
+                        - size_before
+    finally:
+        db.session.rollback()
+        BalanceJournal.query.filter_by(warehouse_id=warehouse.id) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        for item in items:
+            db.session.delete(item)
+        db.session.delete(warehouse)
+        db.session.commit()
+
+    report = {'ops': ops_per_round * args.rounds}
+    for name, values in latencies.items():
+        values.sort()
+        report[name] = {
+            'mean_us': round(statistics.mean(values) * 1e6, 1),
+            'p50_us': round(values[len(values) // 2] * 1e6, 1),
+            'p99_us': round(values[int(len(values) * 0.99)] * 1e6, 1),
+            'ops_per_s': round(len(values) / sum(values), 1)
+        }
+    extra = report['with_ledger']['mean_us'] \
+        - report['without_ledger']['mean_us']
+    report['extra_us_per_op'] = round(extra, 1)
+    report['extra_pct'] = round(
+        100 * extra / report['without_ledger']['mean_us'], 1)
+    report['ledger_bytes_per_op'] = round(ledger_bytes / report['ops'], 1)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
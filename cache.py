@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict
+
+from config import RESPONSE_CACHE_SIZE
+
+# Response Cache
+'''
+bounded LRU of serialized responses, per process
+every entry is stored with the version of the table it was built from,
+an entry is served only while the version is still the current one, so
+a change committed by any worker invalidates the entries of all workers
+on their next request
+hits, misses and evictions are counted to help sizing the cache
+'''
+
+
+class ResponseCache:
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, body = entry
+                if entry_version == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return body
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, version, body):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+response_cache = ResponseCache()
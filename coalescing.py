@@ -0,0 +1,168 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from config import BALANCE_COALESCE_WINDOW_MS, BALANCE_COALESCE_MAX_BATCH, \
+    BALANCE_COALESCE_TIMEOUT
+from metrics import observe_coalesced_batch
+from models import db, Warehouse, BalanceJournal
+
+# Balance Write Coalescing
+'''
+opt-in with BALANCE_COALESCE_WINDOW_MS: balance operations of concurrent
+requests are collected for a short window (starting with the first one)
+and applied together by one thread of the process, so a hot entry is
+locked and committed once per window instead of once per operation
+deltas to the same entry are summed up by BALANCE_OPERATIONS and written
+with one update, every operation still gets its own stock movement
+only operations on warehouses without overdraft control are submitted
+(see accepts), and merged (see BalanceJournal.apply_coalesced), if the
+merged ones don't fit the capacity or fail before their commit, they are
+applied one by one
+a request waits until its operation is committed, so every accepted
+operation is durable when it's acknowledged, the merged operations are
+answered right after their commit, the others each with its own result
+or error. A failed commit may still have been applied, so its operations
+are never applied again
+'''
+
+
+# seconds the overdraft control flag of a warehouse is cached for
+OVERDRAFT_FLAG_TTL = 60
+
+
+class BalanceCoalescer:
+    def __init__(self, window_ms=BALANCE_COALESCE_WINDOW_MS,
+                 max_batch=BALANCE_COALESCE_MAX_BATCH,
+                 timeout=BALANCE_COALESCE_TIMEOUT):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.app = None
+        self._overdraft_control = {}
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.app is not None
+
+    def init_app(self, app):
+        self.app = app
+
+    def accepts(self, warehouse_id):
+        """Tells if operations on the warehouse go through the coalescer.
+        Those on warehouses with overdraft control aren't merged, the
+        request applies them faster itself. The flag is cached for
+        OVERDRAFT_FLAG_TTL seconds, a stale one only sends an operation
+        the slower way: apply_coalesced checks the flag again"""
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        cached = self._overdraft_control.get(warehouse_id)
+        if cached is None or cached[1] <= now:
+            overdraft_control = db.session \
+                .query(Warehouse.overdraft_control) \
+                .filter(Warehouse.id == warehouse_id).scalar()
+            # the request doesn't hold a transaction while it waits
+            db.session.rollback()
+            if overdraft_control is None:
+                return False
+            cached = (overdraft_control, now + OVERDRAFT_FLAG_TTL)
+            self._overdraft_control[warehouse_id] = cached
+        return not cached[0]
+
+    def submit(self, warehouse_id, item_id, quantity):
+        """Applies the operation with the next batch, returns the new
+        balance or None as BalanceJournal.apply_operation does. Raises
+        FutureTimeoutError if the batch of the operation isn't taken
+        within the timeout, the operation is dropped then. Once its batch
+        is being applied, the request waits for the outcome"""
+        future = Future()
+        with self._condition:
+            self._start()
+            self._pending.append(((warehouse_id, item_id, quantity), future))
+            self._condition.notify()
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise
+        return future.result()
+
+    def _start(self):
+        # gunicorn forks workers after import, every process needs
+        # a thread of its own
+        if self._thread is None or self._pid != os.getpid():
+            self._pending = []
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='balance-coalescer')
+            self._thread.start()
+
+    def _take_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+        # requests which timed out are dropped, the others can't be
+        # cancelled any more
+        return [(operation, future) for operation, future in batch
+                if future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        with self.app.app_context():
+            try:
+                try:
+                    observe_coalesced_batch(len(batch))
+                    results = BalanceJournal.apply_coalesced(
+                        [operation for operation, _ in batch])
+                except Exception:
+                    # nothing is committed, all are applied one by one
+                    db.session.rollback()
+                    print(sys.exc_info())
+                    results = {}
+                else:
+                    try:
+                        db.session.commit()
+                    except Exception as ex:
+                        # the commit may have been applied anyway, the
+                        # merged operations are not tried again
+                        db.session.rollback()
+                        for index in results:
+                            batch[index][1].set_exception(ex)
+                    else:
+                        for index, result in results.items():
+                            batch[index][1].set_result(result)
+
+                for index, (operation, future) in enumerate(batch):
+                    if index in results:
+                        continue
+                    try:
+                        future.set_result(
+                            BalanceJournal.apply_operation(*operation))
+                    except Exception as ex:
+                        db.session.rollback()
+                        future.set_exception(ex)
+            finally:
+                db.session.remove()
+
+
+balance_coalescer = BalanceCoalescer()
@@ -14,8 +14,102 @@ SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', f'postgresql://{DB_USER}:{DB
 if SQLALCHEMY_DATABASE_URI[:9] == 'postgres:':
     SQLALCHEMY_DATABASE_URI = 'postgresql' + SQLALCHEMY_DATABASE_URI[8:]
 
+# connection pool of every worker process. A worker serves WORKER_THREADS
+# requests at once (see Procfile), so the pool keeps that many connections,
+# long polls of the change feed take one more connection each, hence the
+# overflow. Connections are checked before use (pre-ping) and replaced
+# after DB_POOL_RECYCLE seconds, so a failover costs a reconnect, not a
+# stalled request, and a statement running longer than
+# DB_STATEMENT_TIMEOUT milliseconds is cancelled (0 for no limit)
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 8))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', WORKER_THREADS))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', WORKER_THREADS))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('true', '1', 'yes')
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 30000))
+
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+    'pool_recycle': DB_POOL_RECYCLE,
+    'pool_pre_ping': DB_POOL_PRE_PING,
+    'connect_args': {
+        'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+    }
+}
+
+# connection pool of the async deployment (asgi.py), one event loop serves
+# every open request, so the pool is the limit of concurrent queries
+ASGI_DB_POOL_SIZE = int(os.getenv('ASGI_DB_POOL_SIZE', 20))
+ASGI_DB_MAX_OVERFLOW = int(os.getenv('ASGI_DB_MAX_OVERFLOW', 20))
+
+# directory where gunicorn workers write their metrics, so /metrics sums
+# all the workers up, set by gunicorn.conf.py
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+# opt-in SQL profiling of requests: SQL_PROFILING adds Server-Timing and
+# X-SQL-* headers with the number, total and slowest time of statements,
+# statements slower than SQL_SLOW_QUERY_MS milliseconds are logged with
+# their EXPLAIN (0 for no logging)
+SQL_PROFILING = os.getenv('SQL_PROFILING', 'false').lower() in ('true', '1', 'yes')
+SQL_SLOW_QUERY_MS = float(os.getenv('SQL_SLOW_QUERY_MS', 0))
+
+# keyset pagination of GET /warehouses, /items and /balances
+PAGE_DEFAULT_LIMIT = int(os.getenv('PAGE_DEFAULT_LIMIT', 100))
+PAGE_MAX_LIMIT = int(os.getenv('PAGE_MAX_LIMIT', 1000))
+
+# rows fetched from the server-side cursor (and sent) at once by
+# GET /balances/export
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+# maximal number of seconds GET /balances/changes waits for changes, and
+# how often it checks for changes without a notification
+CHANGES_MAX_WAIT = int(os.getenv('CHANGES_MAX_WAIT', 30))
+CHANGES_POLL_INTERVAL = float(os.getenv('CHANGES_POLL_INTERVAL', 1))
+
+# maximal number of operations in one POST /balances/batch request
+BALANCE_BATCH_MAX_SIZE = int(os.getenv('BALANCE_BATCH_MAX_SIZE', 1000))
+
+# rows upserted with one statement (and committed) by bulk import of
+# warehouses and items, and number of invalid rows listed in its report
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 5000))
+IMPORT_MAX_ERRORS = int(os.getenv('IMPORT_MAX_ERRORS', 1000))
+
+# milliseconds balance operations of concurrent requests are collected
+# for to be applied together (0 switches coalescing off), maximal
+# number of operations applied together, and seconds a request waits
+# for its batch, see coalescing.py
+BALANCE_COALESCE_WINDOW_MS = float(os.getenv('BALANCE_COALESCE_WINDOW_MS', 0))
+BALANCE_COALESCE_MAX_BATCH = int(os.getenv('BALANCE_COALESCE_MAX_BATCH', 500))
+BALANCE_COALESCE_TIMEOUT = float(os.getenv('BALANCE_COALESCE_TIMEOUT', 30))
+
+# every BALANCE_SNAPSHOT_CHECKPOINT_EVERY-th balance snapshot has all the
+# balances (the others only the changed ones), see take_balance_snapshot
+BALANCE_SNAPSHOT_CHECKPOINT_EVERY = int(
+    os.getenv('BALANCE_SNAPSHOT_CHECKPOINT_EVERY', 144))
+
+# seconds a response of POST /balances is kept for retries with the same
+# Idempotency-Key, expired keys are deleted by manage.py
+# prune_idempotency_keys
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 3600))
+
+# number of serialized responses of GET /warehouses and /items kept per
+# process, 0 switches the cache off
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 256))
+
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.getenv('API_AUDIENCE')
+
+# signing keys are cached per process, JWKS_FILE seeds the cache from disk
+# (and is the only source when AUTH0_DOMAIN is not set)
+JWKS_URL = os.getenv('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json' if AUTH0_DOMAIN else None)
+JWKS_FILE = os.getenv('JWKS_FILE')
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30))
+# number of already verified tokens kept per process, 0 switches the cache off
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
 MANAGER_TOKEN = os.getenv('MANAGER_TOKEN')
 USER_TOKEN = os.getenv('USER_TOKEN')
\ No newline at end of file
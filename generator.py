@@ -0,0 +1,163 @@
+import io
+import itertools
+import random
+
+from models import db, TableVersion, NO_STATEMENT_TIMEOUT, rebuild_summaries
+
+# Dataset Generator
+'''
+synthetic warehouses, items and balances for performance work, the same
+seed gives the same dataset
+balances are skewed the way stock usually is: items are ranked by
+popularity and an item of rank r is stocked in about C / r^skew
+warehouses (C is chosen so that the total is the requested number of
+balances) with quantities falling with the rank the same way, so a few
+items have most of the balances and most of the stock
+rows are written with COPY in chunks, in one transaction, warehouses and
+items get ids from 1, so the tables should be empty (or truncated)
+'''
+
+CITIES = ['Amsterdam', 'Berlin', 'Chicago', 'Denver', 'Dublin', 'Houston',
+          'Lisbon', 'Madrid', 'Milan', 'Munich', 'Osaka', 'Oslo', 'Paris',
+          'Prague', 'Riga', 'Seattle', 'Tallinn', 'Toronto', 'Vienna',
+          'Warsaw']
+SITES = ['central warehouse', 'distribution center', 'cross-dock', 'store',
+         'cold storage', 'backroom']
+
+ADJECTIVES = ['pickled', 'frozen', 'organic', 'heavy-duty', 'compact',
+              'premium', 'budget', 'stainless', 'wooden', 'insulated',
+              'folding', 'waterproof']
+PRODUCTS = ['tomatoes', 'cucumbers', 'zucchini', 'winter tires', 'shovel',
+            'paint', 'screws', 'rope', 'lamp', 'bucket', 'gloves', 'hammer',
+            'ladder', 'jar', 'kettle', 'blanket']
+PACKAGES = ['1 pc.', '3 pcs.', '1 l.', '2 l.', '3 l.', '5 kg', '10 kg',
+            'box of 12', 'pallet']
+
+TRUNCATE = db.text('''
+    TRUNCATE balance_journal, stock_movements, balance_snapshot_entries,
+             balance_snapshots, warehouse_summaries, item_summaries,
+             tombstones, warehouses, items
+    RESTART IDENTITY CASCADE
+''')
+
+# ids are given explicitly, sequences should continue after them
+RESET_SEQUENCES = [
+    db.text(f'''
+        SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                      coalesce(max(id), 0) + 1, false)
+        FROM {table}
+    ''')
+    for table in ('warehouses', 'items')
+]
+
+
+def warehouse_rows(rng, count, row_version):
+    for warehouse_id in range(1, count + 1):
+        name = f'{rng.choice(CITIES)} {rng.choice(SITES)} {warehouse_id}'
+        overdraft_control = 't' if rng.random() < 0.3 else 'f'
+        yield f'{warehouse_id}\t{name}\t{overdraft_control}\t{row_version}\n'
+
+
+def item_rows(rng, count, row_version):
+    for item_id in range(1, count + 1):
+        name = f'{rng.choice(ADJECTIVES)} {rng.choice(PRODUCTS)} ' \
+               f'{rng.choice(PACKAGES)} #{item_id}'
+        # most items are small
+        volume = min(int(rng.paretovariate(1.5)), 100)
+        yield f'{item_id}\t{name}\t{volume}\t{row_version}\n'
+
+
+def coverage(weights, warehouses, balances):
+    """Returns scale C such that sum of min(warehouses, C * weight)
+    over the items is about balances"""
+    low, high = 0.0, float(warehouses) / weights[-1]
+    for _ in range(60):
+        scale = (low + high) / 2
+        total = sum(min(warehouses, scale * weight) for weight in weights)
+        if total < balances:
+            low = scale
+        else:
+            high = scale
+    return high
+
+
+def balance_rows(rng, warehouses, items, balances, skew):
+    weights = [1 / rank ** skew for rank in range(1, items + 1)]
+    scale = coverage(weights, warehouses, balances)
+
+    # popularity rank of an item doesn't follow its id
+    item_ids = list(range(1, items + 1))
+    rng.shuffle(item_ids)
+
+    warehouse_ids = range(1, warehouses + 1)
+    for item_id, weight in zip(item_ids, weights):
+        stocked_in = min(warehouses, int(scale * weight + rng.random()))
+        if not stocked_in:
+            continue
+        # quantities fall with the rank as well
+        top = max(int(1000 * weight / weights[0]), 1)
+        for warehouse_id in rng.sample(warehouse_ids, stocked_in):
+            yield f'{warehouse_id}\t{item_id}\t{rng.randint(1, top)}\n'
+
+
+def copy_rows(cursor, table, columns, rows, chunk_size):
+    """COPYs lines of rows to the table in chunks, returns the number
+    of rows"""
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return count
+        cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN',
+                           io.StringIO(''.join(chunk)))
+        count += len(chunk)
+
+
+def generate_dataset(warehouses, items, balances, seed=0, skew=1.0,
+                     truncate=False, chunk_size=100000):
+    """Generates warehouses, items and about `balances` balance entries
+    (at most warehouses * items) in one transaction, returns numbers of
+    generated rows. Raises ValueError if there are warehouses or items
+    already and truncate is not set"""
+    db.session.execute(NO_STATEMENT_TIMEOUT)
+    if truncate:
+        db.session.execute(TRUNCATE)
+    elif db.session.execute(db.text(
+            'SELECT EXISTS (SELECT 1 FROM warehouses) '
+            'OR EXISTS (SELECT 1 FROM items)')).scalar():
+        db.session.rollback()
+        raise ValueError('Warehouses or items exist already')
+
+    rng = random.Random(seed)
+    balances = min(balances, warehouses * items)
+    cursor = db.session.connection().connection.cursor()
+
+    # generated rows show up in delta sync
+    counts = {
+        'warehouses': copy_rows(
+            cursor, 'warehouses',
+            ['id', 'name', 'overdraft_control', 'row_version'],
+            warehouse_rows(rng, warehouses, TableVersion.bump('warehouses')),
+            chunk_size),
+        'items': copy_rows(
+            cursor, 'items', ['id', 'name', 'volume', 'row_version'],
+            item_rows(rng, items, TableVersion.bump('items')),
+            chunk_size),
+        'balances': copy_rows(
+            cursor, 'balance_journal', ['warehouse_id', 'item_id', 'quantity'],
+            balance_rows(rng, warehouses, items, balances, skew),
+            chunk_size)
+    }
+    cursor.close()
+
+    for statement in RESET_SEQUENCES:
+        db.session.execute(statement)
+    # commits the whole dataset together with the summaries
+    rebuild_summaries()
+
+    # planner statistics of the new tables
+    db.session.execute(NO_STATEMENT_TIMEOUT)
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+
+    return counts
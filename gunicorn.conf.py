@@ -0,0 +1,38 @@
+# read by gunicorn on start (also with uvicorn workers of asgi.py)
+import os
+import shutil
+import tempfile
+
+# every worker writes its metrics to files in this directory, so /metrics
+# served by any worker sums up all of them (see metrics.py). Set before
+# the workers are forked, so they import prometheus_client with it.
+# Without the variable every server gets a new directory of its own (so
+# servers running side by side don't mix their metrics), which is
+# removed on exit, a directory set by the variable is left as it is
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = \
+        tempfile.mkdtemp(prefix='udacity_wh_metrics_')
+    # survives reloading of this file
+    os.environ['OWN_PROMETHEUS_MULTIPROC_DIR'] = \
+        os.environ['PROMETHEUS_MULTIPROC_DIR']
+
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def is_own_directory():
+    return os.environ.get('OWN_PROMETHEUS_MULTIPROC_DIR') == \
+        os.environ['PROMETHEUS_MULTIPROC_DIR']
+
+
+def on_starting(server):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if is_own_directory():
+        shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'],
+                      ignore_errors=True)
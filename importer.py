@@ -0,0 +1,190 @@
+import csv
+import json
+import sys
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from config import IMPORT_BATCH_SIZE, IMPORT_MAX_ERRORS
+from models import db, import_batch
+
+# Bulk Import
+'''
+warehouses and items are read from CSV (with a header row) or NDJSON
+(one JSON object per line) records line by line and upserted by name in
+batches of IMPORT_BATCH_SIZE rows, one statement and one commit per batch
+invalid records are reported with their line numbers and skipped, the rest
+of the file is imported anyway
+a file which can't be read on (not UTF-8 or broken CSV) stops the import,
+the rows before are imported and the report tells where it stopped
+values missing in a record keep their current values for existing
+warehouses and items and get defaults for new ones
+'''
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+NAME_MAX_LENGTH = 120
+
+TRUE_VALUES = ('true', 't', 'yes', 'y', '1')
+FALSE_VALUES = ('false', 'f', 'no', 'n', '0')
+
+
+def is_valid_capacity(capacity):
+    # capacity is a total volume, None for no limit
+    return capacity is None or (type(capacity) is int and capacity >= 0)
+
+
+def parse_int(value):
+    # CSV values are strings, NDJSON values should be numbers already
+    if isinstance(value, str):
+        return int(value)
+    if type(value) is not int:
+        raise ValueError
+    return value
+
+
+def parse_overdraft_control(value):
+    if isinstance(value, str):
+        if value.lower() in TRUE_VALUES:
+            return True
+        if value.lower() in FALSE_VALUES:
+            return False
+    if type(value) is not bool:
+        raise ValueError('invalid overdraft_control')
+    return value
+
+
+def parse_capacity(value):
+    try:
+        capacity = None if value is None else parse_int(value)
+    except ValueError:
+        raise ValueError('invalid capacity')
+    if not is_valid_capacity(capacity):
+        raise ValueError('invalid capacity')
+    return capacity
+
+
+def parse_volume(value):
+    try:
+        volume = parse_int(value)
+    except ValueError:
+        raise ValueError('invalid volume')
+    if volume < 0:
+        raise ValueError('invalid volume')
+    return volume
+
+
+FIELD_PARSERS = {
+    'warehouses': {
+        'overdraft_control': parse_overdraft_control,
+        'capacity': parse_capacity
+    },
+    'items': {
+        'volume': parse_volume
+    }
+}
+
+
+def parse_record(model, record):
+    """Returns row of the model from a record, raises ValueError with
+    the reason if the record is invalid"""
+    if not isinstance(record, dict):
+        raise ValueError('malformed record')
+
+    name = record.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required')
+    if len(name) > NAME_MAX_LENGTH:
+        raise ValueError('name is too long')
+
+    row = {'name': name}
+    for field, parse in FIELD_PARSERS[model.__tablename__].items():
+        if field in record:
+            row[field] = parse(record[field])
+
+    return row
+
+
+def read_records(lines, import_format):
+    """Yields line number and record (None if the line is malformed)
+    for every record of lines of CSV or NDJSON"""
+    if import_format == 'csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            # empty cells are missing values
+            yield reader.line_num, {key: value
+                                    for key, value in record.items()
+                                    if key is not None and value != ''}
+        return
+
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError:
+            yield line_num, None
+
+
+def import_records(model, lines, import_format,
+                   batch_size=IMPORT_BATCH_SIZE):
+    """Imports warehouses or items from lines of CSV or NDJSON,
+    returns the report: numbers of inserted, updated and unchanged rows
+    and of rows skipped for a later row with the same name, number of
+    errors, the first IMPORT_MAX_ERRORS errors and the line after which
+    the file couldn't be read (None if it was read through)"""
+    report = {
+        'inserted': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'skipped': 0,
+        'error_count': 0,
+        'errors': [],
+        'aborted': None
+    }
+
+    def add_error(line_num, error):
+        report['error_count'] += 1
+        if len(report['errors']) < IMPORT_MAX_ERRORS:
+            report['errors'].append({'line': line_num, 'error': error})
+
+    def flush(batch):
+        try:
+            inserted, updated = import_batch(
+                model, [row for _, row in batch.values()])
+        except SQLAlchemyError:
+            db.session.rollback()
+            print(sys.exc_info())
+            for line_num, _ in batch.values():
+                add_error(line_num, 'not imported: database error')
+            return
+        report['inserted'] += inserted
+        report['updated'] += updated
+        report['unchanged'] += len(batch) - inserted - updated
+
+    # rows by name, a later row with the same name wins
+    batch = {}
+    last_line = 0
+    try:
+        for line_num, record in read_records(lines, import_format):
+            last_line = line_num
+            try:
+                row = parse_record(model, record)
+            except ValueError as ex:
+                add_error(line_num, str(ex) or 'malformed record')
+                continue
+
+            if row['name'] in batch:
+                report['skipped'] += 1
+            batch[row['name']] = (line_num, row)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = {}
+    except (UnicodeDecodeError, csv.Error):
+        print(sys.exc_info())
+        report['aborted'] = {'after_line': last_line,
+                             'error': 'malformed file'}
+
+    if batch:
+        flush(batch)
+
+    return report
@@ -1,14 +1,107 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+import click
+from flask.cli import FlaskGroup
 
 from app import app
-from models import db
+from config import BALANCE_SNAPSHOT_CHECKPOINT_EVERY, IDEMPOTENCY_KEY_TTL
+from generator import generate_dataset
+from importer import IMPORT_FORMATS, import_records
+from models import Warehouse, Item, rebuild_summaries, take_balance_snapshot, \
+    prune_idempotency_keys
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+# flask_migrate registers its commands on app.cli,
+# so `python manage.py db upgrade` works as `flask db upgrade`
+cli = FlaskGroup(create_app=lambda: app)
 
-manager.add_command('db', MigrateCommand)
+
+@cli.command('rebuild_summaries')
+def rebuild_summaries_command():
+    """Recompute warehouse and item summaries from balance_journal."""
+    rebuild_summaries()
+    click.echo('Summaries are rebuilt.')
+
+
+@cli.command('snapshot_balances')
+def snapshot_balances_command():
+    """Fold stock movements into a new balance snapshot."""
+    snapshot = take_balance_snapshot(BALANCE_SNAPSHOT_CHECKPOINT_EVERY)
+    click.echo(f'Snapshot {snapshot.id} is taken at '
+               f'{snapshot.taken_at.isoformat()}.')
+
+
+@cli.command('prune_idempotency_keys')
+def prune_idempotency_keys_command():
+    """Delete idempotency keys older than IDEMPOTENCY_KEY_TTL."""
+    count = prune_idempotency_keys(IDEMPOTENCY_KEY_TTL)
+    click.echo(f'{count} expired idempotency keys are deleted.')
+
+
+def import_file(model, path, import_format):
+    if import_format is None:
+        import_format = path.rsplit('.', 1)[-1].lower()
+        if import_format not in IMPORT_FORMATS:
+            raise click.UsageError('Unknown format, use --format.')
+
+    with open(path, newline='', encoding='utf-8') as lines:
+        report = import_records(model, lines, import_format)
+
+    click.echo(f"Inserted: {report['inserted']}, "
+               f"updated: {report['updated']}, "
+               f"unchanged: {report['unchanged']}, "
+               f"skipped as repeated: {report['skipped']}, "
+               f"errors: {report['error_count']}.")
+    for error in report['errors']:
+        click.echo(f"Line {error['line']}: {error['error']}", err=True)
+    if report['aborted'] is not None:
+        raise click.ClickException(
+            f"Import stopped after line {report['aborted']['after_line']}: "
+            f"{report['aborted']['error']}.")
+
+
+@cli.command('import_warehouses')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(IMPORT_FORMATS),
+              help='Format of the file, by default the extension.')
+def import_warehouses_command(path, import_format):
+    """Upsert warehouses by name from a CSV or NDJSON file."""
+    import_file(Warehouse, path, import_format)
+
+
+@cli.command('import_items')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(IMPORT_FORMATS),
+              help='Format of the file, by default the extension.')
+def import_items_command(path, import_format):
+    """Upsert items by name from a CSV or NDJSON file."""
+    import_file(Item, path, import_format)
+
+
+@cli.command('generate_dataset')
+@click.option('--warehouses', type=click.IntRange(1), default=100,
+              show_default=True)
+@click.option('--items', type=click.IntRange(1), default=100000,
+              show_default=True)
+@click.option('--balances', type=click.IntRange(0), default=1000000,
+              show_default=True,
+              help='Number of balance entries, at most warehouses * items.')
+@click.option('--skew', type=click.FloatRange(0), default=1.0,
+              show_default=True,
+              help='Zipf exponent of item popularity, 0 is uniform.')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--truncate', is_flag=True,
+              help='Delete all warehouses, items, balances and their '
+                   'history first.')
+def generate_dataset_command(warehouses, items, balances, skew, seed,
+                             truncate):
+    """Bulk load a synthetic dataset for performance work."""
+    try:
+        counts = generate_dataset(warehouses, items, balances, seed=seed,
+                                  skew=skew, truncate=truncate)
+    except ValueError as ex:
+        raise click.UsageError(f'{ex}, use --truncate.')
+    click.echo(f"Warehouses: {counts['warehouses']}, "
+               f"items: {counts['items']}, "
+               f"balances: {counts['balances']}.")
 
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    cli()
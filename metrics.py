@@ -0,0 +1,170 @@
+import os
+import time
+
+from flask import g, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, \
+    CONTENT_TYPE_LATEST, REGISTRY, generate_latest, multiprocess
+
+from config import PROMETHEUS_MULTIPROC_DIR
+
+# Metrics
+'''
+Prometheus metrics of requests, SQL statements and auth
+every request is timed per Flask endpoint (the view function), with the
+number and the total time of the SQL statements it ran, statements are
+counted by engine events (see profiling.py), so every query of every
+route is included
+under gunicorn every worker writes its metrics to files in
+PROMETHEUS_MULTIPROC_DIR and /metrics sums the files of all the workers
+up, whichever worker serves it (see gunicorn.conf.py), without the
+directory the metrics are of the serving process only
+connection pools are per worker, so their metrics are kept apart by
+the pid of the worker instead of being summed up
+'''
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Time to build the response, per endpoint',
+    ['endpoint', 'method'])
+
+RESPONSES = Counter(
+    'http_responses_total',
+    'Responses per endpoint and status code',
+    ['endpoint', 'status'])
+
+SQL_QUERIES = Histogram(
+    'db_queries_per_request',
+    'Number of SQL statements per request',
+    ['endpoint'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500))
+
+SQL_TIME = Histogram(
+    'db_time_per_request_seconds',
+    'Total time of SQL statements per request',
+    ['endpoint'])
+
+AUTH_TIME = Histogram(
+    'auth_verification_seconds',
+    'Time to authenticate a request, cache is hit or miss of the '
+    'verified token cache',
+    ['cache'],
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+             1, 2.5))
+
+COALESCED_BATCH = Histogram(
+    'balance_coalesced_batch_size',
+    'Number of balance operations applied together by write coalescing',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+# under gunicorn the pid label is added by prometheus_client, the gauges
+# of a worker are removed when it exits (see gunicorn.conf.py)
+POOL_CONNECTIONS = Gauge(
+    'db_pool_connections',
+    'Connections of the pool of a worker: size of the pool, checked out '
+    'and overflow connections',
+    ['state'],
+    multiprocess_mode='liveall')
+
+POOL_WAIT = Histogram(
+    'db_pool_wait_seconds',
+    'Time a checkout waited for a connection, per worker, outcome is ok '
+    'or timeout',
+    ['pid', 'outcome'],
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 2.5, 5, 10))
+
+
+def observe_request(endpoint, method, status, seconds):
+    REQUEST_LATENCY.labels(endpoint, method).observe(seconds)
+    RESPONSES.labels(endpoint, str(status)).inc()
+
+
+def observe_auth(cache_hit, seconds):
+    AUTH_TIME.labels('hit' if cache_hit else 'miss').observe(seconds)
+
+
+def observe_coalesced_batch(size):
+    COALESCED_BATCH.observe(size)
+
+
+def observe_pool_checkout(seconds, timed_out):
+    POOL_WAIT.labels(str(os.getpid()),
+                     'timeout' if timed_out else 'ok').observe(seconds)
+
+
+def set_pool_state(pool):
+    POOL_CONNECTIONS.labels('size').set(pool.size())
+    POOL_CONNECTIONS.labels('checked_out').set(pool.checkedout())
+    POOL_CONNECTIONS.labels('overflow').set(max(pool.overflow(), 0))
+
+
+def init_app(app):
+    # number and time of SQL statements are counted by profiling.py
+    @app.before_request
+    def start_request_metrics():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_start' in g and 'sql_queries' in g:
+            endpoint = request.endpoint or 'unknown'
+            observe_request(endpoint, request.method, response.status_code,
+                            time.perf_counter() - g.request_start)
+            SQL_QUERIES.labels(endpoint).observe(g.sql_queries)
+            SQL_TIME.labels(endpoint).observe(g.sql_time)
+        return response
+
+
+def collect_registry():
+    """Returns the registry with the metrics of all the workers"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render():
+    """Returns the metrics of all the workers in the text format
+    and its content type"""
+    return generate_latest(collect_registry()), CONTENT_TYPE_LATEST
+
+
+def pool_workers():
+    """Returns the connection pool figures of every running worker,
+    read from the metrics the workers write"""
+    workers = {}
+
+    def worker(pid):
+        return workers.setdefault(int(pid), {
+            'pid': int(pid), 'size': 0, 'checked_out': 0, 'overflow': 0,
+            'checkouts': 0, 'timeouts': 0, 'wait_total_ms': 0.0})
+
+    waits = []
+    for metric in collect_registry().collect():
+        for sample in metric.samples:
+            if sample.name == 'db_pool_connections':
+                pid = sample.labels.get('pid', os.getpid())
+                worker(pid)[sample.labels['state']] = int(sample.value)
+            elif sample.name in ('db_pool_wait_seconds_count',
+                                 'db_pool_wait_seconds_sum'):
+                waits.append(sample)
+
+    # waits of exited workers stay in the files, only running ones count
+    for sample in waits:
+        pid = int(sample.labels['pid'])
+        if pid not in workers:
+            continue
+        if sample.name == 'db_pool_wait_seconds_sum':
+            workers[pid]['wait_total_ms'] += sample.value * 1000
+        elif sample.labels['outcome'] == 'timeout':
+            workers[pid]['timeouts'] += int(sample.value)
+        else:
+            workers[pid]['checkouts'] += int(sample.value)
+
+    for stats in workers.values():
+        attempts = stats['checkouts'] + stats['timeouts']
+        stats['wait_mean_ms'] = round(
+            stats['wait_total_ms'] / attempts, 3) if attempts else 0.0
+        stats['wait_total_ms'] = round(stats['wait_total_ms'], 3)
+
+    return [workers[pid] for pid in sorted(workers)]
@@ -6,6 +6,7 @@ from logging.config import fileConfig
 from flask import current_app
 
 from alembic import context
+from sqlalchemy import create_engine, pool
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -71,7 +72,13 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
-    connectable = current_app.extensions['migrate'].db.get_engine()
+    # the app engine cancels statements after DB_STATEMENT_TIMEOUT, index
+    # builds and backfills on large tables take longer, so migrations get
+    # an engine of their own without the limit
+    connectable = create_engine(
+        current_app.extensions['migrate'].db.get_engine().url,
+        poolclass=pool.NullPool,
+        connect_args={'options': '-c statement_timeout=0'})
 
     with connectable.connect() as connection:
         context.configure(
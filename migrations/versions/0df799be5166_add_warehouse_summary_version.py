@@ -0,0 +1,25 @@
+"""add warehouse summary version
+
+Revision ID: 0df799be5166
+Revises: 42b9fe300972
+Create Date: 2026-10-18 16:02:33.184083
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0df799be5166'
+down_revision = '42b9fe300972'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('ALTER TABLE warehouse_summaries '
+               'ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0')
+
+
+def downgrade():
+    op.drop_column('warehouse_summaries', 'version')
@@ -0,0 +1,25 @@
+"""add warehouse capacity
+
+Revision ID: 42b9fe300972
+Revises: ed4cac532380
+Create Date: 2026-10-18 15:54:19.042308
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '42b9fe300972'
+down_revision = 'ed4cac532380'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('ALTER TABLE warehouses '
+               'ADD COLUMN IF NOT EXISTS capacity BIGINT')
+
+
+def downgrade():
+    op.drop_column('warehouses', 'capacity')
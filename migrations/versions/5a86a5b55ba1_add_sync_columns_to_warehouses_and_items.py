@@ -0,0 +1,63 @@
+"""add sync columns to warehouses and items
+
+Revision ID: 5a86a5b55ba1
+Revises: f7b3834bc679
+Create Date: 2026-10-18 16:05:32.574222
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a86a5b55ba1'
+down_revision = 'f7b3834bc679'
+branch_labels = None
+depends_on = None
+
+
+SYNCED_TABLES = ['warehouses', 'items']
+
+# existing rows get version 1, so a sync from version 0 returns all of them,
+# and the versions of the tables start at least from 1
+
+
+def drop_invalid_index(name):
+    # a cancelled concurrent build leaves an invalid index, IF NOT EXISTS
+    # would skip it on the next run and it would never be used
+    invalid = op.get_bind().execute(sa.text(
+        'SELECT NOT indisvalid FROM pg_index '
+        'WHERE indexrelid = to_regclass(CAST(:name AS text))'),
+        {'name': name}).scalar()
+    if invalid:
+        op.execute(f'DROP INDEX CONCURRENTLY {name}')
+
+
+def upgrade():
+    for table in SYNCED_TABLES:
+        op.execute(f'ALTER TABLE {table} '
+                   'ADD COLUMN IF NOT EXISTS row_version BIGINT NOT NULL '
+                   'DEFAULT 0')
+        op.execute(f'ALTER TABLE {table} '
+                   'ADD COLUMN IF NOT EXISTS updated_at '
+                   'TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()')
+        op.execute(f'UPDATE {table} SET row_version = 1 '
+                   'WHERE row_version = 0')
+        op.execute('INSERT INTO table_versions (name, version) '
+                   f"VALUES ('{table}', 1) ON CONFLICT (name) DO NOTHING")
+
+    with op.get_context().autocommit_block():
+        for table in SYNCED_TABLES:
+            drop_invalid_index(f'ix_{table}_row_version')
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                       f'ix_{table}_row_version ON {table} (row_version)')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in SYNCED_TABLES:
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS '
+                       f'ix_{table}_row_version')
+    for table in SYNCED_TABLES:
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'row_version')
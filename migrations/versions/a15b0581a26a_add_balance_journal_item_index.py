@@ -0,0 +1,46 @@
+"""add balance_journal item index
+
+Revision ID: a15b0581a26a
+Revises: 
+Create Date: 2026-10-18 15:51:08.280863
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a15b0581a26a'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# tables themselves are created by db.create_all() on app start, which also
+# creates the index on new databases, hence IF NOT EXISTS
+# the index is built concurrently, so the journal is not locked for writes
+
+
+def drop_invalid_index(name):
+    # a cancelled concurrent build leaves an invalid index, IF NOT EXISTS
+    # would skip it on the next run and it would never be used
+    invalid = op.get_bind().execute(sa.text(
+        'SELECT NOT indisvalid FROM pg_index '
+        'WHERE indexrelid = to_regclass(CAST(:name AS text))'),
+        {'name': name}).scalar()
+    if invalid:
+        op.execute(f'DROP INDEX CONCURRENTLY {name}')
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        drop_invalid_index('ix_balance_journal_item_id')
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                   'ix_balance_journal_item_id '
+                   'ON balance_journal (item_id, warehouse_id)')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS '
+                   'ix_balance_journal_item_id')
@@ -0,0 +1,32 @@
+"""add balance snapshot checkpoint
+
+Revision ID: c3e9d1a7b204
+Revises: 5a86a5b55ba1
+Create Date: 2026-10-18 17:12:41.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e9d1a7b204'
+down_revision = '5a86a5b55ba1'
+branch_labels = None
+depends_on = None
+
+
+# the first snapshot has always had all the balances, so it becomes the
+# first checkpoint
+
+
+def upgrade():
+    op.execute('ALTER TABLE balance_snapshots '
+               'ADD COLUMN IF NOT EXISTS checkpoint BOOLEAN NOT NULL '
+               'DEFAULT false')
+    op.execute('UPDATE balance_snapshots SET checkpoint = true '
+               'WHERE id = (SELECT min(id) FROM balance_snapshots)')
+
+
+def downgrade():
+    op.drop_column('balance_snapshots', 'checkpoint')
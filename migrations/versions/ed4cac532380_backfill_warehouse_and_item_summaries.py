@@ -0,0 +1,45 @@
+"""backfill warehouse and item summaries
+
+Revision ID: ed4cac532380
+Revises: a15b0581a26a
+Create Date: 2026-10-18 15:53:03.152065
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ed4cac532380'
+down_revision = 'a15b0581a26a'
+branch_labels = None
+depends_on = None
+
+
+# summary tables are created by db.create_all() on app start,
+# here they get filled from the existing balance_journal
+
+
+def upgrade():
+    op.execute('LOCK TABLE balance_journal, items IN SHARE MODE')
+    op.execute('DELETE FROM warehouse_summaries')
+    op.execute('DELETE FROM item_summaries')
+    op.execute('''
+        INSERT INTO warehouse_summaries
+            (warehouse_id, total_quantity, total_volume)
+        SELECT b.warehouse_id, sum(b.quantity), sum(b.quantity * i.volume)
+        FROM balance_journal b
+        JOIN items i ON i.id = b.item_id
+        GROUP BY b.warehouse_id
+    ''')
+    op.execute('''
+        INSERT INTO item_summaries (item_id, total_quantity)
+        SELECT item_id, sum(quantity)
+        FROM balance_journal
+        GROUP BY item_id
+    ''')
+
+
+def downgrade():
+    op.execute('DELETE FROM warehouse_summaries')
+    op.execute('DELETE FROM item_summaries')
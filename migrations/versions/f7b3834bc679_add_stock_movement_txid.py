@@ -0,0 +1,50 @@
+"""add stock movement txid
+
+Revision ID: f7b3834bc679
+Revises: 0df799be5166
+Create Date: 2026-10-18 16:04:07.188307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7b3834bc679'
+down_revision = '0df799be5166'
+branch_labels = None
+depends_on = None
+
+
+# the column is added without a default first, so existing movements stay
+# null (older than any cursor of the change feed) and the table is not
+# rewritten, the index is built concurrently
+
+
+def drop_invalid_index(name):
+    # a cancelled concurrent build leaves an invalid index, IF NOT EXISTS
+    # would skip it on the next run and it would never be used
+    invalid = op.get_bind().execute(sa.text(
+        'SELECT NOT indisvalid FROM pg_index '
+        'WHERE indexrelid = to_regclass(CAST(:name AS text))'),
+        {'name': name}).scalar()
+    if invalid:
+        op.execute(f'DROP INDEX CONCURRENTLY {name}')
+
+
+def upgrade():
+    op.execute('ALTER TABLE stock_movements '
+               'ADD COLUMN IF NOT EXISTS txid BIGINT')
+    op.execute('ALTER TABLE stock_movements '
+               'ALTER COLUMN txid SET DEFAULT txid_current()')
+    with op.get_context().autocommit_block():
+        drop_invalid_index('ix_stock_movements_txid')
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                   'ix_stock_movements_txid ON stock_movements (txid)')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS '
+                   'ix_stock_movements_txid')
+    op.drop_column('stock_movements', 'txid')
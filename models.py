@@ -1,5 +1,7 @@
+import select as select_module
+
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import backref
+from sqlalchemy import and_, func, select, tuple_
 
 db = SQLAlchemy()
 
@@ -10,6 +12,14 @@ class Warehouse(db.Model):
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     name = db.Column(db.String(120), nullable=False, unique=True)
     overdraft_control = db.Column(db.Boolean, default=False, nullable=False)
+    # maximal total volume of items, None for no limit
+    capacity = db.Column(db.BigInteger, nullable=True)
+    # version of the table the row was last changed in, see TableVersion
+    row_version = db.Column(db.BigInteger, nullable=False, default=0,
+                            server_default='0', index=True)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=db.func.now(),
+                           onupdate=db.func.now())
     balances = db.relationship('BalanceJournal', backref='warehouse')
 
     def __repr__(self) -> str:
@@ -17,12 +27,17 @@ class Warehouse(db.Model):
 
     def insert(self):
         db.session.add(self)
+        self.row_version = TableVersion.bump(self.__tablename__)
+        db.session.flush()
+        Tombstone.forget(self)
         db.session.commit()
 
     def update(self):
+        self.row_version = TableVersion.bump(self.__tablename__)
         db.session.commit()
 
     def delete(self):
+        Tombstone.record(self, TableVersion.bump(self.__tablename__))
         db.session.delete(self)
         db.session.commit()
 
@@ -30,7 +45,8 @@ class Warehouse(db.Model):
         return {
             'id': self.id,
             'name': self.name,
-            'overdraft_control': self.overdraft_control
+            'overdraft_control': self.overdraft_control,
+            'capacity': self.capacity
         }
 
 
@@ -40,6 +56,12 @@ class Item(db.Model):
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     name = db.Column(db.String(120), nullable=False, unique=True)
     volume = db.Column(db.Integer, nullable=False, default=0)
+    # version of the table the row was last changed in, see TableVersion
+    row_version = db.Column(db.BigInteger, nullable=False, default=0,
+                            server_default='0', index=True)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=db.func.now(),
+                           onupdate=db.func.now())
     balances = db.relationship('BalanceJournal', backref='item')
 
     def __repr__(self) -> str:
@@ -47,12 +69,17 @@ class Item(db.Model):
 
     def insert(self):
         db.session.add(self)
+        self.row_version = TableVersion.bump(self.__tablename__)
+        db.session.flush()
+        Tombstone.forget(self)
         db.session.commit()
 
     def update(self):
+        self.row_version = TableVersion.bump(self.__tablename__)
         db.session.commit()
 
     def delete(self):
+        Tombstone.record(self, TableVersion.bump(self.__tablename__))
         db.session.delete(self)
         db.session.commit()
 
@@ -63,9 +90,739 @@ class Item(db.Model):
             'volume': self.volume
         }
 
+    def update_volume(self, volume):
+        """Sets volume and moves volume totals of the warehouses storing
+        the item by the difference, the item should be locked for update"""
+        difference = volume - self.volume
+        self.volume = volume
+        if difference:
+            db.session.execute(ITEM_VOLUME_CHANGE, {
+                'item_id': self.id,
+                'difference': difference
+            })
+
+
+class WarehouseSummary(db.Model):
+    __tablename__ = 'warehouse_summaries'
+
+    warehouse_id = db.Column(db.Integer,
+                             db.ForeignKey('warehouses.id', ondelete='CASCADE'),
+                             primary_key=True, nullable=False)
+    total_quantity = db.Column(db.BigInteger, nullable=False, default=0)
+    total_volume = db.Column(db.BigInteger, nullable=False, default=0)
+    # incremented by every balance operation on the warehouse, the sum of
+    # versions changes with every change of balances without a single
+    # counter all the operations would have to wait for
+    version = db.Column(db.BigInteger, nullable=False, default=0,
+                        server_default='0')
+
+    def __repr__(self) -> str:
+        return f'<WH:{self.warehouse_id} summary>'
+
+    def format(self):
+        return {
+            'warehouse_id': self.warehouse_id,
+            'total_quantity': self.total_quantity,
+            'total_volume': self.total_volume
+        }
+
+
+class ItemSummary(db.Model):
+    __tablename__ = 'item_summaries'
+
+    item_id = db.Column(db.Integer,
+                        db.ForeignKey('items.id', ondelete='CASCADE'),
+                        primary_key=True, nullable=False)
+    total_quantity = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f'<I:{self.item_id} summary>'
+
+    def format(self):
+        return {
+            'item_id': self.item_id,
+            'total_quantity': self.total_quantity
+        }
+
+
+class StockMovement(db.Model):
+    __tablename__ = 'stock_movements'
+    # history of a warehouse or an item goes away with it
+    __table_args__ = (
+        db.Index('ix_stock_movements_entry',
+                 'warehouse_id', 'item_id', 'created_at'),
+    )
+
+    # append-only, rows are written by balance operations and never changed
+    id = db.Column(db.BigInteger, primary_key=True)
+    # time of the insert itself, not of the transaction start, so the
+    # snapshot job can rely on movements before its cutoff being committed
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=db.text('clock_timestamp()'),
+                           index=True)
+    warehouse_id = db.Column(db.Integer,
+                             db.ForeignKey('warehouses.id', ondelete='CASCADE'),
+                             nullable=False)
+    item_id = db.Column(db.Integer,
+                        db.ForeignKey('items.id', ondelete='CASCADE'),
+                        nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    # id of the writing transaction, the change feed of balances reads
+    # movements by it (ids are not in commit order, txids below the xmin
+    # of a snapshot are all finished). Null for movements written before
+    # the change feed
+    txid = db.Column(db.BigInteger, nullable=True,
+                     server_default=db.text('txid_current()'), index=True)
+
+    def __repr__(self) -> str:
+        return f'<Movement {self.id} WH:{self.warehouse_id} I:{self.item_id} ' \
+               f'quantity:{self.quantity}>'
+
+    def format(self):
+        return {
+            'id': self.id,
+            'created_at': self.created_at.isoformat(),
+            'warehouse_id': self.warehouse_id,
+            'item_id': self.item_id,
+            'quantity': self.quantity
+        }
+
+
+class BalanceSnapshot(db.Model):
+    __tablename__ = 'balance_snapshots'
+
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                         unique=True)
+    # a checkpoint has all the balances, the others only the changed ones
+    checkpoint = db.Column(db.Boolean, nullable=False, default=False,
+                           server_default='false')
+    entries = db.relationship('BalanceSnapshotEntry', backref='snapshot',
+                              passive_deletes=True)
+
+    def __repr__(self) -> str:
+        return f'<Snapshot {self.id} at {self.taken_at}>'
+
+    def format(self):
+        return {
+            'id': self.id,
+            'taken_at': self.taken_at.isoformat()
+        }
+
+
+class BalanceSnapshotEntry(db.Model):
+    __tablename__ = 'balance_snapshot_entries'
+    # latest entry of a balance as of a snapshot
+    __table_args__ = (
+        db.Index('ix_balance_snapshot_entries_entry',
+                 'warehouse_id', 'item_id', 'snapshot_id'),
+    )
+
+    # a checkpoint snapshot has all the balances, the next ones only the
+    # balances changed since the previous snapshot
+    snapshot_id = db.Column(db.Integer,
+                            db.ForeignKey('balance_snapshots.id',
+                                          ondelete='CASCADE'),
+                            primary_key=True, nullable=False)
+    warehouse_id = db.Column(db.Integer,
+                             db.ForeignKey('warehouses.id', ondelete='CASCADE'),
+                             primary_key=True, nullable=False)
+    item_id = db.Column(db.Integer,
+                        db.ForeignKey('items.id', ondelete='CASCADE'),
+                        primary_key=True, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'<Snapshot {self.snapshot_id} WH:{self.warehouse_id} ' \
+               f'I:{self.item_id} quantity:{self.quantity}>'
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    # version of a table is bumped in the same transaction as every change
+    # of the table, so all the processes see the new version together
+    # with the change
+    name = db.Column(db.String(64), primary_key=True, nullable=False)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f'<{self.name} version:{self.version}>'
+
+    @staticmethod
+    def bump(name):
+        """Increments version of the table in the current transaction,
+        returns the new version. The version row stays locked until
+        commit, so versions of a table are committed in order"""
+        return db.session.execute(TABLE_VERSION_BUMP, {'name': name}) \
+            .scalar()
+
+    @staticmethod
+    def get(name):
+        """Returns the committed version of the table, 0 if it never
+        changed"""
+        version = db.session.query(TableVersion.version) \
+            .filter_by(name=name).scalar()
+        return version or 0
+
+    @staticmethod
+    def tag(name):
+        """Returns an opaque tag of the committed version of the table"""
+        return f'{name}.{TableVersion.get(name)}'
+
+
+TABLE_VERSION_BUMP = db.text('''
+    INSERT INTO table_versions (name, version)
+    VALUES (:name, 1)
+    ON CONFLICT (name) DO UPDATE
+    SET version = table_versions.version + 1
+    RETURNING version
+''')
+
+
+class Tombstone(db.Model):
+    __tablename__ = 'tombstones'
+
+    # deleted rows of synced tables (warehouses and items), so a delta
+    # sync can tell the client to drop them
+    table_name = db.Column(db.String(64), primary_key=True, nullable=False)
+    row_id = db.Column(db.Integer, primary_key=True, nullable=False)
+    # version of the table the row was deleted in
+    row_version = db.Column(db.BigInteger, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=db.func.now())
+
+    def __repr__(self) -> str:
+        return f'<{self.table_name} {self.row_id} deleted ' \
+               f'version:{self.row_version}>'
+
+    @staticmethod
+    def record(entity, row_version):
+        """Records deletion of the entity in the current transaction"""
+        db.session.execute(TOMBSTONE_RECORD, {
+            'table_name': entity.__tablename__,
+            'row_id': entity.id,
+            'row_version': row_version
+        })
+
+    @staticmethod
+    def forget(entity):
+        """Drops the tombstone of a reused id of the inserted entity"""
+        Tombstone.query.filter_by(table_name=entity.__tablename__,
+                                  row_id=entity.id) \
+            .delete(synchronize_session=False)
+
+
+TOMBSTONE_RECORD = db.text('''
+    INSERT INTO tombstones (table_name, row_id, row_version)
+    VALUES (:table_name, :row_id, :row_version)
+    ON CONFLICT (table_name, row_id) DO UPDATE
+    SET row_version = excluded.row_version,
+        deleted_at = now()
+''')
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    # responses of balance operations sent with an Idempotency-Key header,
+    # so a retried request gets the response of the first one instead of
+    # being applied again. Keys are per user (sub of the token) and expire
+    # after IDEMPOTENCY_KEY_TTL seconds
+    owner = db.Column(db.String(255), primary_key=True, nullable=False)
+    key = db.Column(db.String(255), primary_key=True, nullable=False)
+    # sha256 of the request the key was first used with
+    request_hash = db.Column(db.String(64), nullable=False)
+    # JSON body of the response, written in the transaction of the request
+    response = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=db.func.now(), index=True)
+
+    def __repr__(self) -> str:
+        return f'<Idempotency key {self.key} of {self.owner}>'
+
+    @staticmethod
+    def claim(owner, key, request_hash, ttl):
+        """Claims the key in the current transaction, returns None if the
+        key is new (or expired), otherwise the request_hash and response
+        of the request which used it first. A request with the same key
+        that is still running is waited for"""
+        params = {'owner': owner, 'key': key, 'request_hash': request_hash,
+                  'ttl': ttl}
+        while True:
+            if db.session.execute(IDEMPOTENCY_KEY_CLAIM, params).first():
+                return None
+            first = db.session.execute(IDEMPOTENCY_KEY_GET, params).first()
+            # otherwise it has just been pruned
+            if first is not None:
+                return first
+
+    @staticmethod
+    def remember(owner, key, response):
+        """Stores the response of the claimed key in the current
+        transaction"""
+        db.session.execute(IDEMPOTENCY_KEY_REMEMBER, {
+            'owner': owner, 'key': key, 'response': response})
+
+
+def prune_idempotency_keys(ttl):
+    """Deletes expired idempotency keys, returns their number"""
+    count = db.session.execute(IDEMPOTENCY_KEYS_PRUNE, {'ttl': ttl}).rowcount
+    db.session.commit()
+    return count
+
+
+# a running request holds its key locked (the insert is not committed),
+# so a retry with the same key waits for it and then sees its response,
+# if the first request failed, its key is rolled back and the retry claims
+# it. An expired key is claimed again as if it were new
+IDEMPOTENCY_KEY_CLAIM = db.text('''
+    INSERT INTO idempotency_keys (owner, key, request_hash)
+    VALUES (:owner, :key, :request_hash)
+    ON CONFLICT (owner, key) DO UPDATE
+    SET request_hash = excluded.request_hash,
+        response = NULL,
+        created_at = now()
+    WHERE idempotency_keys.created_at
+          < now() - CAST(:ttl AS integer) * interval '1 second'
+    RETURNING true
+''')
+
+IDEMPOTENCY_KEY_GET = db.text('''
+    SELECT request_hash, response
+    FROM idempotency_keys
+    WHERE owner = :owner AND key = :key
+''')
+
+IDEMPOTENCY_KEY_REMEMBER = db.text('''
+    UPDATE idempotency_keys
+    SET response = :response
+    WHERE owner = :owner AND key = :key
+''')
+
+IDEMPOTENCY_KEYS_PRUNE = db.text('''
+    DELETE FROM idempotency_keys
+    WHERE created_at < now() - CAST(:ttl AS integer) * interval '1 second'
+''')
+
+# everything the list of balances is built from, read in one statement, so
+# all the parts come from the same snapshot of the database. Deleting a
+# warehouse drops its summary (and its part of the sum), so the version
+# of warehouses is a part of the tag, rebuilding summaries starts their
+# versions over, so it bumps the version of balance_journal
+BALANCES_VERSION = db.text('''
+    SELECT
+        coalesce(max(version) FILTER (WHERE name = 'warehouses'), 0)
+            AS warehouses,
+        coalesce(max(version) FILTER (WHERE name = 'items'), 0) AS items,
+        coalesce(max(version) FILTER (WHERE name = 'balance_journal'), 0)
+            AS balance_journal,
+        (SELECT coalesce(sum(version), 0) FROM warehouse_summaries)
+            AS summaries
+    FROM table_versions
+''')
+
+
+# BULK IMPORT
+# warehouses and items are upserted by name with one statement per batch,
+# rows come as arrays with all the columns filled in (missing values of
+# existing rows are taken from the rows, of new rows from defaults).
+# Rows which don't change are not updated and not returned, so they don't
+# get a new row_version and don't show up in delta sync
+IMPORT_DEFAULTS = {
+    'warehouses': {'overdraft_control': False, 'capacity': None},
+    'items': {'volume': 0}
+}
+
+IMPORT_UPSERTS = {
+    'warehouses': db.text('''
+        INSERT INTO warehouses (name, overdraft_control, capacity, row_version)
+        SELECT name, overdraft_control, capacity, :row_version
+        FROM unnest(CAST(:names AS varchar[]),
+                    CAST(:overdraft_control AS boolean[]),
+                    CAST(:capacity AS bigint[]))
+             AS r (name, overdraft_control, capacity)
+        ORDER BY name
+        ON CONFLICT (name) DO UPDATE
+        SET overdraft_control = excluded.overdraft_control,
+            capacity = excluded.capacity,
+            row_version = excluded.row_version,
+            updated_at = now()
+        WHERE (warehouses.overdraft_control, warehouses.capacity)
+              IS DISTINCT FROM (excluded.overdraft_control, excluded.capacity)
+        RETURNING id, xmax = 0 AS inserted
+    '''),
+    'items': db.text('''
+        INSERT INTO items (name, volume, row_version)
+        SELECT name, volume, :row_version
+        FROM unnest(CAST(:names AS varchar[]),
+                    CAST(:volume AS integer[]))
+             AS r (name, volume)
+        ORDER BY name
+        ON CONFLICT (name) DO UPDATE
+        SET volume = excluded.volume,
+            row_version = excluded.row_version,
+            updated_at = now()
+        WHERE items.volume <> excluded.volume
+        RETURNING id, xmax = 0 AS inserted
+    ''')
+}
+
+# moves volume totals of the warehouses storing the items when volumes of
+# many items change at once, the same way as ITEM_VOLUME_CHANGE
+ITEM_VOLUME_CHANGES = db.text('''
+    UPDATE warehouse_summaries ws
+    SET total_volume = ws.total_volume + b.volume
+    FROM (SELECT b.warehouse_id, sum(b.quantity * d.difference) AS volume
+          FROM balance_journal b
+          JOIN unnest(CAST(:item_ids AS integer[]),
+                      CAST(:differences AS integer[]))
+               AS d (item_id, difference) ON d.item_id = b.item_id
+          GROUP BY b.warehouse_id) b
+    WHERE ws.warehouse_id = b.warehouse_id
+''')
+
+
+def import_batch(model, rows):
+    """Upserts list of rows (dicts with name and any of the other columns)
+    of warehouses or items by name in one transaction, names should be
+    unique. Returns numbers of inserted and updated rows. The version of
+    the table is only bumped if any row is written"""
+    table = model.__tablename__
+    defaults = IMPORT_DEFAULTS[table]
+    names = [row['name'] for row in rows]
+
+    # existing rows are locked, so items can't change volume under
+    # balance operations and the volume differences are exact
+    existing = {
+        entity.name: entity
+        for entity in model.query.filter(model.name.in_(names))
+        .order_by(model.id).with_for_update()}
+
+    values = {column: [] for column in defaults}
+    for row in rows:
+        current = existing.get(row['name'])
+        for column, default in defaults.items():
+            if column in row:
+                value = row[column]
+            elif current is not None:
+                value = getattr(current, column)
+            else:
+                value = default
+            values[column].append(value)
+
+    result = db.session.execute(IMPORT_UPSERTS[table], dict(
+        values, names=names,
+        row_version=TableVersion.bump(table))).fetchall()
+    if not result:
+        # nothing changed, the cached responses and ETags stay valid
+        db.session.rollback()
+        return 0, 0
+
+    inserted = [row.id for row in result if row.inserted]
+    if inserted:
+        # ids of deleted rows can be reused
+        Tombstone.query.filter(Tombstone.table_name == table,
+                               Tombstone.row_id.in_(inserted)) \
+            .delete(synchronize_session=False)
+
+    if model is Item:
+        changes = [(existing[name].id, volume - existing[name].volume)
+                   for name, volume in zip(names, values['volume'])
+                   if name in existing and volume != existing[name].volume]
+        if changes:
+            db.session.execute(ITEM_VOLUME_CHANGES, {
+                'item_ids': [item_id for item_id, _ in changes],
+                'differences': [difference for _, difference in changes]
+            })
+
+    db.session.commit()
+
+    return len(inserted), len(result) - len(inserted)
+
+
+# applies balance operations in one statement: inserts new entries or
+# increments the existing ones. Overdraft control is checked in the same
+# statement, DO UPDATE re-checks it against the latest version of the row,
+# so concurrent operations on the same entry can't lose updates. A new
+# entry of a warehouse with overdraft control can't start below 0.
+# Accepted deltas are added to warehouse and item summaries by the same
+# statement. Items are locked FOR SHARE first, so a concurrent change of
+# item volume can't make volume totals drift, then entries, then summaries.
+# Warehouses which got more volume than their capacity are flagged with
+# over_capacity: their summary rows are locked by the statement, so the
+# check against the returned running total is exact, and the transaction
+# has to be rolled back.
+# Every operation of an accepted entry is appended to stock_movements.
+# Operations come as arrays in order, they are summed up per entry first
+# (an entry can't be affected twice by one statement). Rejected entries
+# are not returned.
+BALANCE_OPERATIONS = db.text('''
+    WITH ops AS (
+        SELECT *
+        FROM unnest(CAST(:warehouse_ids AS integer[]),
+                    CAST(:item_ids AS integer[]),
+                    CAST(:quantities AS integer[]))
+             WITH ORDINALITY AS o (warehouse_id, item_id, quantity, position)
+    ), entries AS (
+        SELECT warehouse_id, item_id, sum(quantity) AS quantity
+        FROM ops
+        GROUP BY warehouse_id, item_id
+    ), item_volumes AS (
+        SELECT id, volume FROM items
+        WHERE id IN (SELECT item_id FROM entries)
+        ORDER BY id
+        FOR SHARE
+    ), applied AS (
+        INSERT INTO balance_journal (warehouse_id, item_id, quantity)
+        SELECT w.id, o.item_id, o.quantity
+        FROM entries o
+        JOIN warehouses w ON w.id = o.warehouse_id
+        JOIN item_volumes i ON i.id = o.item_id
+        WHERE o.quantity >= 0 OR NOT w.overdraft_control OR EXISTS (
+                SELECT 1 FROM balance_journal b
+                WHERE b.warehouse_id = o.warehouse_id
+                  AND b.item_id = o.item_id)
+        ORDER BY o.warehouse_id, o.item_id
+        ON CONFLICT (warehouse_id, item_id) DO UPDATE
+        SET quantity = balance_journal.quantity + excluded.quantity
+        WHERE balance_journal.quantity + excluded.quantity >= 0
+           OR NOT EXISTS (
+                SELECT 1 FROM warehouses w
+                WHERE w.id = balance_journal.warehouse_id
+                  AND w.overdraft_control)
+        RETURNING warehouse_id, item_id, quantity
+    ), deltas AS (
+        SELECT o.warehouse_id, o.item_id, o.quantity,
+               o.quantity * i.volume AS volume
+        FROM applied a
+        JOIN entries o USING (warehouse_id, item_id)
+        JOIN item_volumes i ON i.id = o.item_id
+    ), warehouse_totals AS (
+        INSERT INTO warehouse_summaries
+            (warehouse_id, total_quantity, total_volume, version)
+        SELECT warehouse_id, sum(quantity), sum(volume), 1
+        FROM deltas
+        GROUP BY warehouse_id
+        ORDER BY warehouse_id
+        ON CONFLICT (warehouse_id) DO UPDATE
+        SET total_quantity = warehouse_summaries.total_quantity
+                             + excluded.total_quantity,
+            total_volume = warehouse_summaries.total_volume
+                           + excluded.total_volume,
+            version = warehouse_summaries.version + 1
+        RETURNING warehouse_id, total_volume
+    ), over_capacity AS (
+        SELECT t.warehouse_id
+        FROM warehouse_totals t
+        JOIN warehouses w ON w.id = t.warehouse_id
+        JOIN (SELECT warehouse_id, sum(volume) AS volume
+              FROM deltas
+              GROUP BY warehouse_id) d ON d.warehouse_id = t.warehouse_id
+        WHERE d.volume > 0 AND t.total_volume > w.capacity
+    ), item_totals AS (
+        INSERT INTO item_summaries (item_id, total_quantity)
+        SELECT item_id, sum(quantity)
+        FROM deltas
+        GROUP BY item_id
+        ORDER BY item_id
+        ON CONFLICT (item_id) DO UPDATE
+        SET total_quantity = item_summaries.total_quantity
+                             + excluded.total_quantity
+    ), movements AS (
+        INSERT INTO stock_movements (warehouse_id, item_id, quantity)
+        SELECT o.warehouse_id, o.item_id, o.quantity
+        FROM ops o
+        JOIN applied a USING (warehouse_id, item_id)
+        ORDER BY o.position
+    )
+    SELECT warehouse_id, item_id, quantity,
+           warehouse_id IN (SELECT warehouse_id FROM over_capacity)
+               AS over_capacity
+    FROM applied
+''')
+
+# warehouses whose balance operations may be applied together by write
+# coalescing, locked against switching overdraft control on
+COALESCED_WAREHOUSES = db.text('''
+    SELECT id FROM warehouses
+    WHERE id = ANY(CAST(:warehouse_ids AS integer[]))
+      AND NOT overdraft_control
+    ORDER BY id
+    FOR SHARE
+''')
+
+# warehouses whose volume total is over the capacity, their summaries are
+# already locked by BALANCE_OPERATIONS in the same transaction
+WAREHOUSES_OVER_CAPACITY = db.text('''
+    SELECT s.warehouse_id
+    FROM warehouse_summaries s
+    JOIN warehouses w ON w.id = s.warehouse_id
+    WHERE s.warehouse_id = ANY(CAST(:warehouse_ids AS integer[]))
+      AND s.total_volume > w.capacity
+''')
+
+# moves volume totals of the warehouses storing an item when the volume
+# of the item changes, with one set-based statement
+ITEM_VOLUME_CHANGE = db.text('''
+    UPDATE warehouse_summaries ws
+    SET total_volume = ws.total_volume + b.quantity * :difference
+    FROM (SELECT warehouse_id, sum(quantity) AS quantity
+          FROM balance_journal
+          WHERE item_id = :item_id
+          GROUP BY warehouse_id) b
+    WHERE ws.warehouse_id = b.warehouse_id
+''')
+
+# maintenance jobs scan whole tables, DB_STATEMENT_TIMEOUT of requests
+# doesn't apply to them
+NO_STATEMENT_TIMEOUT = db.text('SET LOCAL statement_timeout = 0')
+
+# recomputes all the summaries from balance_journal
+REBUILD_SUMMARIES = [
+    NO_STATEMENT_TIMEOUT,
+    db.text('LOCK TABLE balance_journal, items IN SHARE MODE'),
+    db.text('DELETE FROM warehouse_summaries'),
+    db.text('DELETE FROM item_summaries'),
+    db.text('''
+        INSERT INTO warehouse_summaries
+            (warehouse_id, total_quantity, total_volume)
+        SELECT b.warehouse_id, sum(b.quantity), sum(b.quantity * i.volume)
+        FROM balance_journal b
+        JOIN items i ON i.id = b.item_id
+        GROUP BY b.warehouse_id
+    '''),
+    db.text('''
+        INSERT INTO item_summaries (item_id, total_quantity)
+        SELECT item_id, sum(quantity)
+        FROM balance_journal
+        GROUP BY item_id
+    ''')
+]
+
+
+def rebuild_summaries():
+    """Recomputes warehouse and item summaries from balance_journal,
+    balance operations wait until it's done"""
+    for statement in REBUILD_SUMMARIES:
+        db.session.execute(statement)
+    # versions of the summaries start over
+    TableVersion.bump(BalanceJournal.__tablename__)
+    db.session.commit()
+
+
+# balance operations write stock_movements in the same statement as
+# balance_journal, so while the table is locked in SHARE mode (after all
+# the running operations are committed and before the next ones start)
+# balance_journal holds the balances as of the snapshot time
+SNAPSHOT_LOCK = db.text('LOCK TABLE stock_movements IN SHARE MODE')
+
+SNAPSHOT_INSERT = db.text('''
+    INSERT INTO balance_snapshots (taken_at, checkpoint)
+    VALUES (clock_timestamp(), :checkpoint)
+    RETURNING id, taken_at
+''')
+
+SNAPSHOT_ALL_ENTRIES = db.text('''
+    INSERT INTO balance_snapshot_entries
+        (snapshot_id, warehouse_id, item_id, quantity)
+    SELECT :snapshot_id, warehouse_id, item_id, quantity
+    FROM balance_journal
+''')
+
+SNAPSHOT_CHANGED_ENTRIES = db.text('''
+    INSERT INTO balance_snapshot_entries
+        (snapshot_id, warehouse_id, item_id, quantity)
+    SELECT :snapshot_id, b.warehouse_id, b.item_id, b.quantity
+    FROM balance_journal b
+    WHERE (b.warehouse_id, b.item_id) IN (
+        SELECT warehouse_id, item_id
+        FROM stock_movements
+        WHERE created_at > :since)
+''')
+
+
+# CHANGE FEED
+# the cursor of the feed is the xmin of the current snapshot: all the
+# transactions below it are finished, so movements with txid in
+# [since, cursor) are all visible and no later commit can add more
+BALANCE_CHANGES_CURSOR = db.text(
+    'SELECT txid_snapshot_xmin(txid_current_snapshot())')
+
+# balance operations notify the listeners of the feed, the notification
+# is delivered on commit (and dropped on rollback)
+BALANCE_CHANGES_CHANNEL = 'balance_changes'
+BALANCE_CHANGES_NOTIFY = db.text(f'NOTIFY {BALANCE_CHANGES_CHANNEL}')
+
+
+class BalanceChangesListener:
+    """LISTENs to notifications of balance operations on a connection of
+    its own, use as a context manager"""
+
+    def __enter__(self):
+        self.connection = db.engine.raw_connection()
+        cursor = self.connection.cursor()
+        cursor.execute(f'LISTEN {BALANCE_CHANGES_CHANNEL}')
+        self.connection.commit()
+        return self
+
+    def wait(self, timeout):
+        """Waits for a notification at most timeout seconds,
+        returns True if notified"""
+        connection = self.connection.connection
+        if not connection.notifies:
+            select_module.select([connection], [], [], timeout)
+            connection.poll()
+        notified = bool(connection.notifies)
+        connection.notifies.clear()
+        return notified
+
+    def __exit__(self, *exc_info):
+        cursor = self.connection.cursor()
+        cursor.execute('UNLISTEN *')
+        self.connection.commit()
+        self.connection.close()
+
+
+def take_balance_snapshot(checkpoint_every):
+    """Folds movements since the previous snapshot into a new snapshot
+    of the changed balances, returns the new snapshot. The first snapshot
+    and then every checkpoint_every-th one is a checkpoint of all the
+    balances, so a balance as of any moment is found in the latest
+    checkpoint or in at most checkpoint_every - 1 snapshots after it"""
+    previous = BalanceSnapshot.query \
+        .order_by(BalanceSnapshot.taken_at.desc()).first()
+    last_checkpoint = db.session.query(func.max(BalanceSnapshot.id)) \
+        .filter(BalanceSnapshot.checkpoint).scalar()
+    checkpoint = last_checkpoint is None or BalanceSnapshot.query \
+        .filter(BalanceSnapshot.id > last_checkpoint) \
+        .count() + 1 >= checkpoint_every
+
+    db.session.execute(NO_STATEMENT_TIMEOUT)
+    db.session.execute(SNAPSHOT_LOCK)
+    snapshot = db.session.execute(SNAPSHOT_INSERT,
+                                  {'checkpoint': checkpoint}).first()
+
+    if checkpoint:
+        db.session.execute(SNAPSHOT_ALL_ENTRIES,
+                           {'snapshot_id': snapshot.id})
+    else:
+        db.session.execute(SNAPSHOT_CHANGED_ENTRIES, {
+            'snapshot_id': snapshot.id,
+            'since': previous.taken_at
+        })
+    db.session.commit()
+
+    return BalanceSnapshot.query.get(snapshot.id)
+
 
 class BalanceJournal(db.Model):
     __tablename__ = 'balance_journal'
+    # primary key covers lookups by warehouse, this index covers lookups
+    # by item (and keeps them ordered by warehouse for pagination)
+    __table_args__ = (
+        db.Index('ix_balance_journal_item_id', 'item_id', 'warehouse_id'),
+    )
 
     warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'),
                              primary_key=True, nullable=False)
@@ -78,13 +835,16 @@ class BalanceJournal(db.Model):
 
     def insert(self):
         db.session.add(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        TableVersion.bump(self.__tablename__)
         db.session.commit()
 
     def format(self):
@@ -93,3 +853,340 @@ class BalanceJournal(db.Model):
             'item': self.item,
             'quantity': self.quantity,
         }
+
+    @staticmethod
+    def _flat_columns(b):
+        return (
+            b.quantity,
+            (b.quantity * Item.volume).label('volume'),
+            Warehouse.id.label('warehouse_id'),
+            Warehouse.name.label('warehouse_name'),
+            Warehouse.overdraft_control,
+            Warehouse.capacity,
+            Item.id.label('item_id'),
+            Item.name.label('item_name'),
+            Item.volume.label('item_volume')
+        )
+
+    @classmethod
+    def flat_query(cls, balances=None):
+        """Query of balances joined with their warehouses and items,
+        selects flat columns only, so rows don't need lazy loads.
+        balances is a subquery with warehouse_id, item_id and quantity
+        columns to use instead of balance_journal (e.g. as_of)"""
+        b = cls if balances is None else balances.c
+        return db.session.query(*cls._flat_columns(b)) \
+            .join(Warehouse, Warehouse.id == b.warehouse_id) \
+            .join(Item, Item.id == b.item_id)
+
+    @classmethod
+    def flat_select(cls):
+        """Core select of the same rows as flat_query, doesn't need
+        the session (e.g. for the async engine of asgi.py)"""
+        return select(*cls._flat_columns(cls)) \
+            .join(Warehouse, Warehouse.id == cls.warehouse_id) \
+            .join(Item, Item.id == cls.item_id)
+
+    @staticmethod
+    def changes_cursor():
+        """Returns the position of the change feed all the committed
+        balance operations are before"""
+        return db.session.execute(BALANCE_CHANGES_CURSOR).scalar()
+
+    @staticmethod
+    def _changed_entries(since, cursor):
+        return select(StockMovement.warehouse_id, StockMovement.item_id) \
+            .where(StockMovement.txid >= since,
+                   StockMovement.txid < cursor) \
+            .distinct().subquery()
+
+    @classmethod
+    def changes_query(cls, since, cursor):
+        """Query of flat rows of the balances changed by operations
+        between the since and the cursor positions of the change feed"""
+        changed = cls._changed_entries(since, cursor)
+        return cls.flat_query() \
+            .join(changed, and_(changed.c.warehouse_id == cls.warehouse_id,
+                                changed.c.item_id == cls.item_id))
+
+    @classmethod
+    def changes_select(cls, since, cursor):
+        """Core select of the same rows as changes_query"""
+        changed = cls._changed_entries(since, cursor)
+        return cls.flat_select() \
+            .join(changed, and_(changed.c.warehouse_id == cls.warehouse_id,
+                                changed.c.item_id == cls.item_id))
+
+    @staticmethod
+    def version_tag():
+        """Returns an opaque tag which changes with every change of the
+        balances, warehouses or items, cheap to read: one row per
+        warehouse at most"""
+        version = db.session.execute(BALANCES_VERSION).first()
+        return 'balances.' + '.'.join(str(part) for part in version)
+
+    @classmethod
+    def as_of(cls, moment):
+        """Subquery of balances as of moment: balances of the nearest
+        snapshot taken before moment plus movements after the snapshot.
+        Balances come from the snapshots and the movements only, so an
+        entry deleted from balance_journal later is still there. Only the
+        latest checkpoint snapshot and the snapshots after it are read,
+        so the cost is bounded by the checkpoint interval, not by the
+        length of the history. None if there is no snapshot before
+        moment"""
+        snapshot = BalanceSnapshot.query \
+            .filter(BalanceSnapshot.taken_at <= moment) \
+            .order_by(BalanceSnapshot.taken_at.desc()).first()
+        if snapshot is None:
+            return None
+        checkpoint_id = db.session.query(func.max(BalanceSnapshot.id)) \
+            .filter(BalanceSnapshot.checkpoint,
+                    BalanceSnapshot.id <= snapshot.id).scalar()
+
+        tail = db.session.query(
+            StockMovement.warehouse_id,
+            StockMovement.item_id,
+            func.sum(StockMovement.quantity).label('quantity')
+        ).filter(StockMovement.created_at > snapshot.taken_at,
+                 StockMovement.created_at <= moment) \
+            .group_by(StockMovement.warehouse_id, StockMovement.item_id) \
+            .subquery('tail')
+
+        # the latest entry of every balance in the checkpoint and the
+        # snapshots after it up to this one
+        entries = db.session.query(
+            BalanceSnapshotEntry.warehouse_id,
+            BalanceSnapshotEntry.item_id,
+            BalanceSnapshotEntry.quantity
+        ).filter(BalanceSnapshotEntry.snapshot_id.between(checkpoint_id,
+                                                         snapshot.id)) \
+            .distinct(BalanceSnapshotEntry.warehouse_id,
+                      BalanceSnapshotEntry.item_id) \
+            .order_by(BalanceSnapshotEntry.warehouse_id,
+                      BalanceSnapshotEntry.item_id,
+                      BalanceSnapshotEntry.snapshot_id.desc()) \
+            .subquery('entries')
+
+        return db.session.query(
+            func.coalesce(entries.c.warehouse_id,
+                          tail.c.warehouse_id).label('warehouse_id'),
+            func.coalesce(entries.c.item_id, tail.c.item_id).label('item_id'),
+            (func.coalesce(entries.c.quantity, 0) +
+             func.coalesce(tail.c.quantity, 0)).label('quantity')
+        ).select_from(entries) \
+            .outerjoin(tail,
+                       and_(tail.c.warehouse_id == entries.c.warehouse_id,
+                            tail.c.item_id == entries.c.item_id),
+                       full=True) \
+            .subquery('balances_as_of')
+
+    @staticmethod
+    def format_row(row):
+        """Formats a row of flat_query the same way as
+        warehouse and item format themselves"""
+        return {
+            'warehouse': {
+                'id': row.warehouse_id,
+                'name': row.warehouse_name,
+                'overdraft_control': row.overdraft_control,
+                'capacity': row.capacity
+            },
+            'item': {
+                'id': row.item_id,
+                'name': row.item_name,
+                'volume': row.item_volume
+            },
+            'quantity': row.quantity,
+            'volume': row.volume
+        }
+
+    @staticmethod
+    def _apply_operations(operations):
+        """Applies list of (warehouse_id, item_id, quantity) operations
+        with one statement, returns {(warehouse_id, item_id): new balance}
+        of the accepted entries and set of warehouses over capacity"""
+        rows = db.session.execute(BALANCE_OPERATIONS, {
+            'warehouse_ids': [op[0] for op in operations],
+            'item_ids': [op[1] for op in operations],
+            'quantities': [op[2] for op in operations]
+        }).fetchall()
+
+        if rows:
+            db.session.execute(BALANCE_CHANGES_NOTIFY)
+
+        new_balances = {(row.warehouse_id, row.item_id): row.quantity
+                        for row in rows}
+        over_capacity = {row.warehouse_id for row in rows
+                         if row.over_capacity}
+
+        return new_balances, over_capacity
+
+    @classmethod
+    def apply_operation(cls, warehouse_id, item_id, quantity, commit=True):
+        """Adds quantity to the balance and returns the new balance,
+        None if the operation was rejected by overdraft control or
+        capacity of the warehouse or the warehouse does not exist.
+        Without commit the operation is left in the current transaction
+        (a rejected one is rolled back anyway)"""
+        new_balances, over_capacity = cls._apply_operations(
+            [(warehouse_id, item_id, quantity)])
+
+        if over_capacity:
+            db.session.rollback()
+            return None
+
+        if commit:
+            db.session.commit()
+
+        return new_balances.get((warehouse_id, item_id))
+
+    @classmethod
+    def apply_coalesced(cls, operations):
+        """Applies list of (warehouse_id, item_id, quantity) operations of
+        concurrent requests with one statement, the caller commits them.
+        Returns {index: new balance (or None) as apply_operation does} of
+        the applied operations, the others are left to be applied one by
+        one: operations on warehouses with overdraft control, and all of
+        them when their total doesn't fit the capacity"""
+        warehouse_ids = sorted({op[0] for op in operations})
+        # overdraft control can't be switched on until commit
+        coalesced = set(db.session.execute(COALESCED_WAREHOUSES, {
+            'warehouse_ids': warehouse_ids}).scalars())
+        # decreases go first: if the volume total fits the capacity after
+        # all of them, it fits after every one of them
+        positions = sorted(
+            (index for index, op in enumerate(operations)
+             if op[0] in coalesced),
+            key=lambda index: operations[index][2])
+        if not positions:
+            db.session.rollback()
+            return {}
+
+        new_balances, over_capacity = cls._apply_operations(
+            [operations[index] for index in positions])
+        # a warehouse over the capacity (lowered, or volumes of items
+        # raised) can only be emptied: one by one its increases are
+        # rejected even if the total goes down
+        increased = sorted({operations[index][0] for index in positions
+                            if operations[index][2] > 0})
+        if not over_capacity and increased:
+            over_capacity = set(db.session.execute(
+                WAREHOUSES_OVER_CAPACITY,
+                {'warehouse_ids': increased}).scalars())
+        if over_capacity:
+            # some of them don't fit, the order matters
+            db.session.rollback()
+            return {}
+
+        # balances after every operation, back from the last ones
+        results = {}
+        for index in reversed(positions):
+            warehouse_id, item_id, quantity = operations[index]
+            balance = new_balances.get((warehouse_id, item_id))
+            results[index] = balance
+            if balance is not None:
+                new_balances[(warehouse_id, item_id)] = balance - quantity
+
+        return results
+
+    @classmethod
+    def apply_batch(cls, operations, atomic=True):
+        """Applies list of (warehouse_id, item_id, quantity) operations
+        in one transaction. Operations are checked in order, so overdraft
+        control and capacity see the balance left by the previous ones.
+        Returns list of errors (None for accepted operations) and
+        {(warehouse_id, item_id): new balance} of the touched entries.
+        If atomic, nothing is applied when any operation fails."""
+        keys = sorted({(op[0], op[1]) for op in operations})
+        warehouse_ids = {key[0] for key in keys}
+        item_ids = {key[1] for key in keys}
+
+        warehouses = {
+            warehouse_id: (overdraft_control, capacity)
+            for warehouse_id, overdraft_control, capacity in db.session.query(
+                Warehouse.id, Warehouse.overdraft_control, Warehouse.capacity)
+            .filter(Warehouse.id.in_(warehouse_ids))}
+        # lock items, then existing entries, then summaries in a stable
+        # order (the same as BALANCE_OPERATIONS), so concurrent batches
+        # can't deadlock and balances can't change until commit
+        volumes = dict(db.session.query(Item.id, Item.volume)
+                       .filter(Item.id.in_(item_ids))
+                       .order_by(Item.id)
+                       .with_for_update(read=True))
+
+        balances = {key: 0 for key in keys}
+        locked = db.session.query(cls.warehouse_id, cls.item_id, cls.quantity) \
+            .filter(tuple_(cls.warehouse_id, cls.item_id).in_(keys)) \
+            .order_by(cls.warehouse_id, cls.item_id) \
+            .with_for_update()
+        for warehouse_id, item_id, quantity in locked:
+            balances[(warehouse_id, item_id)] = quantity
+
+        total_volumes = {warehouse_id: 0 for warehouse_id in warehouse_ids}
+        locked = db.session.query(WarehouseSummary.warehouse_id,
+                                  WarehouseSummary.total_volume) \
+            .filter(WarehouseSummary.warehouse_id.in_(warehouse_ids)) \
+            .order_by(WarehouseSummary.warehouse_id) \
+            .with_for_update()
+        for warehouse_id, total_volume in locked:
+            total_volumes[warehouse_id] = total_volume
+
+        errors = []
+        accepted = []
+        for warehouse_id, item_id, quantity in operations:
+            key = (warehouse_id, item_id)
+            if warehouse_id not in warehouses:
+                errors.append('warehouse not found')
+                continue
+            if item_id not in volumes:
+                errors.append('item not found')
+                continue
+
+            overdraft_control, capacity = warehouses[warehouse_id]
+            volume = quantity * volumes[item_id]
+            if overdraft_control and balances[key] + quantity < 0:
+                errors.append('overdraft')
+            elif (capacity is not None and volume > 0 and
+                    total_volumes[warehouse_id] + volume > capacity):
+                errors.append('over capacity')
+            else:
+                errors.append(None)
+                balances[key] += quantity
+                total_volumes[warehouse_id] += volume
+                accepted.append((warehouse_id, item_id, quantity))
+
+        if atomic and any(errors):
+            db.session.rollback()
+            return errors, {}
+
+        new_balances, over_capacity = cls._apply_operations(accepted)
+
+        # rejected by the statement itself (e.g. overdraft control or
+        # capacity changed meanwhile)
+        if over_capacity:
+            db.session.rollback()
+            errors = ['over capacity' if op[0] in over_capacity else error
+                      for op, error in zip(operations, errors)]
+            if atomic:
+                return errors, {}
+            # apply the rest without warehouses over capacity
+            rest = [(index, op) for index, op in enumerate(operations)
+                    if op[0] not in over_capacity]
+            rest_errors, new_balances = cls.apply_batch(
+                [op for _, op in rest], atomic)
+            for (index, _), error in zip(rest, rest_errors):
+                errors[index] = error
+            return errors, new_balances
+
+        rejected = {(op[0], op[1]) for op in accepted} - set(new_balances)
+        if rejected:
+            errors = ['overdraft' if (op[0], op[1]) in rejected else error
+                      for op, error in zip(operations, errors)]
+            if atomic:
+                db.session.rollback()
+                return errors, {}
+
+        db.session.commit()
+
+        return errors, new_balances
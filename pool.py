@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+from metrics import observe_pool_checkout, set_pool_state
+
+# Pool Metrics
+'''
+connection pool of the process with the time requests wait for a
+connection, the pool itself knows checked out and overflow connections,
+so only waits are counted here
+every gunicorn worker has a pool of its own, so the metrics are per
+process and come with its pid, they are also exported to the prometheus
+metrics labelled by pid (see metrics.py), so the pools of all the
+workers can be read from any of them
+'''
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def stats(self, pool):
+        return {
+            'pid': os.getpid(),
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_total_ms': round(self.wait_total * 1000, 3),
+            'wait_max_ms': round(self.wait_max * 1000, 3),
+            'wait_mean_ms': round(
+                self.wait_total * 1000 / (self.checkouts + self.timeouts), 3)
+            if self.checkouts + self.timeouts else 0.0
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeasuredQueuePool(QueuePool):
+    """QueuePool which records how long every checkout waits
+    for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            wait = time.perf_counter() - start
+            pool_metrics.record(wait, timed_out=True)
+            observe_pool_checkout(wait, timed_out=True)
+            raise
+        wait = time.perf_counter() - start
+        pool_metrics.record(wait)
+        observe_pool_checkout(wait, timed_out=False)
+        set_pool_state(self)
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        set_pool_state(self)
@@ -0,0 +1,101 @@
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import SQL_PROFILING, SQL_SLOW_QUERY_MS
+
+# SQL Profiling
+'''
+every SQL statement run during a request is timed by engine events, the
+request keeps the number and the total time of its statements (reported
+by /metrics, see metrics.py)
+opt-in with SQL_PROFILING: the slowest statement of the request is kept
+too and responses get Server-Timing and X-SQL-* headers with the numbers
+opt-in with SQL_SLOW_QUERY_MS: statements running longer are logged with
+their EXPLAIN, the plan is read with a new cursor of the same connection
+inside a savepoint, so it doesn't touch the results of the statement or
+the transaction of the request
+'''
+
+EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    context._profiling_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    # statements outside requests (e.g. manage.py) are not counted
+    if not has_request_context() or 'sql_queries' not in g:
+        return
+
+    elapsed = time.perf_counter() - context._profiling_start
+    g.sql_queries += 1
+    g.sql_time += elapsed
+
+    if SQL_PROFILING and elapsed > g.sql_slowest[0]:
+        g.sql_slowest = (elapsed, statement)
+
+    if SQL_SLOW_QUERY_MS and elapsed * 1000 >= SQL_SLOW_QUERY_MS:
+        log_slow_statement(conn, statement, parameters, executemany,
+                           elapsed)
+
+
+def explain(conn, statement, parameters):
+    """Returns the plan of the statement, None if it can't be explained"""
+    if conn.dialect.name != 'postgresql' or \
+            statement.lstrip().split(None, 1)[0].lower() not in EXPLAINABLE:
+        return None
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute('SAVEPOINT sql_profiling_explain')
+        try:
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT sql_profiling_explain')
+            plan = None
+        cursor.execute('RELEASE SAVEPOINT sql_profiling_explain')
+        return plan
+    finally:
+        cursor.close()
+
+
+def log_slow_statement(conn, statement, parameters, executemany, elapsed):
+    plan = None if executemany else explain(conn, statement, parameters)
+    current_app.logger.warning(
+        'Slow SQL statement (%.1f ms) in %s %s:\n%s\nPlan:\n%s',
+        elapsed * 1000, request.method, request.path, statement.strip(),
+        plan or 'not available')
+
+
+def init_app(app):
+    @app.before_request
+    def start_sql_profiling():
+        g.sql_queries = 0
+        g.sql_time = 0.0
+        g.sql_slowest = (0.0, None)
+
+    @app.after_request
+    def add_sql_profiling_headers(response):
+        if SQL_PROFILING and 'sql_queries' in g:
+            total_ms = g.sql_time * 1000
+            slowest_ms = g.sql_slowest[0] * 1000
+            response.headers['Server-Timing'] = \
+                f'db;dur={total_ms:.1f};desc="{g.sql_queries} queries", ' \
+                f'db-slowest;dur={slowest_ms:.1f}'
+            response.headers['X-SQL-Queries'] = str(g.sql_queries)
+            response.headers['X-SQL-Time-Ms'] = f'{total_ms:.1f}'
+            response.headers['X-SQL-Slowest-Ms'] = f'{slowest_ms:.1f}'
+            if g.sql_slowest[1] is not None:
+                # headers are a single line
+                response.headers['X-SQL-Slowest'] = \
+                    ' '.join(g.sql_slowest[1].split())[:1000]
+        return response